@@ -3,29 +3,91 @@
 import os
 import numpy as np
 import glob
+import functools
 import argparse
-import librosa
-import ddsp
-from tqdm import tqdm
+import scipy.fft
+import sys
 from utils.file_utils import get_config
+from utils.parallel_utils import add_parallel_args, run_parallel
+from utils.plan_utils import add_manifest_args, get_planned_synthesis_dirs
+from utils.journal_utils import add_journal_args, get_journal, piece_key
 from utils.file_utils import pickle_load, pickle_dump
-from midi_ddsp.utils.audio_io import save_wav
-from midi_ddsp.utils.inference_utils import ensure_same_length
+from utils.audio_utils import AsyncWavWriter, read_wav
+from utils.profile_utils import add_profile_args, get_profiler, profile_stage
+from utils.random_utils import add_seed_args, get_rng
 
 # Reverb IR from: https://www.housecallfm.com/download-gns-personal-lexicon-480l, saved in ./ir
+IR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ir')
 REVERB_TYPES = {'small': 'Small Hall.aif', 'medium': 'Medium Hall.aif', 'large': 'Large Hall.aif'}
-
-
-def add_reverb(wav, reverb_type, sample_rate):
-    reverb_ir, _ = librosa.load(os.path.join(os.path.abspath(__file__), REVERB_TYPES[reverb_type]), sr=sample_rate,
-                                mono=True)
-    reverb_length = len(reverb_ir)
-    reverb = ddsp.effects.Reverb(trainable=False, reverb_length=reverb_length)
-    wav = reverb(wav[np.newaxis], reverb_ir)
-    return wav
-
-
-def audio_augmentation(data_dir, output_dir, sample_rate):
+IR_FILE_EXTENSIONS = ('.aif', '.aiff', '.wav', '.flac')
+
+
+class ImpulseResponseBank:
+    """Impulse responses of a directory, loaded and resampled once, with their FFTs cached for each FFT size.
+
+    The convolution matches ddsp.effects.Reverb(trainable=False): the first sample of the IR is masked to 0
+    and the dry signal is added to the wet signal.
+    """
+
+    def __init__(self, sample_rate, ir_dir=IR_DIR, reverb_types=None):
+        self.sample_rate = sample_rate
+        self.ir_dir = ir_dir
+        if reverb_types is None:
+            if os.path.abspath(ir_dir) == IR_DIR:
+                reverb_types = REVERB_TYPES
+            else:  # user-supplied IR directory: the reverb type is the file name without extension.
+                reverb_types = {os.path.splitext(f)[0]: f for f in sorted(os.listdir(ir_dir))
+                                if f.lower().endswith(IR_FILE_EXTENSIONS)}
+        self.reverb_types = reverb_types
+        self._irs = {}
+        self._ir_ffts = {}
+
+    def get_ir(self, reverb_type):
+        if reverb_type not in self._irs:
+            import librosa
+            ir, _ = librosa.load(os.path.join(self.ir_dir, self.reverb_types[reverb_type]), sr=self.sample_rate,
+                                 mono=True)
+            ir[0] = 0.0  # mask the dry part of the IR
+            self._irs[reverb_type] = ir
+        return self._irs[reverb_type]
+
+    def get_ir_fft(self, reverb_type, fft_size):
+        key = (reverb_type, fft_size)
+        if key not in self._ir_ffts:
+            self._ir_ffts[key] = scipy.fft.rfft(self.get_ir(reverb_type), n=fft_size)
+        return self._ir_ffts[key]
+
+    def apply(self, wavs, reverb_type):
+        """Add reverb to a list of 1-D audio arrays with one batched FFT convolution."""
+        lengths = [len(w) for w in wavs]
+        max_length = max(lengths)
+        # round up the FFT size to a power of 2 to keep the number of cached IR FFTs small.
+        fft_size = int(2 ** np.ceil(np.log2(max_length + len(self.get_ir(reverb_type)) - 1)))
+        batch = np.zeros((len(wavs), max_length), dtype=np.float32)
+        for i, w in enumerate(wavs):
+            batch[i, :len(w)] = w
+        wet = scipy.fft.irfft(scipy.fft.rfft(batch, n=fft_size, axis=-1) * self.get_ir_fft(reverb_type, fft_size),
+                              n=fft_size, axis=-1)[:, :max_length]
+        wet += batch
+        return [wet[i, :length] for i, length in enumerate(lengths)]
+
+
+_IR_BANKS = {}
+
+
+def get_ir_bank(sample_rate, ir_dir=IR_DIR):
+    """Get the impulse response bank of ir_dir, shared by everything in the current process."""
+    key = (sample_rate, os.path.abspath(ir_dir))
+    if key not in _IR_BANKS:
+        _IR_BANKS[key] = ImpulseResponseBank(sample_rate, ir_dir)
+    return _IR_BANKS[key]
+
+
+def add_reverb(wav, reverb_type, sample_rate, ir_dir=IR_DIR):
+    return get_ir_bank(sample_rate, ir_dir).apply([wav], reverb_type)[0]
+
+
+def audio_augmentation(data_dir, output_dir, sample_rate, ir_dir=IR_DIR, seed=None):
     # if output_dir is provided, then save to the output_dir.
     if output_dir:
         output_dir = os.path.join(output_dir, os.path.basename(data_dir))
@@ -33,33 +95,37 @@ def audio_augmentation(data_dir, output_dir, sample_rate):
     else:  # else, change in place
         output_dir = data_dir
 
-    # load metadata
-    pickle_path = os.path.join(data_dir, 'metadata.pickle')
-    metadata = pickle_load(pickle_path)
+    with profile_stage('load'):
+        # load metadata
+        pickle_path = os.path.join(data_dir, 'metadata.pickle')
+        metadata = pickle_load(pickle_path)
 
-    # sample a reverb type for all stems
-    reverb_type = np.random.choice(REVERB_TYPES)
+        # sample a reverb type for all stems
+        ir_bank = get_ir_bank(sample_rate, ir_dir)
+        rng = get_rng(seed, 'audio_augmentation', piece_key(data_dir))
+        reverb_type = str(rng.choice(list(ir_bank.reverb_types)))
 
-    wav_files = glob.glob(f'{data_dir}/*.wav')
-    stem_wav_files = [f for f in wav_files if 'mix.wav' not in f]  # exclude mix wav
-    wavs_after_reverb = []
-    for wav_file in stem_wav_files:
-        wav, _ = librosa.load(wav_file, sr=sample_rate, mono=True)
-        wav = add_reverb(wav, reverb_type, sample_rate)
-        save_wav(wav[0].numpy(), os.path.join(output_dir, os.path.basename(wav_file)), sample_rate=sample_rate)
-        wavs_after_reverb.append(wav[0].numpy())
+        wav_files = glob.glob(f'{data_dir}/*.wav')
+        stem_wav_files = [f for f in wav_files if 'mix.wav' not in f]  # exclude mix wav
+        wavs = [read_wav(wav_file, sample_rate)[0] for wav_file in stem_wav_files]
+    with profile_stage('reverb'):
+        wavs_after_reverb = ir_bank.apply(wavs, reverb_type)
+    with profile_stage('save'), AsyncWavWriter(num_threads=2) as writer:
+        for wav_file, wav in zip(stem_wav_files, wavs_after_reverb):
+            writer.write(wav, os.path.join(output_dir, os.path.basename(wav_file)), sample_rate)
 
-    midi_audio_mix = np.sum(
-        np.stack(ensure_same_length(
-            [wavs_after_reverb[i].astype(np.float64) for i in range(len(wavs_after_reverb))], axis=0),
-            axis=-1),
-        axis=-1)
+        # the stems are padded with zeros to the longest one, without importing MIDI-DDSP and TensorFlow
+        max_length = max(len(wav) for wav in wavs_after_reverb)
+        midi_audio_mix = np.sum(
+            np.stack([np.pad(wav.astype(np.float64), (0, max_length - len(wav))) for wav in wavs_after_reverb],
+                     axis=-1),
+            axis=-1)
 
-    save_wav(midi_audio_mix, os.path.join(output_dir, 'mix.wav'), sample_rate=sample_rate)
+        writer.write(midi_audio_mix, os.path.join(output_dir, 'mix.wav'), sample_rate)
 
-    # add metadata and save
-    metadata['audio_augmentation'] = f'reverb_{reverb_type}'
-    pickle_dump(metadata, os.path.join(output_dir, 'metadata.pickle'))
+        # add metadata and save
+        metadata['audio_augmentation'] = f'reverb_{reverb_type}'
+        pickle_dump(metadata, os.path.join(output_dir, 'metadata.pickle'))
 
 
 if __name__ == '__main__':
@@ -71,14 +137,41 @@ if __name__ == '__main__':
                        help='the directory containing multiple folders generated by MIDI-DDSP synthesis.')
     parser.add_argument('--output_dir', type=str, default=None, metavar='N',
                         help='the directory for output.')
+    parser.add_argument('--ir_dir', type=str, default=IR_DIR, metavar='N',
+                        help='the directory containing the reverb impulse responses.')
+    add_parallel_args(parser)
+    add_journal_args(parser)
+    add_manifest_args(parser)
+    add_profile_args(parser)
+    add_seed_args(parser)
     args = parser.parse_args()
 
     config = get_config()
 
     if args.synthesis_dir:
         synth_dir_list = [args.synthesis_dir]
+    elif args.multi_synthesis_dir and args.manifest:
+        planned_batches = get_planned_synthesis_dirs(args.manifest, args.multi_synthesis_dir, args.chunk)
+        synth_dir_list = [d for batch in planned_batches for d in batch]
     elif args.multi_synthesis_dir:
-        synth_dir_list = glob.glob(f'{args.multi_synthesis_dir}/*/')
-
-    for synth_dir in tqdm(synth_dir_list):
-        audio_augmentation(synth_dir, args.output_dir, config['sample_rate'])
+        synth_dir_list = sorted(glob.glob(f'{args.multi_synthesis_dir}/*/'))
+
+    # the trailing slash of the glob would make the name of the piece directories empty
+    synth_dir_list = [os.path.normpath(d) for d in synth_dir_list]
+    journal = get_journal(args)
+    synth_dir_list = journal.pending('audio_augmentation', synth_dir_list, ignore_journal=args.ignore_journal,
+                                     in_place=not args.output_dir)
+
+    process_fn = functools.partial(audio_augmentation,
+                                   output_dir=args.output_dir,
+                                   sample_rate=config['sample_rate'],
+                                   ir_dir=args.ir_dir,
+                                   seed=args.seed)
+    profiler = get_profiler(args, 'audio_augmentation')
+    failures = run_parallel(profiler.wrap(journal.wrap('audio_augmentation', process_fn)),
+                            synth_dir_list,
+                            num_workers=args.num_workers,
+                            chunksize=args.chunksize)
+    profiler.summarize()
+    if failures:
+        sys.exit(1)
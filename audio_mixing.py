@@ -3,46 +3,36 @@
 import numpy as np
 import os
 import glob
-import pyloudnorm as pyln
-import librosa
-from tqdm import tqdm
+import functools
 import argparse
+import sys
 
 from utils.file_utils import pickle_load, pickle_dump
-from midi_ddsp.utils.audio_io import save_wav
 from utils.file_utils import get_config
+from utils.loudness_utils import integrated_loudness
+from utils.audio_utils import AsyncWavWriter, read_wav
+from utils.parallel_utils import add_parallel_args, run_parallel
+from utils.plan_utils import add_manifest_args, get_planned_synthesis_dirs
+from utils.journal_utils import add_journal_args, get_journal
+from utils.profile_utils import add_profile_args, get_profiler, profile_stage
 
 
-def audio_normalization(data_dir, output_dir, normalization_factor, target_peak, sample_rate):
+def normalize_and_mix(all_audio, normalization_factor, target_peak, sample_rate):
+    """Loudness normalize the stems and mix them.
+    Returns the normalized stems as an array [stems, samples], the mixture, and the metadata of the normalization."""
     # https://github.com/ethman/slakh-generation/blob/e6454eb57a3683b99cdd16695fe652f83b75bb14/render_by_instrument.py#L439
-
-    # if output_dir is provided, then save to the output_dir.
-    if output_dir:
-        output_dir = os.path.join(output_dir, os.path.basename(data_dir))
-        os.makedirs(output_dir, exist_ok=True)
-    else:  # else, change in place
-        output_dir = data_dir
-
-    # load metadata
-    pickle_path = os.path.join(data_dir, 'metadata.pickle')
-    metadata = pickle_load(pickle_path)
-
-    wav_files = glob.glob(f'{data_dir}/*.wav')
-    stem_wav_files = [f for f in wav_files if 'mix.wav' not in f]  # exclude mix wav
-    all_audio = []
-    for wav_file in stem_wav_files:
-        wav, _ = librosa.load(wav_file, sr=sample_rate, mono=True)
-        all_audio.append(wav)
-
-    meter = pyln.Meter(sample_rate)
+    mix_metadata = {}
     target_gain = np.power(10.0, target_peak / 20.0)
-    loudnesses = [meter.integrated_loudness(a) for a in all_audio]
-    metadata['stem_integrated_loudness'] = {j: float(loudnesses[j]) for j in range(len(loudnesses))}
+    # one buffer for all the stems, metered at once and normalized in place.
+    normalized_audio = np.empty((len(all_audio), len(all_audio[0])), dtype=np.float64)
+    for j, a in enumerate(all_audio):
+        normalized_audio[j] = a
+    loudnesses = integrated_loudness(normalized_audio, sample_rate)
+    mix_metadata['stem_integrated_loudness'] = {j: float(loudnesses[j]) for j in range(len(loudnesses))}
     if np.any(np.isinf(loudnesses)):
         raise RuntimeError('One or more sources have -inf loudness!')
 
-    normalized_audio = [pyln.normalize.loudness(a, loudnesses[j], normalization_factor)
-                        for j, a in enumerate(all_audio)]
+    normalized_audio *= np.power(10.0, (normalization_factor - loudnesses) / 20.0)[:, np.newaxis]
     mixture = np.sum(normalized_audio, axis=0)
 
     peak = np.max(np.abs(mixture))
@@ -53,26 +43,52 @@ def audio_normalization(data_dir, output_dir, normalization_factor, target_peak,
         if np.any(np.isnan(mixture)):
             raise RuntimeError('This mixture contains NaNs!!!')
 
-        normalized_audio = [a * gain for a in normalized_audio]
+        normalized_audio *= gain
 
-        metadata['overall_gain'] = float(gain)
+        mix_metadata['overall_gain'] = float(gain)
 
     else:
-        metadata['overall_gain'] = 1.0
+        mix_metadata['overall_gain'] = 1.0
+
+    mix_metadata['normalization_factor'] = normalization_factor
+    mix_metadata['target_peak'] = target_peak
+    mix_metadata['normalized'] = True
+
+    return normalized_audio, mixture, mix_metadata
+
+
+def audio_normalization(data_dir, output_dir, normalization_factor, target_peak, sample_rate):
+    # if output_dir is provided, then save to the output_dir.
+    if output_dir:
+        output_dir = os.path.join(output_dir, os.path.basename(data_dir))
+        os.makedirs(output_dir, exist_ok=True)
+    else:  # else, change in place
+        output_dir = data_dir
+
+    with profile_stage('load'):
+        # load metadata
+        pickle_path = os.path.join(data_dir, 'metadata.pickle')
+        metadata = pickle_load(pickle_path)
+
+        wav_files = glob.glob(f'{data_dir}/*.wav')
+        stem_wav_files = [f for f in wav_files if 'mix.wav' not in f]  # exclude mix wav
+        all_audio = [read_wav(wav_file, sample_rate)[0] for wav_file in stem_wav_files]
 
-    metadata['normalization_factor'] = normalization_factor
-    metadata['target_peak'] = target_peak
-    metadata['normalized'] = True
+    with profile_stage('normalize_and_mix'):
+        normalized_audio, mixture, mix_metadata = normalize_and_mix(all_audio, normalization_factor, target_peak,
+                                                                    sample_rate)
+    metadata.update(mix_metadata)
 
-    # save metadata
-    pickle_dump(metadata, os.path.join(output_dir, 'metadata.pickle'))
+    with profile_stage('save'), AsyncWavWriter(num_threads=2) as writer:
+        # save stem
+        for i, wav_file in enumerate(stem_wav_files):
+            writer.write(normalized_audio[i], os.path.join(output_dir, os.path.basename(wav_file)), sample_rate)
 
-    # save stem
-    for i, wav_file in enumerate(stem_wav_files):
-        save_wav(normalized_audio[i], os.path.join(output_dir, os.path.basename(wav_file)), sample_rate=sample_rate)
+        # save mix
+        writer.write(mixture, os.path.join(output_dir, 'mix.wav'), sample_rate)
 
-    # save mix
-    save_wav(mixture, os.path.join(output_dir, 'mix.wav'), sample_rate=sample_rate)
+        # save metadata
+        pickle_dump(metadata, os.path.join(output_dir, 'metadata.pickle'))
 
 
 if __name__ == '__main__':
@@ -84,18 +100,38 @@ if __name__ == '__main__':
                        help='the directory containing multiple folders generated by MIDI-DDSP synthesis.')
     parser.add_argument('--output_dir', type=str, default=None, metavar='N',
                         help='the directory for output.')
+    add_parallel_args(parser)
+    add_journal_args(parser)
+    add_manifest_args(parser)
+    add_profile_args(parser)
     args = parser.parse_args()
 
     config = get_config()
 
     if args.synthesis_dir:
         synth_dir_list = [args.synthesis_dir]
+    elif args.multi_synthesis_dir and args.manifest:
+        planned_batches = get_planned_synthesis_dirs(args.manifest, args.multi_synthesis_dir, args.chunk)
+        synth_dir_list = [d for batch in planned_batches for d in batch]
     elif args.multi_synthesis_dir:
-        synth_dir_list = glob.glob(f'{args.multi_synthesis_dir}/*/')
-
-    for synth_dir in tqdm(synth_dir_list):
-        audio_normalization(synth_dir,
-                            args.output_dir,
-                            normalization_factor=config['mix_normalization_factor'],
-                            target_peak=config['mix_target_peak'],
-                            sample_rate=config['sample_rate'])
+        synth_dir_list = sorted(glob.glob(f'{args.multi_synthesis_dir}/*/'))
+
+    # the trailing slash of the glob would make the name of the piece directories empty
+    synth_dir_list = [os.path.normpath(d) for d in synth_dir_list]
+    journal = get_journal(args)
+    synth_dir_list = journal.pending('audio_mixing', synth_dir_list, ignore_journal=args.ignore_journal,
+                                     in_place=not args.output_dir)
+
+    process_fn = functools.partial(audio_normalization,
+                                   output_dir=args.output_dir,
+                                   normalization_factor=config['mix_normalization_factor'],
+                                   target_peak=config['mix_target_peak'],
+                                   sample_rate=config['sample_rate'])
+    profiler = get_profiler(args, 'audio_mixing')
+    failures = run_parallel(profiler.wrap(journal.wrap('audio_mixing', process_fn)),
+                            synth_dir_list,
+                            num_workers=args.num_workers,
+                            chunksize=args.chunksize)
+    profiler.summarize()
+    if failures:
+        sys.exit(1)
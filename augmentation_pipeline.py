@@ -0,0 +1,173 @@
+"""
+Run the optional augmentations (note expression, synthesis parameters, reverb) and the mixing on each piece in memory,
+so that the stems, the mix and the metadata are only read and written once per piece.
+"""
+
+import os
+import glob
+import functools
+import argparse
+import numpy as np
+import sys
+from utils.metadata_utils import load_metadata
+from utils.file_utils import get_config
+from utils.file_utils import pickle_dump
+from utils.audio_utils import AsyncWavWriter, read_wav
+from utils.profile_utils import add_profile_args, get_profiler, profile_stage
+from utils.random_utils import add_seed_args, get_rng
+from utils.model_utils import add_model_args, get_synthesis_generator, get_worker_model_kwargs
+from utils.parallel_utils import add_parallel_args, run_parallel
+from utils.plan_utils import add_manifest_args, get_planned_synthesis_dirs
+from utils.journal_utils import add_journal_args, get_journal, piece_key
+from expression_augmentation import note_expression_edit, conditioning_df_to_audio
+from synth_params_augmentation import intonation_augmentation, synth_params_to_audio
+from audio_augmentation import IR_DIR, get_ir_bank
+from audio_mixing import normalize_and_mix
+
+
+def augmentation_pipeline(data_dir, output_dir, config, note_expression=False, synth_params=False, reverb=False,
+                          ir_dir=IR_DIR, seed=None):
+    # if output_dir is provided, then save to the output_dir.
+    if output_dir:
+        output_dir = os.path.join(output_dir, os.path.basename(data_dir))
+        os.makedirs(output_dir, exist_ok=True)
+    else:  # else, change in place
+        output_dir = data_dir
+    sample_rate = config['sample_rate']
+
+    with profile_stage('load'):
+        # load metadata
+        pickle_path = os.path.join(data_dir, 'metadata.pickle')
+        instrument, conditioning_df_all, synthesis_parameters, residual_metadata = load_metadata(pickle_path)
+    instrument_id_all, instrument_name_all = instrument
+    stem_names = [f'{part_number}_{instrument_name}.wav' for part_number, instrument_name in
+                  enumerate(instrument_name_all)]
+    stems = None
+
+    if note_expression:
+        with profile_stage('note_expression'):
+            conditioning_df_all, edited = note_expression_edit(
+                conditioning_df_all, config, get_rng(seed, 'expression_augmentation', piece_key(data_dir)))
+        with profile_stage('synthesis'):
+            midi_audio, synthesis_parameters = conditioning_df_to_audio(get_synthesis_generator(),
+                                                                        conditioning_df_all,
+                                                                        instrument_id_all,
+                                                                        display_progressbar=False)
+        stems = [midi_audio[i].numpy().astype(np.float64) for i in range(midi_audio.shape[0])]
+        residual_metadata['random_note_expression'] = edited
+
+    if synth_params:
+        import tensorflow as tf
+
+        with profile_stage('intonation'):
+            synthesis_parameters, correction_amount_all = intonation_augmentation(
+                synthesis_parameters, conditioning_df_all, config,
+                get_rng(seed, 'synth_params_augmentation', piece_key(data_dir)))
+        midi_audio = synth_params_to_audio(get_synthesis_generator(), synthesis_parameters,
+                                           tf.concat(instrument_id_all, 0))
+        stems = [midi_audio[i].numpy().astype(np.float64) for i in range(midi_audio.shape[0])]
+        residual_metadata['pitch_correction_amount'] = correction_amount_all
+
+    if stems is None:  # no re-synthesis, start from the stems on disk.
+        with profile_stage('load'):
+            stems = [read_wav(os.path.join(data_dir, stem_name), sample_rate)[0] for stem_name in stem_names]
+
+    if reverb:
+        # sample a reverb type for all stems
+        ir_bank = get_ir_bank(sample_rate, ir_dir)
+        rng = get_rng(seed, 'audio_augmentation', piece_key(data_dir))
+        reverb_type = str(rng.choice(list(ir_bank.reverb_types)))
+        with profile_stage('reverb'):
+            stems = ir_bank.apply(stems, reverb_type)
+        residual_metadata['audio_augmentation'] = f'reverb_{reverb_type}'
+
+    with profile_stage('normalize_and_mix'):
+        normalized_audio, mixture, mix_metadata = normalize_and_mix(
+            stems, normalization_factor=config['mix_normalization_factor'], target_peak=config['mix_target_peak'],
+            sample_rate=sample_rate)
+
+    # make metadata with each item as dict
+    num_parts = len(instrument_id_all)
+    metadata = {
+        'instrument_id': {i: instrument_id_all[i].numpy()[0] for i in range(num_parts)},
+        'note_expression_control': {i: conditioning_df_all[i] for i in range(num_parts)},
+        'synthesis_parameters': {i: {k: v[i].numpy() for k, v in synthesis_parameters.items()}
+                                 for i in range(num_parts)},
+    }
+    metadata = {**metadata, **residual_metadata, **mix_metadata}  # merge changed metadata from rest of metadata
+    with profile_stage('save'), AsyncWavWriter(num_threads=2) as writer:
+        # save stem
+        for stem_name, audio in zip(stem_names, normalized_audio):
+            writer.write(audio, os.path.join(output_dir, stem_name), sample_rate)
+
+        # save mix
+        writer.write(mixture, os.path.join(output_dir, 'mix.wav'), sample_rate)
+
+        pickle_dump(metadata, os.path.join(output_dir, 'metadata.pickle'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fused augmentation and mixing pipeline')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--synthesis_dir', type=str, default=None, metavar='N',
+                       help='the directory generated by MIDI-DDSP synthesis.')
+    group.add_argument('--multi_synthesis_dir', type=str, default=None, metavar='N',
+                       help='the directory containing multiple folders generated by MIDI-DDSP synthesis.')
+    parser.add_argument('--output_dir', type=str, default=None, metavar='N',
+                        help='the directory for output.')
+    parser.add_argument('--note_expression', action='store_true',
+                        help='apply the note expression augmentation.')
+    parser.add_argument('--synth_params', action='store_true',
+                        help='apply the synthesis parameters augmentation.')
+    parser.add_argument('--reverb', action='store_true',
+                        help='apply the reverb augmentation.')
+    parser.add_argument('--ir_dir', type=str, default=IR_DIR, metavar='N',
+                        help='the directory containing the reverb impulse responses.')
+    add_parallel_args(parser)
+    add_journal_args(parser)
+    add_manifest_args(parser)
+    add_model_args(parser)
+    add_profile_args(parser)
+    add_seed_args(parser)
+    args = parser.parse_args()
+
+    config = get_config()
+
+    if args.synthesis_dir:
+        synth_dir_list = [args.synthesis_dir]
+    elif args.multi_synthesis_dir and args.manifest:
+        planned_batches = get_planned_synthesis_dirs(args.manifest, args.multi_synthesis_dir, args.chunk)
+        synth_dir_list = [d for batch in planned_batches for d in batch]
+    elif args.multi_synthesis_dir:
+        synth_dir_list = sorted(glob.glob(f'{args.multi_synthesis_dir}/*/'))
+    else:
+        raise ValueError('Please specify either synthesis_dir or multi_synthesis_dir.')
+
+    # the trailing slash of the glob would make the name of the piece directories empty
+    synth_dir_list = [os.path.normpath(d) for d in synth_dir_list]
+    journal = get_journal(args)
+    synth_dir_list = journal.pending('augmentation_pipeline', synth_dir_list, ignore_journal=args.ignore_journal,
+                                     in_place=not args.output_dir)
+
+    if args.note_expression or args.synth_params:
+        model_kwargs = get_worker_model_kwargs(args)
+    else:
+        model_kwargs = {}
+
+    process_fn = functools.partial(augmentation_pipeline,
+                                   output_dir=args.output_dir,
+                                   config=config,
+                                   note_expression=args.note_expression,
+                                   synth_params=args.synth_params,
+                                   reverb=args.reverb,
+                                   ir_dir=args.ir_dir,
+                                   seed=args.seed)
+    profiler = get_profiler(args, 'augmentation_pipeline')
+    failures = run_parallel(profiler.wrap(journal.wrap('augmentation_pipeline', process_fn)),
+                            synth_dir_list,
+                            num_workers=args.num_workers,
+                            chunksize=args.chunksize,
+                            **model_kwargs)
+    profiler.summarize()
+    if failures:
+        sys.exit(1)
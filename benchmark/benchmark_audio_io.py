@@ -0,0 +1,84 @@
+"""
+Benchmark reading the stems with utils/audio_utils.read_wav against librosa.load, and writing them with the
+AsyncWavWriter against writing them one after another, checking that the samples and files are identical.
+"""
+
+import os
+import sys
+import time
+import glob
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from utils.file_utils import get_config
+from utils.audio_utils import read_wav, save_wav, AsyncWavWriter
+
+
+def time_per_file(func, files, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        results = [func(f) for f in files]
+    return (time.perf_counter() - start) / repeats / len(files), results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark audio I/O')
+    parser.add_argument('--multi_synthesis_dir', type=str, default=None, metavar='N',
+                        help='the directory containing multiple folders generated by MIDI-DDSP synthesis. '
+                             'If not provided, benchmark on random stems.')
+    parser.add_argument('--num_pieces', type=int, default=10, metavar='N',
+                        help='the number of pieces to benchmark on.')
+    parser.add_argument('--repeats', type=int, default=3, metavar='N',
+                        help='the number of times each file is read.')
+    args = parser.parse_args()
+
+    import librosa
+    sample_rate = get_config()['sample_rate']
+    tmp_dir = tempfile.mkdtemp()
+    if args.multi_synthesis_dir:
+        stem_files = [f for synth_dir in sorted(glob.glob(f'{args.multi_synthesis_dir}/*/'))[:args.num_pieces]
+                      for f in sorted(glob.glob(f'{synth_dir}/*.wav')) if 'mix.wav' not in f]
+    else:
+        rng = np.random.default_rng(0)
+        stem_files = []
+        for i in range(args.num_pieces * 4):
+            stem_files.append(os.path.join(tmp_dir, f'{i}.wav'))
+            save_wav(rng.normal(0, 0.1, 60 * sample_rate), stem_files[-1], sample_rate)
+
+    librosa.load(stem_files[0], sr=sample_rate, mono=True)  # librosa imports its submodules on first use
+    librosa_time, librosa_wavs = time_per_file(lambda f: librosa.load(f, sr=sample_rate, mono=True)[0],
+                                               stem_files, args.repeats)
+    read_time, wavs = time_per_file(lambda f: read_wav(f, sample_rate)[0], stem_files, args.repeats)
+    mmap_time, mmap_wavs = time_per_file(lambda f: np.asarray(read_wav(f, sample_rate, mmap=True)[0]),
+                                         stem_files, args.repeats)
+    max_difference = max(max(np.max(np.abs(a - b)), np.max(np.abs(a - c)))
+                         for a, b, c in zip(librosa_wavs, wavs, mmap_wavs))
+    print(f'{len(stem_files)} stems, {sum(len(w) for w in wavs) / sample_rate / len(wavs):.1f}s on average')
+    print(f'librosa.load:         {librosa_time * 1000:.2f} ms/stem')
+    print(f'read_wav:             {read_time * 1000:.2f} ms/stem ({librosa_time / read_time:.1f}x)')
+    print(f'read_wav, mmap:       {mmap_time * 1000:.2f} ms/stem ({librosa_time / mmap_time:.1f}x)')
+    print(f'max abs difference:   {max_difference:.2e}')
+
+    sync_dir, async_dir = os.path.join(tmp_dir, 'sync'), os.path.join(tmp_dir, 'async')
+    os.makedirs(sync_dir)
+    os.makedirs(async_dir)
+    start = time.perf_counter()
+    for i, wav in enumerate(wavs):
+        save_wav(wav, os.path.join(sync_dir, f'{i}.wav'), sample_rate)
+    sync_time = (time.perf_counter() - start) / len(wavs)
+    start = time.perf_counter()
+    with AsyncWavWriter(num_threads=2, max_pending=len(wavs)) as writer:
+        for i, wav in enumerate(wavs):
+            writer.write(wav, os.path.join(async_dir, f'{i}.wav'), sample_rate)
+        # the time the caller is blocked, the rest overlaps with whatever the caller computes next
+        queue_time = (time.perf_counter() - start) / len(wavs)
+    async_time = (time.perf_counter() - start) / len(wavs)
+    identical = all(open(os.path.join(sync_dir, f'{i}.wav'), 'rb').read() ==
+                    open(os.path.join(async_dir, f'{i}.wav'), 'rb').read() for i in range(len(wavs)))
+    print(f'save_wav:             {sync_time * 1000:.2f} ms/stem')
+    print(f'AsyncWavWriter (2):   {async_time * 1000:.2f} ms/stem until closed, caller blocked '
+          f'{queue_time * 1000:.3f} ms/stem, {"identical" if identical else "DIFFERENT"} files')
+    shutil.rmtree(tmp_dir)
@@ -0,0 +1,108 @@
+"""
+Check the batched loudness metering of utils/loudness_utils.py against pyloudnorm, and benchmark the mixing of
+audio_mixing.normalize_and_mix against the original per-stem pyloudnorm implementation.
+Exits with an error if the loudness differs from pyloudnorm by more than --tolerance LU.
+"""
+
+import os
+import sys
+import time
+import glob
+import argparse
+import warnings
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from utils.file_utils import get_config
+from utils.loudness_utils import integrated_loudness
+from audio_mixing import normalize_and_mix
+
+
+def normalize_and_mix_per_stem(all_audio, normalization_factor, target_peak, sample_rate):
+    """The original implementation, kept as the reference for the benchmark."""
+    import pyloudnorm as pyln
+    meter = pyln.Meter(sample_rate)
+    target_gain = np.power(10.0, target_peak / 20.0)
+    loudnesses = [meter.integrated_loudness(a) for a in all_audio]
+    normalized_audio = [pyln.normalize.loudness(a, loudnesses[j], normalization_factor)
+                        for j, a in enumerate(all_audio)]
+    mixture = np.sum(normalized_audio, axis=0)
+    peak = np.max(np.abs(mixture))
+    if peak >= target_gain:
+        gain = target_gain / peak
+        mixture *= gain
+        normalized_audio = [a * gain for a in normalized_audio]
+    return normalized_audio, mixture
+
+
+def synthetic_signals(sample_rate, rng):
+    """Signals exercising the gating: tones, noise starting halfway, decaying noise, silence and lengths close to
+    the block size."""
+    signals = []
+    for num_samples in [int(0.4 * sample_rate), int(0.4 * sample_rate) + 1, 3 * sample_rate + 123, 30 * sample_rate]:
+        t = np.arange(num_samples) / sample_rate
+        signals += [0.1 * np.sin(2 * np.pi * 440 * t),
+                    rng.normal(0, 0.05, num_samples) * (t > t[-1] / 2),
+                    rng.normal(0, 0.3, num_samples) * np.exp(-3 * t) + 1e-5 * rng.normal(size=num_samples),
+                    np.zeros(num_samples)]
+    return [s.astype(np.float32) for s in signals]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark loudness')
+    parser.add_argument('--multi_synthesis_dir', type=str, default=None, metavar='N',
+                        help='the directory containing multiple folders generated by MIDI-DDSP synthesis. '
+                             'If not provided, benchmark on random stems.')
+    parser.add_argument('--num_pieces', type=int, default=10, metavar='N',
+                        help='the number of pieces to benchmark on.')
+    parser.add_argument('--tolerance', type=float, default=1e-4, metavar='N',
+                        help='the largest accepted difference with pyloudnorm, in LU.')
+    args = parser.parse_args()
+
+    import pyloudnorm as pyln
+    config = get_config()
+    sample_rate = config['sample_rate']
+    rng = np.random.default_rng(0)
+    meter = pyln.Meter(sample_rate)
+    warnings.simplefilter('ignore')  # pyloudnorm warns about clipping, and -inf for silence
+
+    signals = synthetic_signals(sample_rate, rng)
+    reference = np.array([meter.integrated_loudness(s) for s in signals])
+    loudness = np.array([integrated_loudness(s, sample_rate) for s in signals])
+    # all the signals at once, padded to the same length
+    padded = np.zeros((len(signals), max(len(s) for s in signals)), dtype=np.float32)
+    for i, s in enumerate(signals):
+        padded[i, :len(s)] = s
+    batched_loudness = integrated_loudness(padded, sample_rate, lengths=[len(s) for s in signals])
+    same_inf = np.isinf(reference) == np.isinf(loudness)
+    finite = ~np.isinf(reference)
+    max_difference = max(np.max(np.abs(loudness - reference)[finite]),
+                         np.max(np.abs(batched_loudness - reference)[finite]))
+    print(f'max difference with pyloudnorm: {max_difference:.2e} LU')
+    if not same_inf.all() or not (np.isinf(batched_loudness) == np.isinf(reference)).all() \
+            or max_difference > args.tolerance:
+        sys.exit(f'The loudness differs from pyloudnorm by more than {args.tolerance} LU.')
+
+    if args.multi_synthesis_dir:
+        import librosa
+        pieces = []
+        for synth_dir in sorted(glob.glob(f'{args.multi_synthesis_dir}/*/'))[:args.num_pieces]:
+            stem_wav_files = sorted(f for f in glob.glob(f'{synth_dir}/*.wav') if 'mix.wav' not in f)
+            pieces.append([librosa.load(f, sr=sample_rate, mono=True)[0] for f in stem_wav_files])
+    else:
+        pieces = [[rng.normal(0, 0.1 * (i + 1), 60 * sample_rate).astype(np.float32) for i in range(4)]
+                  for _ in range(args.num_pieces)]
+
+    mix_args = (config['mix_normalization_factor'], config['mix_target_peak'], sample_rate)
+    start = time.perf_counter()
+    reference_mixes = [normalize_and_mix_per_stem(stems, *mix_args) for stems in pieces]
+    per_stem_time = (time.perf_counter() - start) / len(pieces)
+    start = time.perf_counter()
+    mixes = [normalize_and_mix(stems, *mix_args) for stems in pieces]
+    batched_time = (time.perf_counter() - start) / len(pieces)
+
+    max_error = max(np.max(np.abs(mix[1] - reference[1])) for mix, reference in zip(mixes, reference_mixes))
+    print(f'per-stem: {per_stem_time * 1000:.1f} ms/piece')
+    print(f'batched:  {batched_time * 1000:.1f} ms/piece')
+    print(f'speedup:  {per_stem_time / batched_time:.1f}x')
+    print(f'max abs difference of the mixture: {max_error:.2e}')
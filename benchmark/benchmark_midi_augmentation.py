@@ -0,0 +1,66 @@
+"""
+Benchmark the expressive timing and monophony pass of the MIDI augmentation
+against the original implementation sampling one truncated normal per note.
+"""
+
+import os
+import sys
+import copy
+import time
+import glob
+import argparse
+from scipy.stats import truncnorm
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from utils.file_utils import get_config
+from midi_augmentation import assign_expressive_performance, load_midi_with_tempo
+
+
+def assign_expressive_performance_per_note(midi, config):
+    """The original implementation, kept as the reference for the benchmark."""
+    for inst in midi.instruments:
+        for note in inst.notes:
+            clip_a = -config['expressive_timing_range_ms']
+            clip_b = config['expressive_timing_range_ms']
+            mean = config['expressive_timing_mean_ms']
+            std = config['expressive_timing_std_ms']
+            a, b = (clip_a - mean) / std, (clip_b - mean) / std
+            timing_offset = truncnorm(a, b).rvs() * std
+            timing_offset /= 1000
+            note.start += timing_offset
+            note.end += timing_offset
+        all_notes = inst.notes
+        for i in range(len(all_notes) - 1):
+            if all_notes[i].end > all_notes[i + 1].start:
+                all_notes[i].end = all_notes[i + 1].start
+    return midi
+
+
+def time_per_piece(func, midis, config, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for midi in midis:
+            func(copy.deepcopy(midi), config)
+    return (time.perf_counter() - start) / (repeat * len(midis))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark expressive timing')
+    parser.add_argument('--midi_dir', type=str, default=None, metavar='N',
+                        help='the directory containing the MIDI files to benchmark on.')
+    parser.add_argument('--num_files', type=int, default=20, metavar='N',
+                        help='the number of MIDI files to benchmark on.')
+    parser.add_argument('--repeat', type=int, default=3, metavar='N',
+                        help='the number of times to repeat the benchmark.')
+    args = parser.parse_args()
+
+    config = get_config()
+    midi_files = sorted(glob.glob(f'{args.midi_dir}/*.mid'))[:args.num_files]
+    midis = [load_midi_with_tempo(f, 100) for f in midi_files]
+
+    copy_time = time_per_piece(lambda midi, config: midi, midis, config, args.repeat)
+    per_note_time = time_per_piece(assign_expressive_performance_per_note, midis, config, args.repeat) - copy_time
+    vectorized_time = time_per_piece(assign_expressive_performance, midis, config, args.repeat) - copy_time
+    print(f'per-note:   {per_note_time * 1000:.3f} ms/piece')
+    print(f'vectorized: {vectorized_time * 1000:.3f} ms/piece')
+    print(f'speedup:    {per_note_time / vectorized_time:.1f}x')
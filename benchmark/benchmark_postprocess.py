@@ -0,0 +1,129 @@
+"""
+Benchmark data_postprocess/postprocess_cocochorales.py on synthetic pieces (see benchmark/synthetic_fixtures.py) with
+one worker and with --num_workers workers, checking that both produce exactly the same output tree as the original
+serial implementation, the script of --original_commit run with its own utils. Pass the commit (or tag) before the
+post-processing was parallelized, which depends on the clone.
+Both the original and the current post-processing read the instrument names from MIDI-DDSP, which must be installed.
+Exits with an error if the trees differ.
+"""
+
+import os
+import sys
+import time
+import shutil
+import filecmp
+import tarfile
+import argparse
+import importlib.util
+import tempfile
+import subprocess
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from synthetic_fixtures import make_dataset
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+SCRIPT = os.path.join('data_postprocess', 'postprocess_cocochorales.py')
+
+
+def checkout_original(commit, checkout_dir):
+    """Extract the post-processing script of commit, with the utils it imports, to checkout_dir.
+    Returns the path of the script."""
+    archive_path = os.path.join(checkout_dir, 'original.tar')
+    archive = subprocess.run(['git', '-C', ROOT_DIR, 'archive', '--output', archive_path, commit, 'data_postprocess',
+                              'utils'], stderr=subprocess.PIPE)
+    if archive.returncode != 0:
+        raise RuntimeError(f'Cannot extract the original implementation from {commit}: {archive.stderr.decode()}')
+    with tarfile.open(archive_path, 'r') as tar:
+        tar.extractall(checkout_dir, filter='data')
+        tar.close()
+    return os.path.join(checkout_dir, SCRIPT)
+
+
+def run_postprocess(fixture_dir, work_dir, script, options=()):
+    """Postprocess a copy of the fixtures (the wavs are moved) with script and the command line options.
+    Returns the output directory and the seconds taken. Raises a RuntimeError with the errors of the script if it
+    fails."""
+    shutil.copytree(fixture_dir, work_dir)
+    output_dir = os.path.join(work_dir, 'output')
+    command = [sys.executable, script,
+               '--midi_dir', os.path.join(work_dir, 'midi'),
+               '--synthesis_dir', os.path.join(work_dir, 'synth'),
+               '--output_dir', output_dir,
+               *options]
+    start = time.perf_counter()
+    process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        errors = process.stderr.decode(errors='replace')
+        raise RuntimeError(f'{script} exited with code {process.returncode}:\n{errors[-4000:]}')
+    return output_dir, time.perf_counter() - start
+
+
+def diff_trees(dir_a, dir_b, relative_dir=''):
+    """The relative paths of the files and directories differing between two trees, compared byte by byte."""
+    # nothing is ignored, the bookkeeping of the run is kept out of the dataset
+    comparison = filecmp.dircmp(dir_a, dir_b, ignore=[])
+    differences = [os.path.join(relative_dir, name) for name in comparison.left_only + comparison.right_only +
+                   comparison.common_funny]
+    _, mismatch, errors = filecmp.cmpfiles(dir_a, dir_b, comparison.common_files, shallow=False)
+    differences += [os.path.join(relative_dir, name) for name in mismatch + errors]
+    for name in comparison.common_dirs:
+        differences += diff_trees(os.path.join(dir_a, name), os.path.join(dir_b, name),
+                                  os.path.join(relative_dir, name))
+    return differences
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark postprocessing')
+    parser.add_argument('--num_pieces', type=int, default=10, metavar='N',
+                        help='the number of synthetic pieces of each ensemble.')
+    parser.add_argument('--duration', type=float, default=30, metavar='N',
+                        help='the duration of the synthetic pieces, in seconds.')
+    parser.add_argument('--num_workers', type=int, default=4, metavar='N',
+                        help='the number of worker processes of the parallel run.')
+    parser.add_argument('--max_io_workers', type=int, default=None, metavar='N',
+                        help='the number of workers moving and writing files at the same time in the parallel run.')
+    parser.add_argument('--original_commit', type=str, required=True, metavar='N',
+                        help='the commit or tag of the original serial implementation the output is compared to, '
+                             'before the post-processing was parallelized.')
+    args = parser.parse_args()
+    if importlib.util.find_spec('midi_ddsp') is None:
+        sys.exit('The post-processing reads the instrument names from MIDI-DDSP, install midi_ddsp to run the '
+                 'benchmark.')
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        fixture_dir = os.path.join(tmp_dir, 'fixtures')
+        pieces = make_dataset(fixture_dir, args.num_pieces, args.duration)
+        checkout_dir = os.path.join(tmp_dir, 'original_checkout')
+        os.makedirs(checkout_dir)
+        original_script = checkout_original(args.original_commit, checkout_dir)
+        original_dir, original_time = run_postprocess(fixture_dir, os.path.join(tmp_dir, 'original'),
+                                                      original_script)
+
+        script = os.path.join(ROOT_DIR, SCRIPT)
+        serial_dir, serial_time = run_postprocess(fixture_dir, os.path.join(tmp_dir, 'serial'), script,
+                                                  ['--num_workers', '1', '--no_profile'])
+        parallel_options = ['--num_workers', str(args.num_workers), '--no_profile']
+        if args.max_io_workers:
+            parallel_options += ['--max_io_workers', str(args.max_io_workers)]
+        parallel_dir, parallel_time = run_postprocess(fixture_dir, os.path.join(tmp_dir, 'parallel'), script,
+                                                      parallel_options)
+        differences = {'serial': diff_trees(original_dir, serial_dir),
+                       'parallel': diff_trees(original_dir, parallel_dir)}
+    except RuntimeError as e:
+        sys.exit(str(e))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    print(f'{len(pieces)} pieces: original {original_time:.1f}s, 1 worker {serial_time:.1f}s, '
+          f'{args.num_workers} workers {parallel_time:.1f}s ({original_time / parallel_time:.1f}x)')
+    failed = False
+    for run, run_differences in differences.items():
+        if run_differences:
+            failed = True
+            print(f'{len(run_differences)} files differ between the original ({args.original_commit}) and {run} '
+                  f'output, e.g.:')
+            print('\n'.join(run_differences[:10]))
+    if failed:
+        sys.exit(1)
+    print(f'The serial and parallel output trees are identical to the original ({args.original_commit}) output.')
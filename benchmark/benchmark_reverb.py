@@ -0,0 +1,57 @@
+"""
+Benchmark the batched reverb of the impulse response bank against the original
+implementation loading the IR and building a ddsp.effects.Reverb for every stem.
+"""
+
+import os
+import sys
+import time
+import glob
+import argparse
+import numpy as np
+import librosa
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from utils.file_utils import get_config
+from audio_augmentation import IR_DIR, REVERB_TYPES, get_ir_bank
+
+
+def add_reverb_per_stem(wav, reverb_type, sample_rate):
+    """The original implementation, kept as the reference for the benchmark."""
+    import ddsp
+    reverb_ir, _ = librosa.load(os.path.join(IR_DIR, REVERB_TYPES[reverb_type]), sr=sample_rate, mono=True)
+    reverb = ddsp.effects.Reverb(trainable=False, reverb_length=len(reverb_ir))
+    return reverb(wav[np.newaxis], reverb_ir)[0].numpy()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark reverb')
+    parser.add_argument('--multi_synthesis_dir', type=str, default=None, metavar='N',
+                        help='the directory containing multiple folders generated by MIDI-DDSP synthesis.')
+    parser.add_argument('--num_pieces', type=int, default=10, metavar='N',
+                        help='the number of pieces to benchmark on.')
+    args = parser.parse_args()
+
+    config = get_config()
+    sample_rate = config['sample_rate']
+    pieces = []
+    for synth_dir in sorted(glob.glob(f'{args.multi_synthesis_dir}/*/'))[:args.num_pieces]:
+        stem_wav_files = sorted(f for f in glob.glob(f'{synth_dir}/*.wav') if 'mix.wav' not in f)
+        pieces.append([librosa.load(f, sr=sample_rate, mono=True)[0] for f in stem_wav_files])
+    reverb_types = list(REVERB_TYPES)
+
+    start = time.perf_counter()
+    reference = [[add_reverb_per_stem(w, reverb_types[i % 3], sample_rate) for w in wavs]
+                 for i, wavs in enumerate(pieces)]
+    per_stem_time = (time.perf_counter() - start) / len(pieces)
+
+    start = time.perf_counter()
+    ir_bank = get_ir_bank(sample_rate)
+    batched = [ir_bank.apply(wavs, reverb_types[i % 3]) for i, wavs in enumerate(pieces)]
+    batched_time = (time.perf_counter() - start) / len(pieces)
+
+    max_error = max(np.max(np.abs(r - b)) for rs, bs in zip(reference, batched) for r, b in zip(rs, bs))
+    print(f'per-stem: {per_stem_time * 1000:.1f} ms/piece')
+    print(f'batched:  {batched_time * 1000:.1f} ms/piece (including loading the IRs)')
+    print(f'speedup:  {per_stem_time / batched_time:.1f}x')
+    print(f'max abs difference: {max_error:.2e}')
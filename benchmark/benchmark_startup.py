@@ -0,0 +1,55 @@
+"""
+Benchmark the start-up time of the entry points (running them with --help),
+and optionally the time to load the pre-trained MIDI-DDSP model.
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(ROOT_DIR)
+from utils.model_utils import get_pretrained_model
+
+ENTRY_POINTS = [
+    'midi_augmentation.py',
+    'expression_augmentation.py',
+    'synth_params_augmentation.py',
+    'audio_augmentation.py',
+    'audio_mixing.py',
+    'augmentation_pipeline.py',
+    'data_postprocess/postprocess_cocochorales.py',
+    'data_postprocess/postprocess_and_unchunk_cocochorales.py',
+]
+
+
+def time_command(command, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=ROOT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark start-up time')
+    parser.add_argument('--repeat', type=int, default=5, metavar='N',
+                        help='the number of times to run each entry point.')
+    parser.add_argument('--model', action='store_true',
+                        help='also time loading the pre-trained MIDI-DDSP model.')
+    args = parser.parse_args()
+
+    for entry_point in ENTRY_POINTS:
+        print(f'{entry_point:60s} {time_command([sys.executable, entry_point, "--help"], args.repeat):.2f} s')
+
+    if args.model:
+        start = time.perf_counter()
+        get_pretrained_model()
+        print(f'{"load pre-trained model (first call)":60s} {time.perf_counter() - start:.2f} s')
+        start = time.perf_counter()
+        get_pretrained_model()
+        print(f'{"load pre-trained model (cached)":60s} {time.perf_counter() - start:.2f} s')
@@ -0,0 +1,296 @@
+"""
+Benchmark every stage of the pipeline on synthetic pieces (see benchmark/synthetic_fixtures.py), in one process and
+with a pool of --num_workers processes, and compare the results against a stored baseline.
+
+The stages using MIDI-DDSP synthesis run with a stub synthesizer (synthetic_fixtures.stub_synthesize) instead of the
+model, so the suite runs offline on CPU and measures everything around the synthesis. Stages whose dependencies are
+not installed are skipped.
+
+    python benchmark/benchmark_suite.py --output benchmark/baselines/<machine>.json
+    python benchmark/benchmark_suite.py --compare benchmark/baselines/<machine>.json
+
+The parallel times include starting the pool, as when running the stage scripts.
+With --compare, exits with an error if a stage is more than --max_slowdown slower than in the baseline, fails, or
+is timed in the baseline but not in this run (e.g. its dependencies are not installed anymore).
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import functools
+import importlib.util
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from utils.file_utils import get_config
+from utils.parallel_utils import run_parallel
+from utils.random_utils import get_rng
+from synthetic_fixtures import make_dataset, stub_synthesize, conditioning_df_to_synthesis_parameters
+
+RESULTS_VERSION = 1
+
+
+def bench_midi_augmentation(piece, output_dir, config, seed):
+    from midi_augmentation import midi_augmentation
+    os.makedirs(os.path.join(output_dir, piece['ensemble']), exist_ok=True)
+    midi_augmentation(piece['midi_path'], piece['ensemble'], os.path.join(output_dir, piece['ensemble']), config,
+                      get_rng(seed, 'midi_augmentation', piece['midi_path']))
+
+
+def bench_copy_and_separate_midi(piece, output_dir, config, seed):
+    from data_postprocess.postprocess_utils import copy_and_separate_midi
+    save_dir = os.path.join(output_dir, piece['ensemble'], piece['piece'])
+    os.makedirs(save_dir, exist_ok=True)
+    copy_and_separate_midi(piece['midi_path'], save_dir)
+
+
+def bench_split_metadata(piece, output_dir, config, seed):
+    from data_postprocess.postprocess_utils import split_metadata
+    split_metadata(piece['midi_path'], piece['synth_dir'], piece['ensemble'])
+
+
+def bench_audio_normalization(piece, output_dir, config, seed):
+    from audio_mixing import audio_normalization
+    audio_normalization(piece['synth_dir'], os.path.join(output_dir, piece['ensemble']),
+                        config['mix_normalization_factor'], config['mix_target_peak'], config['sample_rate'])
+
+
+def bench_add_reverb(piece, output_dir, config, seed):
+    from audio_augmentation import add_reverb, get_ir_bank
+    from utils.audio_utils import read_wav
+    reverb_type = sorted(get_ir_bank(config['sample_rate']).reverb_types)[0]
+    stem_files = sorted(f for f in os.listdir(piece['synth_dir']) if f.endswith('.wav') and f != 'mix.wav')
+    for stem_file in stem_files:
+        wav = read_wav(os.path.join(piece['synth_dir'], stem_file), config['sample_rate'])[0]
+        add_reverb(wav, reverb_type, config['sample_rate'])
+
+
+def bench_audio_augmentation(piece, output_dir, config, seed):
+    from audio_augmentation import audio_augmentation
+    audio_augmentation(piece['synth_dir'], os.path.join(output_dir, piece['ensemble']), config['sample_rate'],
+                       seed=seed)
+
+
+def bench_intonation_augmentation(piece, output_dir, config, seed):
+    from synth_params_augmentation import load_and_augment_synth_params
+    load_and_augment_synth_params(piece['synth_dir'], config, seed)
+
+
+def bench_expression_augmentation(piece, output_dir, config, seed):
+    from expression_augmentation import expression_augmentation
+    install_stub_synthesizer()
+    expression_augmentation(piece['synth_dir'], os.path.join(output_dir, piece['ensemble']), config, seed)
+
+
+def bench_synth_params_augmentation(piece, output_dir, config, seed):
+    from synth_params_augmentation import synth_params_augmentation
+    install_stub_synthesizer()
+    synth_params_augmentation(piece['synth_dir'], os.path.join(output_dir, piece['ensemble']), config, seed)
+
+
+# {stage: (function benchmarking a piece, the modules it needs)}
+STAGES = {
+    'midi_augmentation': (bench_midi_augmentation, ['pretty_midi', 'mido', 'midi_ddsp']),
+    'copy_and_separate_midi': (bench_copy_and_separate_midi, ['pretty_midi', 'midi_ddsp']),
+    'split_metadata': (bench_split_metadata, ['pretty_midi', 'pandas', 'midi_ddsp']),
+    'audio_normalization': (bench_audio_normalization, ['scipy', 'soundfile']),
+    'add_reverb': (bench_add_reverb, ['scipy', 'librosa']),
+    'audio_augmentation': (bench_audio_augmentation, ['scipy', 'librosa', 'soundfile', 'midi_ddsp']),
+    'intonation_augmentation': (bench_intonation_augmentation, ['tensorflow', 'ddsp', 'midi_ddsp']),
+    'expression_augmentation': (bench_expression_augmentation, ['tensorflow', 'soundfile', 'midi_ddsp']),
+    'synth_params_augmentation': (bench_synth_params_augmentation, ['tensorflow', 'ddsp', 'soundfile', 'midi_ddsp']),
+}
+# the stages using TensorFlow, run in spawned workers as by the stage scripts
+SPAWN_STAGES = ['intonation_augmentation', 'expression_augmentation', 'synth_params_augmentation']
+
+
+def _stub_synthesis_generator():
+    return None
+
+
+def stub_conditioning_df_to_audio(synthesis_generator, conditioning_df_all, instrument_id_all,
+                                  display_progressbar=True):
+    """Stands in for expression_augmentation.conditioning_df_to_audio, without the MIDI-DDSP model."""
+    import tensorflow as tf
+    synthesis_parameters = conditioning_df_to_synthesis_parameters(conditioning_df_all, np.random.default_rng(0))
+    audio = stub_synthesize(synthesis_parameters, get_config()['sample_rate'])
+    return tf.convert_to_tensor(audio), {k: tf.convert_to_tensor(v) for k, v in synthesis_parameters.items()}
+
+
+def stub_synth_params_to_audio(synthesis_generator, synthesis_parameters, instrument_id):
+    """Stands in for synth_params_augmentation.synth_params_to_audio, without the DDSP processors and the model."""
+    import tensorflow as tf
+    audio = stub_synthesize({k: np.asarray(v) for k, v in synthesis_parameters.items()}, get_config()['sample_rate'])
+    return tf.convert_to_tensor(audio)
+
+
+def install_stub_synthesizer():
+    """Replace the MIDI-DDSP synthesis of expression_augmentation.py and synth_params_augmentation.py by the stub
+    synthesizer, in the current process."""
+    import expression_augmentation
+    import synth_params_augmentation
+    expression_augmentation.get_synthesis_generator = _stub_synthesis_generator
+    expression_augmentation.conditioning_df_to_audio = stub_conditioning_df_to_audio
+    synth_params_augmentation.get_synthesis_generator = _stub_synthesis_generator
+    synth_params_augmentation.synth_params_to_audio = stub_synth_params_to_audio
+
+
+def run_stage(stage, output_dir, config, seed, piece):
+    STAGES[stage][0](piece, output_dir, config, seed)
+
+
+def missing_modules(stage):
+    return [module for module in STAGES[stage][1] if importlib.util.find_spec(module) is None]
+
+
+def time_stage(stage, pieces, config, work_dir, num_workers, repeats, seed):
+    """The seconds per piece of a stage in one process and, if num_workers > 1, in a pool of num_workers processes.
+    Each is the fastest of repeats runs, after a first piece processed to warm up (imports, caches).
+    The augmentations are drawn from seed, so every run processes the pieces with the same augmentations."""
+    run_stage(stage, os.path.join(work_dir, 'warmup'), config, seed, pieces[0])
+    result = {}
+    serial_times, parallel_times = [], []
+    for repeat in range(repeats):
+        output_dir = os.path.join(work_dir, f'serial_{repeat}')
+        start = time.perf_counter()
+        for piece in pieces:
+            run_stage(stage, output_dir, config, seed, piece)
+        serial_times.append((time.perf_counter() - start) / len(pieces))
+        if num_workers > 1:
+            output_dir = os.path.join(work_dir, f'parallel_{repeat}')
+            start = time.perf_counter()
+            failures = run_parallel(functools.partial(run_stage, stage, output_dir, config, seed), pieces,
+                                    num_workers=num_workers,
+                                    start_method='spawn' if stage in SPAWN_STAGES else None,
+                                    desc=stage)
+            if failures:
+                raise RuntimeError(f'{len(failures)} pieces failed in parallel:\n{failures[0][1]}')
+            parallel_times.append((time.perf_counter() - start) / len(pieces))
+    result['serial'] = min(serial_times)
+    if parallel_times:
+        result['parallel'] = min(parallel_times)
+        result['speedup'] = result['serial'] / result['parallel']
+    return result
+
+
+def compare_results(results, baseline, max_slowdown, stages=None):
+    """Print the change of every stage against the baseline. Returns the list of (stage, mode) slower than
+    max_slowdown, and of the (stage, mode) timed in the baseline that failed or were not timed in results.
+    Only the stages in stages (default to all the stages of the baseline and results) are compared."""
+    if results['settings'] != baseline['settings']:
+        print(f'Warning: the baseline was run with different settings: {baseline["settings"]}')
+    if stages is None:
+        stages = list(dict.fromkeys(list(baseline['stages']) + list(results['stages'])))
+    regressions = []
+    print(f'{"stage":<28}{"mode":<10}{"baseline ms":>13}{"current ms":>13}{"change":>9}')
+    for stage in stages:
+        result = results['stages'].get(stage, {})
+        baseline_result = baseline['stages'].get(stage, {})
+        if 'error' in result:
+            regressions.append((stage, 'error'))
+            print(f'{stage:<28}{"error":<10}  REGRESSION: {result["error"]}')
+            continue
+        for mode in ['serial', 'parallel']:
+            if mode not in baseline_result:
+                continue
+            if mode not in result:
+                regressions.append((stage, mode))
+                reason = result.get('skipped', 'not run')
+                print(f'{stage:<28}{mode:<10}{baseline_result[mode] * 1000:>13.1f}{"-":>13}{"-":>9}'
+                      f'  REGRESSION: {reason}')
+                continue
+            change = result[mode] / baseline_result[mode] - 1
+            regressed = change > max_slowdown
+            if regressed:
+                regressions.append((stage, mode))
+            print(f'{stage:<28}{mode:<10}{baseline_result[mode] * 1000:>13.1f}{result[mode] * 1000:>13.1f}'
+                  f'{100 * change:>+8.1f}%{"  REGRESSION" if regressed else ""}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark suite')
+    parser.add_argument('--stages', type=str, nargs='+', default=list(STAGES), choices=list(STAGES), metavar='N',
+                        help=f'the stages to benchmark, among {", ".join(STAGES)}. Default to all.')
+    parser.add_argument('--num_pieces', type=int, default=2, metavar='N',
+                        help='the number of synthetic pieces of each ensemble.')
+    parser.add_argument('--duration', type=float, default=30, metavar='N',
+                        help='the duration of the synthetic pieces, in seconds.')
+    parser.add_argument('--num_workers', type=int, default=4, metavar='N',
+                        help='the number of worker processes of the parallel runs. 1 only runs in one process.')
+    parser.add_argument('--repeats', type=int, default=3, metavar='N',
+                        help='the number of times each stage is run, the fastest run is kept.')
+    parser.add_argument('--seed', type=int, default=0, metavar='N',
+                        help='the random seed of the synthetic pieces and of their augmentations.')
+    parser.add_argument('--fixture_dir', type=str, default=None, metavar='N',
+                        help='the directory for the synthetic pieces, kept after the run. '
+                             'If not provided, use a temporary directory.')
+    parser.add_argument('--output', type=str, default=None, metavar='N',
+                        help='save the results as JSON to this path, e.g. as a baseline.')
+    parser.add_argument('--compare', type=str, default=None, metavar='N',
+                        help='the JSON results of a previous run to compare against.')
+    parser.add_argument('--max_slowdown', type=float, default=0.2, metavar='N',
+                        help='the largest accepted slowdown compared to --compare, as a fraction.')
+    args = parser.parse_args()
+
+    config = get_config()
+    tmp_dir = tempfile.mkdtemp()
+    fixture_dir = args.fixture_dir or os.path.join(tmp_dir, 'fixtures')
+    pieces = make_dataset(fixture_dir, args.num_pieces, args.duration, seed=args.seed)
+
+    results = {
+        'version': RESULTS_VERSION,
+        'time': time.time(),
+        'host': socket.gethostname(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'cpu_count': os.cpu_count(),
+        'settings': {'num_pieces': len(pieces), 'duration': args.duration, 'num_workers': args.num_workers,
+                     'seed': args.seed},
+        'stages': {},
+    }
+    try:
+        for stage in args.stages:
+            missing = missing_modules(stage)
+            if missing:
+                results['stages'][stage] = {'skipped': f'missing {", ".join(missing)}'}
+            else:
+                try:
+                    results['stages'][stage] = time_stage(stage, pieces, config, os.path.join(tmp_dir, stage),
+                                                          args.num_workers, args.repeats, args.seed)
+                except Exception as e:
+                    results['stages'][stage] = {'error': f'{type(e).__name__}: {e}'}
+                shutil.rmtree(os.path.join(tmp_dir, stage), ignore_errors=True)
+
+            result = results['stages'][stage]
+            if 'serial' in result:
+                line = f'{stage:<28}{result["serial"] * 1000:>10.1f} ms/piece'
+                if 'parallel' in result:
+                    line += f', {args.num_workers} workers {result["parallel"] * 1000:.1f} ms/piece ' \
+                            f'({result["speedup"]:.1f}x)'
+            else:
+                line = f'{stage:<28}{result.get("skipped") or result.get("error")}'
+            print(line)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.close()
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+            f.close()
+        regressions = compare_results(results, baseline, args.max_slowdown, args.stages)
+        if regressions:
+            sys.exit(f'{len(regressions)} stages failed, were not timed, or are more than '
+                     f'{100 * args.max_slowdown:.0f}% slower than the baseline.')
@@ -0,0 +1,187 @@
+"""
+Synthetic pieces in the layout of the pipeline, for benchmarking the stages without the Coconet MIDI files or the
+MIDI-DDSP model:
+
+<output_dir>/midi/<ensemble>/<piece>.mid              four-part (SATB) MIDI files, with the instruments assigned
+<output_dir>/midi/split/<ensemble>_split.json         the train / valid / test split of the pieces
+<output_dir>/synth/<ensemble>/<piece>/                the output of MIDI-DDSP synthesis for each piece:
+    <part>_<instrument>.wav, mix.wav                  stems and mixture, synthesized by stub_synthesize
+    metadata.pickle                                   instrument ids, note expressions and synthesis parameters
+
+stub_synthesize is a harmonic synthesizer of the synthesis parameters in numpy, standing in for the DDSP processors
+and the MIDI-DDSP model so that the benchmarks run offline on CPU. Its audio is not meant to sound like MIDI-DDSP.
+"""
+
+import os
+import sys
+import argparse
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from utils.file_utils import get_config, pickle_dump, json_dump
+from utils.instrument_utils import AVAILABLE_ENSEMBLES, FOUR_BACH_PARTS, get_instrument_by_part
+
+FRAME_RATE = 250
+HOP_SIZE = 64
+NOTE_EXPRESSION_COLUMNS = ['volume', 'vol_fluc', 'vibrato', 'brightness', 'attack', 'vol_peak_pos', 'pitch', 'onset',
+                           'offset', 'note_length']
+# the MIDI pitch range of each part
+PART_RANGES = {'Soprano': (60, 81), 'Alto': (55, 74), 'Tenor': (48, 69), 'Bass': (40, 62)}
+NUM_HARMONICS = 60
+NUM_NOISE_BANDS = 65
+# the instruments of MIDI-DDSP as (name, MIDI program), in the order of their instrument ids, so that the fixtures can
+# be written without midi_ddsp installed.
+INSTRUMENTS = [('violin', 40), ('viola', 41), ('cello', 42), ('double bass', 43), ('flute', 73), ('oboe', 68),
+               ('clarinet', 71), ('saxophone', 65), ('bassoon', 70), ('trumpet', 56), ('horn', 60), ('trombone', 57),
+               ('tuba', 58), ('guitar', 24)]
+INST_NAME_TO_ID = {name: i for i, (name, _) in enumerate(INSTRUMENTS)}
+INST_NAME_TO_MIDI_PROGRAM = dict(INSTRUMENTS)
+
+
+def random_satb_notes(duration, tempo, rng):
+    """Random monophonic notes of the four parts, as a list of [(start, end, pitch)] in seconds.
+    Notes last a half, one or two beats, and are sometimes followed by a rest."""
+    beat = 60 / tempo
+    parts = []
+    for part in FOUR_BACH_PARTS:
+        low, high = PART_RANGES[part]
+        notes, time, pitch = [], 0.0, int(rng.integers(low, high + 1))
+        while True:
+            length = beat * rng.choice([0.5, 1, 2], p=[0.3, 0.5, 0.2])
+            if time + length > duration:
+                break
+            notes.append((time, time + length, pitch))
+            time += length + (beat * 0.5 if rng.random() < 0.1 else 0)
+            pitch = int(np.clip(pitch + rng.integers(-4, 5), low, high))
+        parts.append(notes)
+    return parts
+
+
+def write_satb_midi(path, parts, tempo, programs):
+    """Write the notes of the four parts as a MIDI file with one track per part, as the output of
+    midi_augmentation.py. midi_augmentation.py reassigns the programs, so the files are also valid input."""
+    import pretty_midi
+    midi = pretty_midi.PrettyMIDI(initial_tempo=tempo)
+    for notes, program in zip(parts, programs):
+        instrument = pretty_midi.Instrument(program=program)
+        instrument.notes = [pretty_midi.Note(velocity=100, pitch=pitch, start=start, end=end)
+                            for start, end, pitch in notes]
+        midi.instruments.append(instrument)
+    midi.write(path)
+
+
+def notes_to_conditioning_df(notes, rng):
+    """The note expressions of a part as MIDI-DDSP predicts them, one row per note and per rest (with pitch 0),
+    with the onsets and offsets in frames."""
+    import pandas as pd
+    rows, frame = [], 0
+    for start, end, pitch in notes:
+        onset, offset = int(round(start * FRAME_RATE)), int(round(end * FRAME_RATE)) - 1
+        if onset > frame:
+            rows.append([0.0] * 6 + [0, frame, onset - 1, onset - frame])
+        rows.append(list(rng.uniform(0, 1, 6)) + [pitch, onset, offset, offset - onset + 1])
+        frame = offset + 1
+    conditioning_df = pd.DataFrame(rows, columns=NOTE_EXPRESSION_COLUMNS)
+    conditioning_df[['pitch', 'onset', 'offset', 'note_length']] = \
+        conditioning_df[['pitch', 'onset', 'offset', 'note_length']].astype(np.int64)
+    return conditioning_df
+
+
+def conditioning_df_to_synthesis_parameters(conditioning_df_all, rng):
+    """Synthesis parameters following the notes of each part, as {name: [parts, frames, channels]} padded with zeros
+    to the length of the longest part as MIDI-DDSP outputs them."""
+    num_frames = max(int(df['offset'].iloc[-1]) + 1 for df in conditioning_df_all)
+    num_parts = len(conditioning_df_all)
+    f0_hz = np.zeros((num_parts, num_frames, 1), dtype=np.float32)
+    amplitudes = np.zeros((num_parts, num_frames, 1), dtype=np.float32)
+    for i, conditioning_df in enumerate(conditioning_df_all):
+        for pitch, onset, offset, volume in conditioning_df[['pitch', 'onset', 'offset', 'volume']].to_numpy():
+            if pitch == 0:
+                continue
+            onset, offset = int(onset), int(offset) + 1
+            # a detuned, slightly vibrating pitch, so that the intonation augmentation has something to correct.
+            vibrato = 0.3 * np.sin(2 * np.pi * 5 * np.arange(offset - onset) / FRAME_RATE)
+            f0_hz[i, onset:offset, 0] = 440 * 2 ** ((pitch - 69 + rng.normal(0, 0.1) + vibrato) / 12)
+            amplitudes[i, onset:offset, 0] = 0.1 + 0.2 * volume
+    harmonic_distribution = rng.uniform(0, 1, (num_parts, num_frames, NUM_HARMONICS)).astype(np.float32)
+    harmonic_distribution /= np.arange(1, NUM_HARMONICS + 1, dtype=np.float32) ** 2
+    harmonic_distribution /= harmonic_distribution.sum(axis=-1, keepdims=True)
+    noise_magnitudes = rng.uniform(0, 1e-3, (num_parts, num_frames, NUM_NOISE_BANDS)).astype(np.float32)
+    return {'f0_hz': f0_hz, 'amplitudes': amplitudes, 'harmonic_distribution': harmonic_distribution,
+            'noise_magnitudes': noise_magnitudes}
+
+
+def stub_synthesize(synthesis_parameters, sample_rate, num_harmonics=8):
+    """Synthesize the first num_harmonics harmonics of the synthesis parameters {name: [parts, frames, channels]}.
+    Returns the audio [parts, frames * HOP_SIZE] as float32."""
+    f0_hz = np.repeat(np.asarray(synthesis_parameters['f0_hz'], dtype=np.float64)[..., 0], HOP_SIZE, axis=1)
+    amplitudes = np.repeat(np.asarray(synthesis_parameters['amplitudes'], dtype=np.float64)[..., 0], HOP_SIZE, axis=1)
+    harmonic_distribution = np.asarray(synthesis_parameters['harmonic_distribution'])[..., :num_harmonics]
+    phase = 2 * np.pi * np.cumsum(f0_hz / sample_rate, axis=1)
+    audio = np.zeros(f0_hz.shape, dtype=np.float64)
+    for k in range(num_harmonics):
+        harmonic_amplitude = np.repeat(harmonic_distribution[..., k], HOP_SIZE, axis=1)
+        harmonic_amplitude = np.where(f0_hz * (k + 1) < sample_rate / 2, harmonic_amplitude, 0)
+        audio += harmonic_amplitude * np.sin((k + 1) * phase)
+    return (audio * amplitudes).astype(np.float32)
+
+
+def make_piece(synth_dir, parts, instrument_ids, instrument_names, sample_rate, rng):
+    """Write the stems, mixture and metadata.pickle of a piece as MIDI-DDSP synthesis does."""
+    from utils.audio_utils import save_wav
+    os.makedirs(synth_dir, exist_ok=True)
+    conditioning_df_all = [notes_to_conditioning_df(notes, rng) for notes in parts]
+    synthesis_parameters = conditioning_df_to_synthesis_parameters(conditioning_df_all, rng)
+    audio = stub_synthesize(synthesis_parameters, sample_rate)
+    for i, instrument_name in enumerate(instrument_names):
+        save_wav(audio[i], os.path.join(synth_dir, f'{i}_{instrument_name}.wav'), sample_rate)
+    save_wav(np.sum(audio.astype(np.float64), axis=0), os.path.join(synth_dir, 'mix.wav'), sample_rate)
+    metadata = {
+        'instrument_id': {i: instrument_id for i, instrument_id in enumerate(instrument_ids)},
+        'note_expression_control': {i: conditioning_df for i, conditioning_df in enumerate(conditioning_df_all)},
+        'synthesis_parameters': {i: {k: v[i] for k, v in synthesis_parameters.items()} for i in range(len(parts))},
+    }
+    pickle_dump(metadata, os.path.join(synth_dir, 'metadata.pickle'))
+
+
+def make_dataset(output_dir, num_pieces, duration, seed=0, ensembles=AVAILABLE_ENSEMBLES, sample_rate=None):
+    """Write num_pieces pieces of about duration seconds for each ensemble.
+    Returns a list of {'ensemble', 'piece', 'midi_path', 'synth_dir'}, the same for the same seed."""
+    sample_rate = sample_rate or get_config()['sample_rate']
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(output_dir, 'midi', 'split'), exist_ok=True)
+    pieces = []
+    for ensemble in ensembles:
+        os.makedirs(os.path.join(output_dir, 'midi', ensemble), exist_ok=True)
+        split = {'train': [], 'valid': [], 'test': []}
+        for i in range(num_pieces):
+            piece = str(1000 + i)
+            tempo = int(rng.integers(60, 121))
+            parts = random_satb_notes(duration, tempo, rng)
+            instrument_names = [get_instrument_by_part(ensemble, part, rng) for part in FOUR_BACH_PARTS]
+            midi_path = os.path.join(output_dir, 'midi', ensemble, f'{piece}.mid')
+            write_satb_midi(midi_path, parts, tempo,
+                            [INST_NAME_TO_MIDI_PROGRAM[name] for name in instrument_names])
+            synth_dir = os.path.join(output_dir, 'synth', ensemble, piece)
+            make_piece(synth_dir, parts, [INST_NAME_TO_ID[name] for name in instrument_names], instrument_names,
+                       sample_rate, rng)
+            split['train' if i % 10 < 8 else 'valid' if i % 10 == 8 else 'test'].append(f'{piece}.mid')
+            pieces.append({'ensemble': ensemble, 'piece': piece, 'midi_path': midi_path, 'synth_dir': synth_dir})
+        json_dump(split, os.path.join(output_dir, 'midi', 'split', f'{ensemble}_split.json'))
+    return pieces
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Synthetic fixtures')
+    parser.add_argument('--output_dir', type=str, default=None, metavar='N',
+                        help='the directory for the synthetic MIDI files and synthesized pieces.')
+    parser.add_argument('--num_pieces', type=int, default=10, metavar='N',
+                        help='the number of pieces of each ensemble.')
+    parser.add_argument('--duration', type=float, default=30, metavar='N',
+                        help='the duration of the pieces, in seconds.')
+    parser.add_argument('--seed', type=int, default=0, metavar='N',
+                        help='the random seed.')
+    args = parser.parse_args()
+
+    pieces = make_dataset(args.output_dir, args.num_pieces, args.duration, seed=args.seed)
+    print(f'{len(pieces)} pieces written to {args.output_dir}')
@@ -1,7 +1,107 @@
+"""
+Extract the downloaded tar files, several at a time.
+
+Each tar file is read once, its md5 computed while it is piped to tar, and its content is extracted to a staging
+directory which is moved into place only if tar succeeded and the md5 matches cocochorales_md5s.txt.
+A marker is then written to <output_dir>/.extracted, so that an interrupted run can be restarted and skips the
+tar files already extracted.
+"""
+
 import os
-import glob
-from tqdm import tqdm
+import re
+import shutil
+import hashlib
+import tempfile
+import functools
+import subprocess
 import argparse
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from utils.parallel_utils import add_parallel_args, run_parallel
+from utils.shard_utils import DATA_TYPES, SPLITS, list_shards
+
+READ_SIZE = 1 << 20
+
+
+def shard_key(shard_path):
+    """The key of a tar file in the md5 list: <data_type>/<split>/<n>.tar.bz2"""
+    return '/'.join(os.path.normpath(shard_path).split(os.sep)[-3:])
+
+
+def load_md5s(md5_path):
+    """Load the md5 list, in the format of md5sum (<md5>  <path>) or BSD md5 (MD5 (<path>) = <md5>)."""
+    md5s = {}
+    with open(md5_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            bsd_match = re.match(r'^MD5 \((.+)\) = ([0-9a-fA-F]{32})$', line)
+            if bsd_match:
+                path, md5 = bsd_match.group(1), bsd_match.group(2)
+            elif re.match(r'^[0-9a-fA-F]{32}\s', line):
+                md5, path = line[:32], line[32:].strip().lstrip('*')
+            else:
+                continue
+            md5s[shard_key(path)] = md5.lower()
+        f.close()
+    return md5s
+
+
+def extract_tar(tar_file, output_dir, md5s=None):
+    """Extract a tar file to the same <data_type>/<split> directory under output_dir, verifying its md5."""
+    key = shard_key(tar_file)
+    marker_path = os.path.join(output_dir, '.extracted', key + '.done')
+    if os.path.exists(marker_path):
+        return
+    expected_md5 = None
+    if md5s is not None:
+        if key not in md5s:
+            raise ValueError(f'{key} is not in the md5 list.')
+        expected_md5 = md5s[key]
+
+    # extract to a staging directory first, so that a failed or corrupted tar file leaves nothing behind.
+    staging_dir = os.path.join(output_dir, '.extracting', key.replace('/', '_'))
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+    compress_prog = 'pbzip2' if shutil.which('pbzip2') is not None else 'bzip2'
+    md5 = hashlib.md5()
+    # the errors of tar go to a file rather than a pipe, which tar would fill while it is fed, e.g. on a corrupted tar
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(['tar', '-x', '-f', '-', f'--use-compress-prog={compress_prog}', '-C', staging_dir],
+                                   stdin=subprocess.PIPE, stderr=stderr)
+        try:
+            with open(tar_file, 'rb') as f:
+                for chunk in iter(functools.partial(f.read, READ_SIZE), b''):
+                    md5.update(chunk)
+                    process.stdin.write(chunk)
+                f.close()
+            process.stdin.close()
+        except BrokenPipeError:
+            pass  # tar exited early, reported below
+        return_code = process.wait()
+        stderr.seek(0)
+        errors = stderr.read().decode(errors='replace')
+        stderr.close()
+    if return_code != 0:
+        raise RuntimeError(f'tar failed on {tar_file} with exit code {return_code}: {errors}')
+    if expected_md5 is not None and md5.hexdigest() != expected_md5:
+        raise ValueError(f'md5 mismatch for {tar_file}: expected {expected_md5}, got {md5.hexdigest()}. '
+                         f'Download it again.')
+
+    target_dir = os.path.join(output_dir, os.path.dirname(key))
+    for name in os.listdir(staging_dir):
+        target_path = os.path.join(target_dir, name)
+        # a previous run may have been interrupted while moving
+        if os.path.isdir(target_path) and not os.path.islink(target_path):
+            shutil.rmtree(target_path)
+        os.replace(os.path.join(staging_dir, name), target_path)
+    os.rmdir(staging_dir)
+
+    os.makedirs(os.path.dirname(marker_path), exist_ok=True)
+    with open(marker_path, 'w') as f:
+        f.write(md5.hexdigest())
+        f.close()
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -9,18 +109,36 @@ if __name__ == '__main__':
                         help='the directory containing all the zip files downloaded from the GCS.')
     parser.add_argument('--output_dir', type=str, default=None, metavar='N',
                         help='the directory for outputting the extracted dataset.')
+    # you could only use 'main_dataset'
+    parser.add_argument('--data_types', type=str, nargs='+', default=DATA_TYPES, choices=DATA_TYPES,
+                        help='the data types to extract.')
+    parser.add_argument('--splits', type=str, nargs='+', default=SPLITS, choices=SPLITS,
+                        help='the splits to extract.')
+    parser.add_argument('--md5_file', type=str, default=None, metavar='N',
+                        help='the md5 list. Default to cocochorales_md5s.txt in data_dir.')
+    parser.add_argument('--no_verify', action='store_true',
+                        help='do not verify the md5 of the tar files.')
+    add_parallel_args(parser)
 
     args = parser.parse_args()
 
     data_dir = args.data_dir
     output_dir = args.output_dir
 
-    # you could only use 'main_dataset'
-    for data_type in ['f0', 'main_dataset', 'metadata', 'note_expression', 'synthesis_parameters']:
-        for split in ['train', 'test', 'valid']:
+    md5s = None
+    if not args.no_verify:
+        md5s = load_md5s(args.md5_file or os.path.join(data_dir, 'cocochorales_md5s.txt'))
+
+    tar_files = []
+    for data_type in args.data_types:
+        for split in args.splits:
             os.makedirs(os.path.join(output_dir, data_type, split), exist_ok=True)
-            tar_files = sorted(glob.glob(os.path.join(data_dir, data_type, split, '*.tar.bz2')),
-                               key=lambda x: int(os.path.basename(x).split('.')[0]))
-            for tar_file in tqdm(tar_files):
-                os.system(
-                    f'tar -xf {tar_file} --use-compress-prog=pbzip2 -C {os.path.join(output_dir, data_type, split)}')
+            tar_files += list_shards(data_dir, data_type, split)
+
+    failures = run_parallel(functools.partial(extract_tar, output_dir=output_dir, md5s=md5s),
+                            tar_files,
+                            num_workers=args.num_workers,
+                            chunksize=args.chunksize)
+    shutil.rmtree(os.path.join(output_dir, '.extracting'), ignore_errors=True)
+    if failures:
+        sys.exit(1)
@@ -0,0 +1,46 @@
+"""
+Rewrite the downloaded .tar.bz2 shards in the indexed format (see utils/shard_utils.py), for random access to single
+pieces and files. The shards stay valid .tar.bz2 files.
+"""
+
+import os
+import functools
+import argparse
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from utils.parallel_utils import add_parallel_args, run_parallel
+from utils.shard_utils import DATA_TYPES, SPLITS, SHARD_INDEX_EXTENSION, list_shards, convert_to_indexed_shard
+
+
+def index_shard(shard_path, data_dir, output_dir):
+    output_path = os.path.join(output_dir, os.path.relpath(shard_path, data_dir))
+    if os.path.exists(output_path + SHARD_INDEX_EXTENSION):
+        return  # already converted
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    convert_to_indexed_shard(shard_path, output_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index shards')
+    parser.add_argument('--data_dir', type=str, default=None, metavar='N',
+                        help='the directory containing all the tar files downloaded from the GCS.')
+    parser.add_argument('--output_dir', type=str, default=None, metavar='N',
+                        help='the directory for the indexed tar files. '
+                             'If not provided, convert the tar files in place.')
+    parser.add_argument('--data_types', type=str, nargs='+', default=DATA_TYPES, choices=DATA_TYPES,
+                        help='the data types to convert.')
+    add_parallel_args(parser)
+    args = parser.parse_args()
+
+    shard_paths = [shard_path
+                   for data_type in args.data_types
+                   for split in SPLITS
+                   for shard_path in list_shards(args.data_dir, data_type, split)]
+    failures = run_parallel(functools.partial(index_shard, data_dir=args.data_dir,
+                                              output_dir=args.output_dir or args.data_dir),
+                            shard_paths,
+                            num_workers=args.num_workers,
+                            chunksize=args.chunksize)
+    if failures:
+        sys.exit(1)
@@ -0,0 +1,74 @@
+"""
+Convert the synthesis parameters (or f0) saved as pickles to the columnar format that can be memory-mapped,
+optionally with a reduced precision encoding (see utils/synth_params_utils.py).
+"""
+
+import os
+import glob
+import functools
+import argparse
+import sys
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from utils.file_utils import pickle_load
+from utils.parallel_utils import add_parallel_args, run_parallel
+from utils.synth_params_utils import SYNTH_PARAMS_EXTENSION, ENCODINGS, save_synthesis_parameters, \
+    load_synthesis_parameters, encoding_error_bound
+
+
+def verify_synthesis_parameters(synthesis_parameters, save_path, encoding):
+    """Check that the saved file decodes to synthesis_parameters within the error bound of the encoding."""
+    loaded = load_synthesis_parameters(save_path)
+    parts = list(synthesis_parameters.keys())
+    for name in synthesis_parameters[parts[0]].keys():
+        # the quantization range covers all the parts, as they are stored in one array.
+        array = np.concatenate([synthesis_parameters[part][name] for part in parts], axis=0)
+        error = np.abs(np.concatenate([loaded[part][name] for part in parts], axis=0).astype(np.float64) - array)
+        if np.any(error > encoding_error_bound(array, encoding)):
+            raise ValueError(f'{save_path}: {name} exceeds the error bound of {encoding}, max error {error.max()}.')
+
+
+def convert_synthesis_parameters(pickle_path, input_dir, output_dir, remove_pickle=False, encoding='float32',
+                                 verify=False):
+    relative_path = os.path.relpath(pickle_path, input_dir).replace('.pickle', SYNTH_PARAMS_EXTENSION)
+    save_path = os.path.join(output_dir, relative_path)
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    synthesis_parameters = pickle_load(pickle_path)
+    # f0 pickles are {part: f0_hz}, store them as a single f0_hz parameter.
+    synthesis_parameters = {part: value if isinstance(value, dict) else {'f0_hz': value}
+                            for part, value in synthesis_parameters.items()}
+    save_synthesis_parameters(synthesis_parameters, save_path, encoding=encoding)
+    if verify:
+        verify_synthesis_parameters(synthesis_parameters, save_path, encoding)
+    if remove_pickle:
+        os.remove(pickle_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert synthesis parameters')
+    parser.add_argument('--synthesis_parameters_dir', type=str, default=None, metavar='N',
+                        help='the directory containing the synthesis parameters pickles, searched recursively.')
+    parser.add_argument('--output_dir', type=str, default=None, metavar='N',
+                        help='the directory for output. If not provided, save next to the pickles.')
+    parser.add_argument('--remove_pickle', action='store_true',
+                        help='remove each pickle after it is converted.')
+    parser.add_argument('--encoding', type=str, default='float32', choices=ENCODINGS,
+                        help='the encoding of the arrays. See utils/synth_params_utils.py for the error of each.')
+    parser.add_argument('--verify', action='store_true',
+                        help='check each converted file against the pickle before removing it.')
+    add_parallel_args(parser)
+    args = parser.parse_args()
+
+    pickle_list = sorted(glob.glob(os.path.join(args.synthesis_parameters_dir, '**', '*.pickle'), recursive=True))
+    failures = run_parallel(functools.partial(convert_synthesis_parameters,
+                                              input_dir=args.synthesis_parameters_dir,
+                                              output_dir=args.output_dir or args.synthesis_parameters_dir,
+                                              remove_pickle=args.remove_pickle,
+                                              encoding=args.encoding,
+                                              verify=args.verify),
+                            pickle_list,
+                            num_workers=args.num_workers,
+                            chunksize=args.chunksize)
+    if failures:
+        sys.exit(1)
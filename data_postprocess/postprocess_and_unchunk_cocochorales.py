@@ -2,175 +2,172 @@
 Post-process the chunked output from MIDI-DDSP
 (each chunk corresponds to a job using MIDI-DDSP to synthesize several MIDIs)
 and chunk the final dataset by compress pieces into tars.
+
+The pieces are read directly from the zip of each chunk, post-processed in memory and appended to the tars of
+the five data types, so that nothing is extracted or copied to disk in between.
+The tars are compressed in background threads while the next pieces are post-processed.
+
+The pieces of a split are appended to its tars in the order of their track ids, so the tar of each piece is known
+from the registry. Each tar is recorded in the journal once it is written, and a restarted run skips the pieces of
+the tars already written.
 """
 import os
-import glob
-import shutil
+import time
+import functools
+import pickle
+import zipfile
 import argparse
 from tqdm import tqdm
 import sys
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
-from utils.file_utils import json_load
 from utils.instrument_utils import AVAILABLE_ENSEMBLES
-from data_postprocess.postprocess_utils import copy_and_separate_midi, move_wavs, split_metadata, save_other_data
-
-NUM_TRACK_DIGITS = 6
-
-
-def split_piece_list(piece_list, split_json):
-    piece_list_split = {}
-    for split, split_pieces in split_json.items():
-        split_pieces_filename = [f.replace('.mid', '') for f in split_pieces]
-        piece_list_split[split] = [p for p in piece_list if os.path.basename(p) in split_pieces_filename]
-    return piece_list_split
+from utils.synth_params_utils import ENCODINGS
+from utils.shard_utils import DATA_TYPES, ShardPacker
+from utils.journal_utils import add_journal_args, get_journal
+from utils.profile_utils import add_profile_args, get_profiler, profile_stage
+from utils.registry_utils import SPLITS, add_registry_args, get_registry, list_zip_pieces
+from data_postprocess.postprocess_utils import separate_midi, get_wav_save_names, split_loaded_metadata, \
+    serialize_other_data, get_bookkeeping_dir
+
+STAGE = 'postprocess_and_unchunk'
+
+
+def postprocess_piece(zip_file, piece, file_names, midi_path, ensemble, piece_save_id,
+                      synthesis_parameters_format='pickle', synthesis_parameters_encoding='float32'):
+    """Post-process a piece read from the zip of a chunk, in memory.
+    Returns {data type: {path in the split directory of the data type: bytes}}."""
+    with profile_stage('midi'):
+        piece_files = separate_midi(midi_path)
+    with profile_stage('read_zip'):
+        wav_names = [name for name in file_names if name.endswith('.wav')]
+        for wav_name, save_name in get_wav_save_names(wav_names):
+            piece_files[save_name] = zip_file.read(wav_name)
+        metadata = pickle.loads(zip_file.read(f'{piece}/metadata.pickle'))
+
+    with profile_stage('metadata'):
+        metadata, note_expression, synthesis_parameters = split_loaded_metadata(midi_path, metadata, ensemble)
+        files = serialize_other_data(metadata, note_expression, synthesis_parameters, piece_save_id,
+                                     synthesis_parameters_format=synthesis_parameters_format,
+                                     synthesis_parameters_encoding=synthesis_parameters_encoding)
+    files['main_dataset'].update({f'{piece_save_id}/{name}': data for name, data in piece_files.items()})
+    return files
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Postprocess and Unchunk')
     parser.add_argument('--midi_dir', type=str, default=None, metavar='N',
                         help='The directory containing all the MIDI files.')
-    parser.add_argument('--postprocess_output_dir', type=str, default=None, metavar='N',
-                        help='The temporary directory for outputting the postprocessed data for each piece.'
-                             'The data for each piece will be compressed into tars.')
     parser.add_argument('--zip_dir', type=str, default=None, metavar='N',
                         help='The directory for the zip of each chunk output by MIDI-DDSP.')
-    parser.add_argument('--zip_extract_dir', type=str, default=None, metavar='N',
-                        help='The temporary directory for outputting the '
-                             'extracted data for each chunk output by MIDI-DDSP.')
     parser.add_argument('--final_output_dir', type=str, default=None, metavar='N',
                         help='The directory for the final output containing tars.')
+    parser.add_argument('--synthesis_parameters_format', type=str, default='pickle', choices=['pickle', 'columnar'],
+                        help='the format for saving the synthesis parameters. '
+                             'columnar saves them in a format that can be memory-mapped.')
+    parser.add_argument('--synthesis_parameters_encoding', type=str, default='float32', choices=ENCODINGS,
+                        help='the encoding of the synthesis parameters and f0 in the columnar format. '
+                             'See utils/synth_params_utils.py for the error of each encoding.')
+    parser.add_argument('--shard_format', type=str, default='tar', choices=['tar', 'indexed'],
+                        help='the format of the tars. indexed also writes an index for reading single pieces '
+                             '(see utils/shard_utils.py).')
+    parser.add_argument('--pack_workers', type=int, default=2, metavar='N',
+                        help='the number of threads compressing the tars, each writing the tars of some data types.')
+    parser.add_argument('--pack_queue_size', type=int, default=4, metavar='N',
+                        help='the number of pieces waiting to be packed, before post-processing waits for packing.')
+    add_journal_args(parser)
+    add_profile_args(parser)
+    add_registry_args(parser)
     args = parser.parse_args()
     midi_dir = args.midi_dir
-    postprocess_output_dir = args.postprocess_output_dir
     final_output_dir = args.final_output_dir
 
-    splits = ['train', 'valid', 'test']
-    main_dataset_dir = os.path.join(postprocess_output_dir, 'main_dataset')
-    metadata_dir = os.path.join(postprocess_output_dir, 'metadata')
-    note_expression_output_dir = os.path.join(postprocess_output_dir, 'note_expression')
-    synthesis_parameters_output_dir = os.path.join(postprocess_output_dir, 'synthesis_parameters')
-    f0_output_dir = os.path.join(postprocess_output_dir, 'f0')
-    os.makedirs(main_dataset_dir, exist_ok=True)
+    splits = SPLITS
 
     # create directory
     for split in splits:
-        os.makedirs(os.path.join(metadata_dir, split), exist_ok=True)
-        os.makedirs(os.path.join(note_expression_output_dir, split), exist_ok=True)
-        os.makedirs(os.path.join(synthesis_parameters_output_dir, split), exist_ok=True)
-        os.makedirs(os.path.join(f0_output_dir, split), exist_ok=True)
-
-        os.makedirs(os.path.join(os.path.join(final_output_dir, 'main_dataset'), split), exist_ok=True)
-        os.makedirs(os.path.join(os.path.join(final_output_dir, 'metadata'), split), exist_ok=True)
-        os.makedirs(os.path.join(os.path.join(final_output_dir, 'note_expression'), split), exist_ok=True)
-        os.makedirs(os.path.join(os.path.join(final_output_dir, 'synthesis_parameters'), split), exist_ok=True)
-        os.makedirs(os.path.join(os.path.join(final_output_dir, 'f0'), split), exist_ok=True)
-
-    os.makedirs(args.zip_extract_dir, exist_ok=True)
+        for data_type in DATA_TYPES:
+            os.makedirs(os.path.join(final_output_dir, data_type, split), exist_ok=True)
 
     # you may need to change the following three lines according to your own dataset and split
     split_idx = {'train': 1, 'valid': 192001, 'test': 216001}  # the ID of the first piece in each split
     zip_idx = {'train': 1, 'valid': 1, 'test': 1}  # the ID of the first zip in each split
     NUM_PIECES_IN_ZIP = 2000  # the number of pieces in each zip
 
-    for ensemble in AVAILABLE_ENSEMBLES:
-        split_json = json_load(os.path.join(midi_dir, 'split', f'{ensemble}_split.json'))
-        ensemble_zip_dir = os.path.join(args.zip_dir, ensemble)
-        all_zip_files = sorted(glob.glob(ensemble_zip_dir + '/*.zip'))
-        for zip_file in all_zip_files:
-            zip_save_path = os.path.join(args.zip_extract_dir, os.path.basename(zip_file))
-
-            os.system(f'cp "{zip_file}" "{zip_save_path}"')
-            os.system(f'unzip -q {zip_save_path} -d {args.zip_extract_dir}')
-
-            piece_list = sorted(glob.glob(args.zip_extract_dir + '/*'))
-            piece_list_splited = split_piece_list(piece_list, split_json)
-            for split, piece_list in piece_list_splited.items():
-                for piece_dir in tqdm(piece_list):
-                    piece_idx = split_idx[split]
-                    piece = os.path.basename(piece_dir)  # piece=name of synthesis dir
-                    midi_path = os.path.join(midi_dir, ensemble, f'{piece}.mid')
-                    # the name of the piece in the final dataset, different from MIDI file id.
-                    piece_save_id = f'{ensemble}_track{str(piece_idx).zfill(NUM_TRACK_DIGITS)}'
-                    piece_save_dir = os.path.join(main_dataset_dir, split, piece_save_id)
-                    os.makedirs(piece_save_dir, exist_ok=True)
-                    copy_and_separate_midi(midi_path, piece_save_dir)
-                    move_wavs(piece_dir, piece_save_dir)
-
-                    metadata, note_expression, synthesis_parameters = split_metadata(midi_path, piece_dir, ensemble)
-                    save_other_data(metadata,
-                                    note_expression,
-                                    synthesis_parameters,
-                                    split,
-                                    piece_save_id,
-                                    piece_save_dir,
-                                    metadata_dir,
-                                    note_expression_output_dir,
-                                    synthesis_parameters_output_dir,
-                                    f0_output_dir)
-
-                    split_idx[split] += 1
-
-            # Check if each output directory has more than 1000 folders, if so, zip them.
-            # Here we use pbzip2 instead of zip because it is faster for large amount of files.
-            for split in splits:
-                piece_list = glob.glob(main_dataset_dir + f'/{split}/*')
-                piece_list = sorted(piece_list, key=lambda x: os.path.basename(x).split('_')[1])
-                if len(piece_list) >= NUM_PIECES_IN_ZIP:
-
-                    print(f'start zipping part {zip_idx[split]} of {split}')
-
-                    # zip the first 1000 folders
-                    zip_tmp_dir = os.path.join(args.zip_extract_dir, f'tmp')
-                    os.makedirs(zip_tmp_dir, exist_ok=True)
-                    piece_list_to_remove = piece_list[:NUM_PIECES_IN_ZIP]
-
-                    chunk_file_name = f'{args.zip_extract_dir}/{zip_idx[split]}.tar.bz2'
-
-                    # main dataset
-                    for piece in piece_list_to_remove:
-                        shutil.move(piece, zip_tmp_dir)
-                    os.system(f'tar cf {chunk_file_name} --use-compress-prog=pbzip2 -C {zip_tmp_dir}/ .')
-                    os.system(f'mv {chunk_file_name} {final_output_dir}/main_dataset/{split}/')
-                    os.system(f'rm -rf {zip_tmp_dir}/*')
-
-                    # metadata
-                    for piece in piece_list_to_remove:
-                        shutil.move(os.path.join(metadata_dir, split, os.path.basename(piece) + '.yaml'), zip_tmp_dir)
-                    os.system(f'tar cf {chunk_file_name} --use-compress-prog=pbzip2 -C {zip_tmp_dir}/ .')
-                    os.system(f'mv {chunk_file_name} {final_output_dir}/metadata/{split}/')
-                    os.system(f'rm -rf {zip_tmp_dir}/*')
-
-                    # note_expression
-                    for piece in piece_list_to_remove:
-                        shutil.move(os.path.join(note_expression_output_dir, split, os.path.basename(piece)),
-                                    zip_tmp_dir)
-                    os.system(f'tar cf {chunk_file_name} --use-compress-prog=pbzip2 -C {zip_tmp_dir}/ .')
-                    os.system(f'mv {chunk_file_name} '
-                              f'{final_output_dir}/note_expression/{split}/')
-                    os.system(f'rm -rf {zip_tmp_dir}/*')
-
-                    # synthesis_parameters
-                    for piece in piece_list_to_remove:
-                        shutil.move(os.path.join(os.path.join(synthesis_parameters_output_dir, split),
-                                                 os.path.basename(piece) + '.pickle'), zip_tmp_dir)
-                    os.system(f'tar cf {chunk_file_name} --use-compress-prog=pbzip2 -C {zip_tmp_dir}/ .')
-                    os.system(f'mv {chunk_file_name} '
-                              f'{final_output_dir}/synthesis_parameters/{split}/')
-                    os.system(f'rm -rf {zip_tmp_dir}/*')
-
-                    # f0
-                    for piece in piece_list_to_remove:
-                        shutil.move(os.path.join(f0_output_dir, split, os.path.basename(piece) + '.pickle'),
-                                    zip_tmp_dir)
-                    os.system(f'tar cf {chunk_file_name} --use-compress-prog=pbzip2 -C {zip_tmp_dir}/ .')
-                    os.system(f'mv {chunk_file_name} '
-                              f'{final_output_dir}/f0/{split}/')
-                    os.system(f'rm -rf {zip_tmp_dir}/*')
-
-                    zip_idx[split] += 1
-
-            # Remove the zip file
-            os.remove(zip_save_path)
-            # Remove the unziped directory
-            os.system(f'rm -rf {args.zip_extract_dir}/*')
+    # the track ids of the pieces are assigned once, when the registry is built.
+    registry = get_registry(args, get_bookkeeping_dir(final_output_dir), midi_dir, zip_dir=args.zip_dir,
+                            first_track_idx=split_idx)
+
+    # the pieces of a split fill its tars one after another, in the order of their track ids
+    num_split_pieces = {split: registry.count(split) for split in splits}
+
+    def get_piece_idx(record):
+        """The position of a piece in its split."""
+        return record['track_idx'] - split_idx[record['split']]
+
+    def get_shard_key(record):
+        """The tar of a piece, recorded as <split>/<tar id> in the journal."""
+        return f'{record["split"]}/{zip_idx[record["split"]] + get_piece_idx(record) // NUM_PIECES_IN_ZIP}'
+
+    journal = get_journal(args, get_bookkeeping_dir(final_output_dir))
+    shard_keys = [f'{split}/{zip_idx[split] + i}' for split in splits
+                  for i in range(-(-num_split_pieces[split] // NUM_PIECES_IN_ZIP))]
+    pending_shard_keys = set(journal.pending(STAGE, shard_keys, key=str, ignore_journal=args.ignore_journal))
+
+    packer = ShardPacker(final_output_dir, DATA_TYPES, shard_format=args.shard_format,
+                         num_workers=args.pack_workers, queue_size=args.pack_queue_size)
+    profiler = get_profiler(args, 'postprocess_and_unchunk', get_bookkeeping_dir(final_output_dir))
+    num_pieces = 0
+    start_time = time.perf_counter()
+    postprocess_time = 0.0
+
+    try:
+        for ensemble in AVAILABLE_ENSEMBLES:
+            for zip_path in registry.zip_paths(ensemble):
+                zip_records = {split: [record for record in registry.pieces(split=split, zip_path=zip_path)
+                                       if get_shard_key(record) in pending_shard_keys] for split in splits}
+                if not any(zip_records.values()):
+                    continue  # all the pieces of the zip are in tars already written
+                with zipfile.ZipFile(zip_path, 'r') as zip_file:
+                    zip_pieces = list_zip_pieces(zip_file)
+                    for split in splits:
+                        for record in tqdm(zip_records[split]):
+                            postprocess_start = time.perf_counter()
+                            piece = record['piece']
+                            midi_path = record['midi_path']
+                            # the name of the piece in the final dataset, different from MIDI file id.
+                            piece_save_id = record['track_id']
+                            piece_idx = get_piece_idx(record)
+                            shard_idx = zip_idx[split] + piece_idx // NUM_PIECES_IN_ZIP
+                            shard_key = get_shard_key(record)
+                            if piece_idx % NUM_PIECES_IN_ZIP == 0:
+                                journal.mark_started(STAGE, shard_key)
+                            with profiler.piece(f'{ensemble}/{piece}'):
+                                files = postprocess_piece(
+                                    zip_file, piece, zip_pieces[piece], midi_path, ensemble, piece_save_id,
+                                    synthesis_parameters_format=args.synthesis_parameters_format,
+                                    synthesis_parameters_encoding=args.synthesis_parameters_encoding)
+                                postprocess_time += time.perf_counter() - postprocess_start
+
+                                # waits while pack_queue_size pieces are already waiting to be packed
+                                with profile_stage('pack_wait'):
+                                    packer.add_piece(split, shard_idx, files)
+                            num_pieces += 1
+
+                            # the last tar of each split holds the remaining pieces
+                            if (piece_idx + 1) % NUM_PIECES_IN_ZIP == 0 or piece_idx + 1 == num_split_pieces[split]:
+                                print(f'queued part {shard_idx} of {split}')
+                                # recorded as done once the tars of all the data types are written
+                                packer.close_shard(split, functools.partial(journal.mark_done, STAGE, shard_key))
+                    zip_file.close()
+
+        packer.close()
+    except BaseException:
+        packer.abort()
+        raise
+
+    total_time = time.perf_counter() - start_time
+    print(f'{num_pieces} pieces in {total_time:.1f}s ({num_pieces / max(total_time, 1e-9):.2f} pieces/s), '
+          f'post-processing {postprocess_time:.1f}s busy ({num_pieces / max(postprocess_time, 1e-9):.2f} pieces/s)')
+    print(packer.summary())
+    profiler.summarize()
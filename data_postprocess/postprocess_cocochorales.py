@@ -1,18 +1,95 @@
 """
 Postprocess the data generated from MIDI-DDSP to the format of the CocoChorales dataset.
+
+The track ids of the pieces are assigned up front by the piece registry (see utils/registry_utils.py), so the pieces
+are postprocessed independently, in parallel with --num_workers, and the output does not depend on the number of
+workers. --max_io_workers bounds the number of workers moving and writing files at the same time.
 """
 
 import os
 import argparse
-from tqdm import tqdm
+import contextlib
+import functools
+import multiprocessing
 import sys
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
-from utils.file_utils import json_load
 from utils.instrument_utils import AVAILABLE_ENSEMBLES
-from data_postprocess.postprocess_utils import copy_and_separate_midi, move_wavs, split_metadata, save_other_data
+from utils.synth_params_utils import ENCODINGS
+from utils.journal_utils import add_journal_args, get_journal
+from utils.parallel_utils import add_parallel_args, run_parallel
+from utils.profile_utils import add_profile_args, get_profiler, profile_stage
+from utils.registry_utils import SPLITS, add_registry_args, get_registry
+from data_postprocess.postprocess_utils import copy_and_separate_midi, link_wavs, remove_wavs, split_metadata, \
+    save_other_data, get_bookkeeping_dir
+
+# the semaphore bounding the workers doing I/O at the same time, None without a bound.
+_io_limit = None
+
+
+def _init_io_limit(io_limit):
+    global _io_limit
+    _io_limit = io_limit
+
+
+@contextlib.contextmanager
+def io_slot():
+    """Hold one of the --max_io_workers slots while moving or writing files. Does nothing without a bound."""
+    if _io_limit is None:
+        yield
+        return
+    with profile_stage('io_wait'):
+        _io_limit.acquire()
+    try:
+        yield
+    finally:
+        _io_limit.release()
+
+
+def _journal_key(record):
+    # pieces are recorded as <ensemble>/<MIDI file id> in the journal
+    return f'{record["ensemble"]}/{record["piece"]}'
+
+
+def postprocess_piece(record, output_dir, synthesis_parameters_format='pickle',
+                      synthesis_parameters_encoding='float32'):
+    """Postprocess a synthesized piece, given by its record in the registry, to the dataset in output_dir."""
+    ensemble, split = record['ensemble'], record['split']
+    midi_path, piece_dir = record['midi_path'], record['synthesis_dir']
+    # piece_save_id is the name of the piece in the final dataset, different from MIDI file id.
+    piece_save_id = record['track_id']
+    piece_save_dir = os.path.join(output_dir, 'main_dataset', split, piece_save_id)
+    os.makedirs(piece_save_dir, exist_ok=True)
+
+    with profile_stage('midi'):
+        copy_and_separate_midi(midi_path, piece_save_dir)
+    with io_slot(), profile_stage('wav'):
+        link_wavs(piece_dir, piece_save_dir)
+
+    with profile_stage('metadata'):
+        metadata, note_expression, synthesis_parameters = split_metadata(midi_path, piece_dir, ensemble)
+    with io_slot(), profile_stage('save'):
+        save_other_data(metadata,
+                        note_expression,
+                        synthesis_parameters,
+                        split,
+                        piece_save_id,
+                        piece_save_dir,
+                        os.path.join(output_dir, 'metadata'),
+                        os.path.join(output_dir, 'note_expression'),
+                        os.path.join(output_dir, 'synthesis_parameters'),
+                        os.path.join(output_dir, 'f0'),
+                        synthesis_parameters_format=synthesis_parameters_format,
+                        synthesis_parameters_encoding=synthesis_parameters_encoding)
+
+
+def postprocess_and_remove_wavs(record, process_fn):
+    """Post-process a piece with process_fn, which records it as done in the journal, then remove its synthesized
+    wavs. An interrupted piece keeps all its wavs, and is post-processed again from them when the run is resumed."""
+    process_fn(record)
+    with io_slot():
+        remove_wavs(record['synthesis_dir'])
 
-NUM_TRACK_DIGITS = 6
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Postprocess')
@@ -22,60 +99,57 @@ if __name__ == '__main__':
                         help='the directory containing all the synthesized audios in each folder.')
     parser.add_argument('--output_dir', type=str, default=None, metavar='N',
                         help='the directory for outputting the postprocessed dataset.')
+    parser.add_argument('--synthesis_parameters_format', type=str, default='pickle', choices=['pickle', 'columnar'],
+                        help='the format for saving the synthesis parameters. '
+                             'columnar saves them in a format that can be memory-mapped.')
+    parser.add_argument('--synthesis_parameters_encoding', type=str, default='float32', choices=ENCODINGS,
+                        help='the encoding of the synthesis parameters and f0 in the columnar format. '
+                             'See utils/synth_params_utils.py for the error of each encoding.')
+    parser.add_argument('--max_io_workers', type=int, default=None, metavar='N',
+                        help='the number of workers moving and writing files at the same time. '
+                             'Default to all the workers.')
+    add_parallel_args(parser)
+    add_journal_args(parser)
+    add_profile_args(parser)
+    add_registry_args(parser)
     args = parser.parse_args()
     midi_dir = args.midi_dir
     synthesis_dir = args.synthesis_dir
     output_dir = args.output_dir
 
-    splits = ['train', 'valid', 'test']
+    splits = SPLITS
 
-    main_dataset_dir = os.path.join(output_dir, 'main_dataset')
-    metadata_dir = os.path.join(output_dir, 'metadata')
-    note_expression_output_dir = os.path.join(output_dir, 'note_expression')
-    synthesis_parameters_output_dir = os.path.join(output_dir, 'synthesis_parameters')
-    f0_output_dir = os.path.join(output_dir, 'f0')
-    os.makedirs(main_dataset_dir, exist_ok=True)
+    os.makedirs(os.path.join(output_dir, 'main_dataset'), exist_ok=True)
 
     # create directory for metadata and intermediate_output
     for split in splits:
-        os.makedirs(os.path.join(metadata_dir, split), exist_ok=True)
-        os.makedirs(os.path.join(note_expression_output_dir, split), exist_ok=True)
-        os.makedirs(os.path.join(synthesis_parameters_output_dir, split), exist_ok=True)
-        os.makedirs(os.path.join(f0_output_dir, split), exist_ok=True)
-
-    piece_idx = 1
-    for ensemble in AVAILABLE_ENSEMBLES:
-        # load the split file containing MIDI filenames for each split.
-        split_json = json_load(os.path.join(midi_dir, 'split', f'{ensemble}_split.json'))
-
-        for split in splits:
-            piece_list = split_json[split]  # find all the MIDI files in the split
-            piece_list = [p.replace('.mid', '') for p in piece_list]
-            for piece in tqdm(piece_list):
-                piece_dir = os.path.join(synthesis_dir, ensemble, piece)
-                if os.path.exists(piece_dir):
-                    midi_path = os.path.join(midi_dir, ensemble, f'{piece}.mid')
-
-                    # piece_save_id is the name of the piece in the final dataset, different from MIDI file id.
-                    piece_save_id = f'{ensemble}_track{str(piece_idx).zfill(NUM_TRACK_DIGITS)}'
-                    piece_save_dir = os.path.join(main_dataset_dir, split, piece_save_id)
-                    os.makedirs(piece_save_dir, exist_ok=True)
-                    copy_and_separate_midi(midi_path, piece_save_dir)
-                    move_wavs(piece_dir, piece_save_dir)
-
-                    metadata, note_expression, synthesis_parameters = split_metadata(midi_path, piece_dir, ensemble)
-                    save_other_data(metadata,
-                                    note_expression,
-                                    synthesis_parameters,
-                                    split,
-                                    piece_save_id,
-                                    piece_save_dir,
-                                    metadata_dir,
-                                    note_expression_output_dir,
-                                    synthesis_parameters_output_dir,
-                                    f0_output_dir)
-
-                    piece_idx += 1
-
-                else:
-                    pass  # print(f'Missing piece {piece}')
+        for data_type in ['metadata', 'note_expression', 'synthesis_parameters', 'f0']:
+            os.makedirs(os.path.join(output_dir, data_type, split), exist_ok=True)
+
+    # the track ids of the pieces are assigned once, when the registry is built.
+    registry = get_registry(args, get_bookkeeping_dir(output_dir), midi_dir, synthesis_dir=synthesis_dir)
+    # the synthesized pieces, in the order of the ensembles, the splits and the split files
+    records = [record for ensemble in AVAILABLE_ENSEMBLES for split in splits
+               for record in registry.pieces(ensemble=ensemble, split=split)]
+
+    journal = get_journal(args, get_bookkeeping_dir(output_dir))
+    records = journal.pending('postprocess', records, key=_journal_key, ignore_journal=args.ignore_journal)
+    profiler = get_profiler(args, 'postprocess', get_bookkeeping_dir(output_dir))
+
+    process_fn = functools.partial(postprocess_piece,
+                                   output_dir=output_dir,
+                                   synthesis_parameters_format=args.synthesis_parameters_format,
+                                   synthesis_parameters_encoding=args.synthesis_parameters_encoding)
+    io_limit = multiprocessing.BoundedSemaphore(args.max_io_workers) \
+        if args.max_io_workers and args.num_workers > args.max_io_workers else None
+    process_fn = profiler.wrap(journal.wrap('postprocess', process_fn, key=_journal_key), key=_journal_key)
+    failures = run_parallel(functools.partial(postprocess_and_remove_wavs, process_fn=process_fn),
+                            records,
+                            num_workers=args.num_workers,
+                            chunksize=args.chunksize,
+                            initializer=_init_io_limit,
+                            initargs=(io_limit,),
+                            desc='postprocess')
+    profiler.summarize()
+    if failures:
+        sys.exit(1)
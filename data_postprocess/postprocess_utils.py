@@ -2,52 +2,106 @@
 Utilities for postprocess the data generated from MIDI-DDSP.
 """
 
+import io
 import os
 import glob
+import pickle
 import shutil
+import yaml
 import pretty_midi
 import sys
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
-from utils.file_utils import pickle_load, pickle_dump, yaml_dump
-from midi_ddsp.data_handling.instrument_name_utils import INST_ID_TO_NAME_DICT, INST_NAME_TO_MIDI_PROGRAM_DICT, \
-    MIDI_PROGRAM_TO_INST_NAME_DICT
+from utils.file_utils import pickle_load
+from utils.synth_params_utils import SYNTH_PARAMS_EXTENSION, synthesis_parameters_to_bytes
+from utils import instrument_utils
+
+
+def get_bookkeeping_dir(output_dir):
+    """The default directory of the bookkeeping of a post-processing run (its journal, piece registry and profile),
+    next to the dataset in output_dir rather than in it, so that it is not published with the dataset."""
+    return f'{os.path.abspath(output_dir)}_bookkeeping'
 
 
 def get_midi_tempo(midi_path):
     return int(pretty_midi.PrettyMIDI(midi_path).get_tempo_changes()[1][0])
 
 
+def get_wav_save_names(wav_paths):
+    """Get the path in the piece directory of the final dataset of each wav file of a synthesized piece,
+    as a list of (wav_path, save_name)."""
+    all_stems = sorted([f for f in wav_paths if 'mix.wav' not in f])
+    save_names = []
+    for stem in all_stems:
+        part_number, instrument_name = os.path.basename(stem).replace('.wav', '').split('_')[:2]
+        # numbered by the part of the stem, not by its position among the stems found
+        save_names.append((stem, f'stems_audio/{int(part_number) + 1}_{instrument_name}.wav'))  # 1-indexed
+    save_names += [(f, 'mix.wav') for f in wav_paths if os.path.basename(f) == 'mix.wav']
+    return save_names
+
+
 def move_wavs(piece_dir, save_dir, copy=False):
     """Move wav files for re-structure. If copy is True, copy instead of move."""
-    stem_audio_save_dir = os.path.join(save_dir, 'stems_audio')
-    os.makedirs(stem_audio_save_dir, exist_ok=True)
-    all_audios = glob.glob(piece_dir + '/*.wav')
-    all_stems = sorted([f for f in all_audios if 'mix.wav' not in f])
-    for i, stem in enumerate(all_stems):
-        instrument_name = os.path.basename(stem).split('_')[1].replace('.wav', '')
+    os.makedirs(os.path.join(save_dir, 'stems_audio'), exist_ok=True)
+    for wav_path, save_name in get_wav_save_names(glob.glob(piece_dir + '/*.wav')):
         if copy:
-            shutil.copy(stem, os.path.join(stem_audio_save_dir, f'{i + 1}_{instrument_name}.wav'))  # 1-indexed
+            shutil.copy(wav_path, os.path.join(save_dir, save_name))
         else:
-            shutil.move(stem, os.path.join(stem_audio_save_dir, f'{i + 1}_{instrument_name}.wav'))  # 1-indexed
-    mix_audio = os.path.join(piece_dir, 'mix.wav')
-    if copy:
-        shutil.copy(mix_audio, os.path.join(save_dir, 'mix.wav'))
-    else:
-        shutil.move(mix_audio, os.path.join(save_dir, 'mix.wav'))
+            shutil.move(wav_path, os.path.join(save_dir, save_name))
 
 
-def copy_and_separate_midi(midi_file, save_dir):
-    """Copy the midi file to the save_dir and separate the midi into stems."""
+def link_wavs(piece_dir, save_dir):
+    """Hard-link the wav files for re-structure, or copy them if save_dir is on another filesystem. Unlike move_wavs,
+    the synthesized piece is left complete, until remove_wavs once its post-processing is done."""
+    os.makedirs(os.path.join(save_dir, 'stems_audio'), exist_ok=True)
+    for wav_path, save_name in get_wav_save_names(glob.glob(piece_dir + '/*.wav')):
+        save_path = os.path.join(save_dir, save_name)
+        if os.path.exists(save_path):
+            os.remove(save_path)  # left by an interrupted run
+        try:
+            os.link(wav_path, save_path)
+        except OSError:
+            shutil.copy(wav_path, save_path)
+
+
+def remove_wavs(piece_dir):
+    """Remove the wav files of a synthesized piece."""
+    for wav_path in glob.glob(piece_dir + '/*.wav'):
+        os.remove(wav_path)
+
+
+def separate_midi(midi_file):
+    """Separate the midi into stems. Returns {path in the piece directory: bytes of the midi file}
+    for the mix and the stems."""
     midi = pretty_midi.PrettyMIDI(midi_file)
-    midi.write(os.path.join(save_dir, 'mix.mid'))
-    stem_midi_save_dir = os.path.join(save_dir, 'stems_midi')
-    os.makedirs(stem_midi_save_dir, exist_ok=True)
+    midi_files = {'mix.mid': midi}
     for i, inst in enumerate(midi.instruments):
         stem_midi = pretty_midi.PrettyMIDI(initial_tempo=midi.get_tempo_changes()[1][0])  # use the same tempo
         stem_midi.instruments.append(inst)
-        instrument_name = MIDI_PROGRAM_TO_INST_NAME_DICT[inst.program]
-        stem_midi.write(os.path.join(stem_midi_save_dir, f'{i + 1}_{instrument_name}.mid'))  # 1-indexed
+        instrument_name = instrument_utils.MIDI_PROGRAM_TO_INST_NAME_DICT[inst.program]
+        midi_files[f'stems_midi/{i + 1}_{instrument_name}.mid'] = stem_midi  # 1-indexed
+
+    midi_bytes = {}
+    for name, midi_to_write in midi_files.items():
+        buffer = io.BytesIO()
+        midi_to_write.write(buffer)
+        midi_bytes[name] = buffer.getvalue()
+    return midi_bytes
+
+
+def write_files(files, save_dir):
+    """Write {relative path: bytes} to save_dir."""
+    for name, data in files.items():
+        path = os.path.join(save_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+            f.close()
+
+
+def copy_and_separate_midi(midi_file, save_dir):
+    """Copy the midi file to the save_dir and separate the midi into stems."""
+    write_files(separate_midi(midi_file), save_dir)
 
 
 def get_f0(synthesis_parameters):
@@ -55,6 +109,40 @@ def get_f0(synthesis_parameters):
     return {key: synthesis_parameters[key]['f0_hz'] for key in synthesis_parameters}
 
 
+def serialize_other_data(metadata,
+                         note_expression,
+                         synthesis_parameters,
+                         piece_save_id,
+                         synthesis_parameters_format='pickle',
+                         synthesis_parameters_encoding='float32'):
+    """Serialize the metadata, note_expression, synthesis_parameters and f0 of a piece.
+    Returns {data type: {path in the split directory of the data type: bytes}}, see save_other_data."""
+    if synthesis_parameters_format == 'pickle' and synthesis_parameters_encoding != 'float32':
+        raise ValueError('Reduced precision encodings are only supported by the columnar format.')
+
+    # metadata is saved in the main dataset, and a second copy in the standalone metadata folder
+    metadata_bytes = yaml.dump(metadata, sort_keys=False).encode()
+    files = {'main_dataset': {f'{piece_save_id}/metadata.yaml': metadata_bytes},
+             'metadata': {f'{piece_save_id}.yaml': metadata_bytes},
+             'note_expression': {}}
+
+    for key in note_expression:
+        instrument_name = metadata['instrument_name'][key]
+        files['note_expression'][f'{piece_save_id}/{key}_{instrument_name}.csv'] = \
+            note_expression[key].to_csv().encode()
+
+    f0 = get_f0(synthesis_parameters)
+    if synthesis_parameters_format == 'columnar':
+        files['synthesis_parameters'] = {f'{piece_save_id}{SYNTH_PARAMS_EXTENSION}': synthesis_parameters_to_bytes(
+            synthesis_parameters, encoding=synthesis_parameters_encoding)}
+        files['f0'] = {f'{piece_save_id}{SYNTH_PARAMS_EXTENSION}': synthesis_parameters_to_bytes(
+            {part: {'f0_hz': f0[part]} for part in f0}, encoding=synthesis_parameters_encoding)}
+    else:
+        files['synthesis_parameters'] = {f'{piece_save_id}.pickle': pickle.dumps(synthesis_parameters)}
+        files['f0'] = {f'{piece_save_id}.pickle': pickle.dumps(f0)}
+    return files
+
+
 def save_other_data(metadata,
                     note_expression,
                     synthesis_parameters,
@@ -64,29 +152,20 @@ def save_other_data(metadata,
                     metadata_dir,
                     note_expression_output_dir,
                     synthesis_parameters_output_dir,
-                    f0_output_dir):
-    """Save the metadata, note_expression, and synthesis_parameters to the corresponding directories."""
-    # Save metadata to main dataset
-    yaml_dump(metadata, os.path.join(piece_save_dir, f'metadata.yaml'))
-    # Save a second copy of metadata to standalone metadata folder
-    metadata_save_dir = os.path.join(metadata_dir, split)
-    yaml_dump(metadata, os.path.join(metadata_save_dir, f'{piece_save_id}.yaml'))
-
-    # Save note expression data
-    note_expression_dir = os.path.join(note_expression_output_dir, split, piece_save_id)
-    os.makedirs(note_expression_dir, exist_ok=True)
-    for key in note_expression:
-        instrument_name = metadata['instrument_name'][key]
-        note_expression[key].to_csv(os.path.join(note_expression_dir, f'{key}_{instrument_name}.csv'))
-
-    # Save synthesis parameters.
-    # The directory for saving synthesized parameters is already created, so no need to create again
-    synthesis_parameters_dir = os.path.join(synthesis_parameters_output_dir, split)
-    pickle_dump(synthesis_parameters, os.path.join(synthesis_parameters_dir, f'{piece_save_id}.pickle'))
-
-    f0 = get_f0(synthesis_parameters)
-    f0_dir = os.path.join(f0_output_dir, split)
-    pickle_dump(f0, os.path.join(f0_dir, f'{piece_save_id}.pickle'))
+                    f0_output_dir,
+                    synthesis_parameters_format='pickle',
+                    synthesis_parameters_encoding='float32'):
+    """Save the metadata, note_expression, and synthesis_parameters to the corresponding directories.
+    synthesis_parameters_format is either 'pickle' or 'columnar' (see utils/synth_params_utils.py).
+    In the columnar format, the synthesis parameters and f0 are stored with synthesis_parameters_encoding."""
+    files = serialize_other_data(metadata, note_expression, synthesis_parameters, piece_save_id,
+                                 synthesis_parameters_format=synthesis_parameters_format,
+                                 synthesis_parameters_encoding=synthesis_parameters_encoding)
+    write_files(files['main_dataset'], os.path.dirname(piece_save_dir))
+    write_files(files['metadata'], os.path.join(metadata_dir, split))
+    write_files(files['note_expression'], os.path.join(note_expression_output_dir, split))
+    write_files(files['synthesis_parameters'], os.path.join(synthesis_parameters_output_dir, split))
+    write_files(files['f0'], os.path.join(f0_output_dir, split))
 
 
 def split_metadata(midi_path, piece_dir, ensemble):
@@ -94,9 +173,12 @@ def split_metadata(midi_path, piece_dir, ensemble):
 
     # dir: the save dir of current split
     metadata_path = os.path.join(piece_dir, 'metadata.pickle')
+    return split_loaded_metadata(midi_path, pickle_load(metadata_path), ensemble)
+
 
+def split_loaded_metadata(midi_path, metadata, ensemble):
+    """Same as split_metadata, for the content of metadata.pickle already loaded."""
     # first save intermediate output
-    metadata = pickle_load(metadata_path)
     synthesis_parameters_to_save = metadata['synthesis_parameters']
 
     # Rename the keys in note_expression.
@@ -112,6 +194,8 @@ def split_metadata(midi_path, piece_dir, ensemble):
     # delete intermediate output from metadata
     metadata.pop('note_expression_control', None)
     metadata.pop('synthesis_parameters', None)
+    INST_ID_TO_NAME_DICT = instrument_utils.INST_ID_TO_NAME_DICT
+    INST_NAME_TO_MIDI_PROGRAM_DICT = instrument_utils.INST_NAME_TO_MIDI_PROGRAM_DICT
     instrument_name = {i: INST_ID_TO_NAME_DICT[instrument_id] for i, instrument_id in
                        enumerate(metadata['instrument_id'].values())}
     midi_program_number = {i: INST_NAME_TO_MIDI_PROGRAM_DICT[INST_ID_TO_NAME_DICT[instrument_id]] for i, instrument_id
@@ -3,20 +3,22 @@
 import os
 import numpy as np
 import glob
+import functools
 import argparse
-from midi_ddsp.utils.audio_io import save_wav
-from midi_ddsp.utils.inference_utils import ensure_same_length
-from midi_ddsp.utils.midi_synthesis_utils import batch_conditioning_df_to_audio
-from midi_ddsp.midi_ddsp_synthesize import load_pretrained_model
+import sys
 from utils.metadata_utils import load_metadata
 from utils.file_utils import get_config
+from utils.model_utils import add_model_args, get_synthesis_generator, get_worker_model_kwargs
+from utils.parallel_utils import add_parallel_args, run_parallel
+from utils.plan_utils import add_manifest_args, get_planned_synthesis_dirs
+from utils.journal_utils import add_journal_args, get_journal, piece_key
 from utils.file_utils import pickle_load, pickle_dump
+from utils.profile_utils import add_profile_args, get_profiler, profile_stage
+from utils.random_utils import add_seed_args, get_rng
 
-# Load pre-trained model
-synthesis_generator, expression_generator = load_pretrained_model()
 
-
-def note_expression_edit(conditioning_df_all, config):
+def note_expression_edit(conditioning_df_all, config, rng=None):
+    rng = np.random.default_rng(rng)
     conditioning_df_all_new = []
 
     for conditioning_df in conditioning_df_all:
@@ -26,37 +28,37 @@ def note_expression_edit(conditioning_df_all, config):
 
         # vibrato
         vibrato_ori = conditioning_df['vibrato'].to_numpy()
-        vibrato_edited = np.random.uniform(config.vibrato_range[0],
-                                           config.vibrato_range[1],
-                                           vibrato_ori.shape) * pitch_mask
+        vibrato_edited = rng.uniform(config['vibrato_range'][0],
+                                     config['vibrato_range'][1],
+                                     vibrato_ori.shape) * pitch_mask
         conditioning_df['vibrato'] = vibrato_edited
 
         # volume
         volume_ori = conditioning_df['volume'].to_numpy()
-        volume_edited = np.random.uniform(config.volume_range[0],
-                                          config.volume_range[1],
-                                          volume_ori.shape) * pitch_mask
+        volume_edited = rng.uniform(config['volume_range'][0],
+                                    config['volume_range'][1],
+                                    volume_ori.shape) * pitch_mask
         conditioning_df['volume'] = volume_edited
 
         # volume fluctuation
         volume_fluc_ori = conditioning_df['vol_fluc'].to_numpy()
-        volume_fluc_edited = np.random.uniform(config.volume_fluctuation_range[0],
-                                               config.volume_fluctuation_range[1],
-                                               volume_fluc_ori.shape) * pitch_mask
+        volume_fluc_edited = rng.uniform(config['volume_fluctuation_range'][0],
+                                         config['volume_fluctuation_range'][1],
+                                         volume_fluc_ori.shape) * pitch_mask
         conditioning_df['vol_fluc'] = volume_fluc_edited
 
         # volume peak position
         vol_peak_pos_ori = conditioning_df['vol_peak_pos'].to_numpy()
-        vol_peak_pos_edited = np.random.uniform(config.volume_peak_position_range[0],
-                                                config.volume_peak_position_range[1],
-                                                vol_peak_pos_ori.shape) * pitch_mask
+        vol_peak_pos_edited = rng.uniform(config['volume_peak_position_range'][0],
+                                          config['volume_peak_position_range'][1],
+                                          vol_peak_pos_ori.shape) * pitch_mask
         conditioning_df['vol_peak_pos'] = vol_peak_pos_edited
 
         # attack
         attack_ori = conditioning_df['attack'].to_numpy()
-        attack_edited = np.random.uniform(config.attack_level_range[0],
-                                          config.attack_level_range[1],
-                                          attack_ori.shape) * pitch_mask
+        attack_edited = rng.uniform(config['attack_level_range'][0],
+                                    config['attack_level_range'][1],
+                                    attack_ori.shape) * pitch_mask
         conditioning_df['attack'] = attack_edited
 
         conditioning_df_all_new.append(conditioning_df)
@@ -66,26 +68,45 @@ def note_expression_edit(conditioning_df_all, config):
     return conditioning_df_all_new, edited
 
 
-def expression_augmentation(data_dir, output_dir, config):
+def conditioning_df_to_audio(synthesis_generator, conditioning_df_all, instrument_id_all, display_progressbar=True):
+    """Synthesize the audio of all the parts from the note expressions using MIDI-DDSP.
+    Returns the audio and the synthesis parameters."""
+    from midi_ddsp.utils.midi_synthesis_utils import batch_conditioning_df_to_audio
+    midi_audio, midi_control_params, midi_synth_params = batch_conditioning_df_to_audio(
+        synthesis_generator,
+        conditioning_df_all,
+        instrument_id_all,
+        display_progressbar=display_progressbar)
+    midi_synth_params = midi_synth_params['inputs']  # discard rest of the values other than inputs
+    return midi_audio, midi_synth_params
+
+
+def expression_augmentation(data_dir, output_dir, config, seed=None):
+    from utils.audio_utils import save_wav
+    from midi_ddsp.utils.inference_utils import ensure_same_length
+
     # if output_dir is provided, then save to the output_dir.
     if output_dir:
         output_dir = os.path.join(output_dir, os.path.basename(data_dir))
         os.makedirs(output_dir, exist_ok=True)
+    else:  # else, change in place
+        output_dir = data_dir
 
-    # load metadata
-    pickle_path = os.path.join(data_dir, 'metadata.pickle')
-    instrument, conditioning_df_all, synthesis_parameters, residual_metadata = load_metadata(pickle_path)
+    with profile_stage('load'):
+        # load metadata
+        pickle_path = os.path.join(data_dir, 'metadata.pickle')
+        instrument, conditioning_df_all, synthesis_parameters, residual_metadata = load_metadata(pickle_path)
     instrument_id_all, instrument_name_all = instrument
 
-    conditioning_df_all, edited = note_expression_edit(conditioning_df_all, config)
+    with profile_stage('note_expression'):
+        conditioning_df_all, edited = note_expression_edit(
+            conditioning_df_all, config, get_rng(seed, 'expression_augmentation', piece_key(data_dir)))
 
     if edited:
-        midi_audio, midi_control_params, midi_synth_params = batch_conditioning_df_to_audio(
-            synthesis_generator,
-            conditioning_df_all,
-            instrument_id_all,
-            display_progressbar=True)
-        midi_synth_params = midi_synth_params['inputs']  # discard rest of the values other than inputs
+        with profile_stage('synthesis'):
+            midi_audio, midi_synth_params = conditioning_df_to_audio(get_synthesis_generator(),
+                                                                     conditioning_df_all,
+                                                                     instrument_id_all)
 
         midi_audio_mix = np.sum(
             np.stack(ensure_same_length(
@@ -93,13 +114,15 @@ def expression_augmentation(data_dir, output_dir, config):
                 axis=-1),
             axis=-1)
 
-        # save stem
-        for part_number, instrument_name in enumerate(instrument_name_all):
-            audio = midi_audio[part_number].numpy().astype(np.float64)
-            save_wav(audio, os.path.join(output_dir, f'{part_number}_{instrument_name}.wav'), config.sample_rate)
+        with profile_stage('save'):
+            # save stem
+            for part_number, instrument_name in enumerate(instrument_name_all):
+                audio = midi_audio[part_number].numpy().astype(np.float64)
+                save_wav(audio, os.path.join(output_dir, f'{part_number}_{instrument_name}.wav'),
+                         config['sample_rate'])
 
-        # save mix
-        save_wav(midi_audio_mix, os.path.join(output_dir, f'mix.wav'), config.sample_rate)
+            # save mix
+            save_wav(midi_audio_mix, os.path.join(output_dir, f'mix.wav'), config['sample_rate'])
 
         # make metadata with each item as dict
         metadata = {
@@ -113,7 +136,8 @@ def expression_augmentation(data_dir, output_dir, config):
         metadata = pickle_load(pickle_path)
         metadata['random_note_expression'] = edited
 
-    pickle_dump(metadata, os.path.join(output_dir, 'metadata.pickle'))
+    with profile_stage('save'):
+        pickle_dump(metadata, os.path.join(output_dir, 'metadata.pickle'))
 
 
 if __name__ == '__main__':
@@ -125,16 +149,39 @@ if __name__ == '__main__':
                        help='the directory containing multiple folders generated by MIDI-DDSP synthesis.')
     parser.add_argument('--output_dir', type=str, default=None, metavar='N',
                         help='the directory for output.')
+    add_parallel_args(parser)
+    add_journal_args(parser)
+    add_manifest_args(parser)
+    add_model_args(parser)
+    add_profile_args(parser)
+    add_seed_args(parser)
     args = parser.parse_args()
 
     config = get_config()
 
     if args.synthesis_dir:
         synth_dir_list = [args.synthesis_dir]
+    elif args.multi_synthesis_dir and args.manifest:
+        planned_batches = get_planned_synthesis_dirs(args.manifest, args.multi_synthesis_dir, args.chunk)
+        synth_dir_list = [d for batch in planned_batches for d in batch]
     elif args.multi_synthesis_dir:
-        synth_dir_list = glob.glob(f'{args.multi_synthesis_dir}/*/')
+        synth_dir_list = sorted(glob.glob(f'{args.multi_synthesis_dir}/*/'))
     else:
         raise ValueError('Either synthesis_dir or multi_synthesis_dir should be specified.')
 
-    for synth_dir in synth_dir_list:
-        expression_augmentation(synth_dir, args.output_dir, config)
+    # the trailing slash of the glob would make the name of the piece directories empty
+    synth_dir_list = [os.path.normpath(d) for d in synth_dir_list]
+    journal = get_journal(args)
+    synth_dir_list = journal.pending('expression_augmentation', synth_dir_list, ignore_journal=args.ignore_journal,
+                                     in_place=not args.output_dir)
+
+    profiler = get_profiler(args, 'expression_augmentation')
+    process_fn = functools.partial(expression_augmentation, output_dir=args.output_dir, config=config, seed=args.seed)
+    failures = run_parallel(profiler.wrap(journal.wrap('expression_augmentation', process_fn)),
+                            synth_dir_list,
+                            num_workers=args.num_workers,
+                            chunksize=args.chunksize,
+                            **get_worker_model_kwargs(args))
+    profiler.summarize()
+    if failures:
+        sys.exit(1)
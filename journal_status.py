@@ -0,0 +1,66 @@
+"""
+Report the progress of the stages recorded in the journals of one or several chunks (see utils/journal_utils.py).
+For each stage, print the number of pieces done, the pieces interrupted (started but not done),
+and the number of chunks whose stage is complete.
+"""
+
+import os
+import glob
+import argparse
+
+from utils.journal_utils import JOURNAL_DIR_NAME, DONE, STARTED, Journal
+
+
+def find_journal_dirs(paths):
+    """Expand the globs, and use the journal directory inside the given directories when there is one."""
+    journal_dirs = []
+    for path in paths:
+        for matched_path in sorted(glob.glob(path)) or [path]:
+            if os.path.isdir(os.path.join(matched_path, JOURNAL_DIR_NAME)):
+                matched_path = os.path.join(matched_path, JOURNAL_DIR_NAME)
+            journal_dirs.append(matched_path)
+    return journal_dirs
+
+
+def stage_status(journal, stage):
+    statuses = journal.status(stage)
+    done = [piece for piece, status in statuses.items() if status == DONE]
+    interrupted = sorted(piece for piece, status in statuses.items() if status == STARTED)
+    total = journal.get_total(stage)
+    complete = total is not None and len(done) >= total and not interrupted
+    return {'done': len(done), 'interrupted': interrupted, 'total': total, 'complete': complete}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Journal status')
+    parser.add_argument('--journal_dirs', type=str, nargs='+', default=None, metavar='N',
+                        help='the journal directories, or the output directories containing them. '
+                             'Accept globs, e.g. "output/chunk_*".')
+    parser.add_argument('--verbose', action='store_true',
+                        help='list the incomplete chunks and the interrupted pieces.')
+    args = parser.parse_args()
+
+    stages = {}  # {stage: {journal_dir: status}}
+    for journal_dir in find_journal_dirs(args.journal_dirs):
+        journal = Journal(journal_dir)
+        for stage in journal.stages():
+            stages.setdefault(stage, {})[journal_dir] = stage_status(journal, stage)
+
+    if not stages:
+        print('No journal found.')
+
+    for stage, chunk_statuses in sorted(stages.items()):
+        num_done = sum(s['done'] for s in chunk_statuses.values())
+        num_interrupted = sum(len(s['interrupted']) for s in chunk_statuses.values())
+        totals = [s['total'] for s in chunk_statuses.values()]
+        total = sum(totals) if None not in totals else '?'
+        num_complete = sum(s['complete'] for s in chunk_statuses.values())
+        print(f'{stage}: {num_done}/{total} pieces done, {num_interrupted} interrupted, '
+              f'{num_complete}/{len(chunk_statuses)} chunks complete')
+        if args.verbose:
+            for journal_dir, status in sorted(chunk_statuses.items()):
+                if status['complete']:
+                    continue
+                print(f'  {journal_dir}: {status["done"]}/{status["total"] or "?"} pieces done')
+                for piece in status['interrupted']:
+                    print(f'    interrupted: {piece}')
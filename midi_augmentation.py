@@ -1,83 +1,166 @@
+import io
+import functools
 import numpy as np
 from mido import MidiFile
 import pretty_midi
 import argparse
 import glob
 import os
-from tqdm import tqdm
-from utils.instrument_utils import INST_NAME_TO_MIDI_PROGRAM_DICT, get_instrument_by_part, FOUR_BACH_PARTS, \
-    AVAILABLE_ENSEMBLES
+import sys
+from utils import instrument_utils
+from utils.instrument_utils import get_instrument_by_part, FOUR_BACH_PARTS, AVAILABLE_ENSEMBLES
 from utils.file_utils import get_config
-from scipy.stats import truncnorm
 from utils.file_utils import json_dump
+from utils.parallel_utils import add_parallel_args, run_parallel
+from utils.journal_utils import add_journal_args, get_journal
+from utils.profile_utils import add_profile_args, get_profiler, profile_stage
+from utils.random_utils import add_seed_args, get_rng
 
 
-def assign_tempo(midi_file, config):
+def load_midi_with_tempo(midi_file, tempo):
+    """Load a MIDI file and set its tempo in memory, without writing a temporary MIDI file."""
     mid = MidiFile(midi_file)
-    # assign tempo
-    tempo = np.random.randint(config['min_tempo'], config['max_tempo'] + 1)
     mid.tracks[0][0].tempo = int(60 / tempo * 1000000)
-    # hack here to first save as midi file then read back using pretty_midi
-    mid.save('./tmp.mid')
-    midi = pretty_midi.PrettyMIDI('./tmp.mid')
+    try:
+        midi = pretty_midi.PrettyMIDI(mido_object=mid)
+    except TypeError:
+        # pretty_midi<0.2.10 can only read from a file, so serialize to an in-memory file instead.
+        midi_buffer = io.BytesIO()
+        mid.save(file=midi_buffer)
+        midi_buffer.seek(0)
+        midi = pretty_midi.PrettyMIDI(midi_buffer)
+    return midi
+
+
+def assign_tempo(midi_file, config, rng=None):
+    # assign tempo
+    tempo = int(np.random.default_rng(rng).integers(config['min_tempo'], config['max_tempo'] + 1))
+    midi = load_midi_with_tempo(midi_file, tempo)
     return midi
 
 
-def assign_instrument(midi, ensemble):
+def assign_instrument(midi, ensemble, rng=None):
     # assign instruments
     for i, inst in enumerate(midi.instruments):
-        instrument = get_instrument_by_part(ensemble, FOUR_BACH_PARTS[i])
-        inst.program = INST_NAME_TO_MIDI_PROGRAM_DICT[instrument]
+        instrument = get_instrument_by_part(ensemble, FOUR_BACH_PARTS[i], rng)
+        inst.program = instrument_utils.INST_NAME_TO_MIDI_PROGRAM_DICT[instrument]
     return midi
 
 
+def instrument_to_note_arrays(instrument):
+    """Convert the notes of an instrument to a dict of numpy arrays of start, end, pitch and velocity."""
+    notes = instrument.notes
+    return {
+        'start': np.array([n.start for n in notes], dtype=np.float64),
+        'end': np.array([n.end for n in notes], dtype=np.float64),
+        'pitch': np.array([n.pitch for n in notes], dtype=np.int64),
+        'velocity': np.array([n.velocity for n in notes], dtype=np.int64),
+    }
+
+
+def note_arrays_to_instrument(note_arrays, instrument):
+    """Write the note arrays back to the notes of an instrument."""
+    instrument.notes = [pretty_midi.Note(velocity=int(v), pitch=int(p), start=float(s), end=float(e))
+                        for s, e, p, v in zip(note_arrays['start'], note_arrays['end'],
+                                              note_arrays['pitch'], note_arrays['velocity'])]
+    return instrument
+
+
+def make_note_arrays_mono(note_arrays):
+    """Cut the end of each note to the start of the next note, if they overlap."""
+    note_arrays['end'][:-1] = np.minimum(note_arrays['end'][:-1], note_arrays['start'][1:])
+    return note_arrays
+
+
 def make_instrument_mono(instrument):
-    all_notes = instrument.notes
-    for i in range(len(all_notes)):
-        if i != len(all_notes) - 1:
-            if all_notes[i].end > all_notes[i + 1].start:
-                all_notes[i].end = all_notes[i + 1].start
-    instrument.notes = all_notes
-
-
-def assign_expressive_performance(midi, config):
-    for inst in midi.instruments:
-        for note in inst.notes:
-            # add expressive timing offset, sampled from truncated normal distribution.
-            clip_a = -config['expressive_timing_range_ms']
-            clip_b = config['expressive_timing_range_ms']
-            mean = config['expressive_timing_mean_ms']
-            std = config['expressive_timing_std_ms']
-
-            # sample from truncated normal distribution
-            a, b = (clip_a - mean) / std, (clip_b - mean) / std
-            timing_offset = truncnorm(a, b).rvs() * std
-
-            # convert to seconds
-            timing_offset /= 1000
-
-            note.start += timing_offset
-            note.end += timing_offset
+    note_arrays = make_note_arrays_mono(instrument_to_note_arrays(instrument))
+    note_arrays_to_instrument(note_arrays, instrument)
+
+
+def sample_expressive_timing(num_notes, config, rng=None):
+    """Sample the expressive timing offset (in seconds) of num_notes notes from a truncated normal distribution."""
+    from scipy.stats import truncnorm
+    clip_a = -config['expressive_timing_range_ms']
+    clip_b = config['expressive_timing_range_ms']
+    mean = config['expressive_timing_mean_ms']
+    std = config['expressive_timing_std_ms']
+
+    # sample from truncated normal distribution
+    a, b = (clip_a - mean) / std, (clip_b - mean) / std
+    timing_offset = truncnorm(a, b).rvs(size=num_notes, random_state=np.random.default_rng(rng)) * std
+
+    # convert to seconds
+    return timing_offset / 1000
+
+
+def assign_expressive_performance(midi, config, rng=None):
+    all_note_arrays = [instrument_to_note_arrays(inst) for inst in midi.instruments]
+    num_notes = [len(note_arrays['start']) for note_arrays in all_note_arrays]
+    # add expressive timing offset to all the notes of all the parts at once.
+    timing_offset = np.split(sample_expressive_timing(sum(num_notes), config, rng), np.cumsum(num_notes)[:-1])
+    for inst, note_arrays, offset in zip(midi.instruments, all_note_arrays, timing_offset):
+        note_arrays['start'] += offset
+        note_arrays['end'] += offset
         # postprocess notes to make instrument mono
-        make_instrument_mono(inst)
+        make_note_arrays_mono(note_arrays)
+        note_arrays_to_instrument(note_arrays, inst)
     return midi
 
 
-def midi_augmentation(file_path, ensemble, output_dir, config):
-    midi = assign_tempo(file_path, config)
-    midi = assign_instrument(midi, ensemble)
-    midi = assign_expressive_performance(midi, config)
-    midi.write(os.path.join(output_dir, os.path.basename(file_path)))
-
-
-def generate_split(ensemble_midi_files):
+def midi_augmentation(file_path, ensemble, output_dir, config, rng=None):
+    rng = np.random.default_rng(rng)
+    with profile_stage('load'):
+        midi = assign_tempo(file_path, config, rng)
+    with profile_stage('augment'):
+        midi = assign_instrument(midi, ensemble, rng)
+        midi = assign_expressive_performance(midi, config, rng)
+    with profile_stage('write'):
+        midi.write(os.path.join(output_dir, os.path.basename(file_path)))
+
+
+def _journal_key(file_path, ensemble):
+    return f'{ensemble}/{os.path.basename(file_path)}'
+
+
+def _midi_augmentation_with_seed(file_path, ensemble, output_dir, config, seed):
+    # the random generator of a file only depends on the seed and the file, not on how the files are scheduled.
+    rng = get_rng(seed, 'midi_augmentation', _journal_key(file_path, ensemble))
+    midi_augmentation(file_path, ensemble, output_dir, config, rng)
+
+
+def midi_augmentation_batch(file_paths, ensemble, output_dir, config, num_workers=1, chunksize=1, seed=None,
+                            journal=None, ignore_journal=False, profiler=None, record_total=True):
+    """Augment a list of MIDI files with a pool of num_workers processes.
+    Each file is augmented with its own random generator derived from seed and the file, so that the output for a
+    given seed does not depend on the number of workers, nor on the files skipped by a resumed run.
+    Returns the list of failed files.
+    If journal is given, the files it records as done are skipped, and the number of files is recorded as the total of
+    the stage unless record_total is False. If profiler is given, each file is profiled."""
+    process_fn = functools.partial(_midi_augmentation_with_seed, ensemble=ensemble, output_dir=output_dir,
+                                   config=config, seed=seed)
+    key = functools.partial(_journal_key, ensemble=ensemble)
+    if journal is not None:
+        file_paths = journal.pending('midi_augmentation', file_paths, key=key, ignore_journal=ignore_journal,
+                                     record_total=record_total)
+        process_fn = journal.wrap('midi_augmentation', process_fn, key=key)
+    if profiler is not None:
+        process_fn = profiler.wrap(process_fn, key=key)
+    failures = run_parallel(process_fn,
+                            file_paths,
+                            num_workers=num_workers,
+                            chunksize=chunksize,
+                            desc=ensemble)
+    return [file_path for file_path, _ in failures]
+
+
+def generate_split(ensemble_midi_files, rng=None):
     """Split the midi files into train, val, test"""
     split = {}
     split_name = ['train', 'valid', 'test']
     split_portion = [0.8, 0.1, 0.1]
     midi_filenames = [os.path.basename(f) for f in ensemble_midi_files]
     # split midis to train/valid/test by 0.8/0.1/0.1
-    np.random.shuffle(midi_filenames)
+    np.random.default_rng(rng).shuffle(midi_filenames)
     idx = 0
     for name, portion in zip(split_name, split_portion):
         file_num = int(portion * len(midi_filenames))
@@ -95,25 +178,52 @@ if __name__ == '__main__':
                         help='the directory for outputting the augmented MIDI files.')
     parser.add_argument('--num_tracks_each_ensemble', type=int, default=60000, metavar='N',
                         help='the number of tracks for each ensemble.')
+    add_seed_args(parser)
+    add_parallel_args(parser)
+    add_journal_args(parser)
+    add_profile_args(parser)
     args = parser.parse_args()
 
     config = get_config()
 
-    midi_file_list = glob.glob(f'{args.midi_dir}/*.mid')
-    np.random.shuffle(midi_file_list)
+    midi_file_list = sorted(glob.glob(f'{args.midi_dir}/*.mid'))
+    get_rng(args.seed, 'midi_augmentation', 'ensembles').shuffle(midi_file_list)
 
     os.makedirs(args.output_dir, exist_ok=True)
     split_json_save_dir = os.path.join(args.output_dir, 'split')
     os.makedirs(split_json_save_dir, exist_ok=True)
 
-    file_idx = 0
+    journal = get_journal(args, args.output_dir)
+    profiler = get_profiler(args, 'midi_augmentation', args.output_dir)
+
+    ensemble_midi_files_all = {ensemble: midi_file_list[i * args.num_tracks_each_ensemble:
+                                                        (i + 1) * args.num_tracks_each_ensemble]
+                               for i, ensemble in enumerate(AVAILABLE_ENSEMBLES)}
+    # the total of the stage covers all the ensembles, each batch only filters its files.
+    journal.set_total('midi_augmentation', sum(len(files) for files in ensemble_midi_files_all.values()))
+
+    num_failures = 0
     for ensemble in AVAILABLE_ENSEMBLES:
-        ensemble_midi_files = midi_file_list[file_idx:file_idx + args.num_tracks_each_ensemble]
-        for midi_file in tqdm(ensemble_midi_files):
-            output_dir = os.path.join(args.output_dir, ensemble)
-            os.makedirs(output_dir, exist_ok=True)
-            midi_augmentation(midi_file, ensemble, output_dir, config)
-        split_json = generate_split(ensemble_midi_files)
+        ensemble_midi_files = ensemble_midi_files_all[ensemble]
+        output_dir = os.path.join(args.output_dir, ensemble)
+        os.makedirs(output_dir, exist_ok=True)
+        failed_files = midi_augmentation_batch(ensemble_midi_files, ensemble, output_dir, config,
+                                               num_workers=args.num_workers,
+                                               chunksize=args.chunksize,
+                                               seed=args.seed,
+                                               journal=journal,
+                                               ignore_journal=args.ignore_journal,
+                                               profiler=profiler,
+                                               record_total=False)
+        if failed_files:
+            # the split is written by the run augmenting all the files, so that it only lists augmented files and
+            # is the same as in a run without failures.
+            print(f'Not writing the split of {ensemble}: {len(failed_files)} files failed.')
+            num_failures += len(failed_files)
+            continue
+        split_json = generate_split(ensemble_midi_files, get_rng(args.seed, 'midi_augmentation', 'split', ensemble))
         split_json_save_path = os.path.join(split_json_save_dir, f'{ensemble}_split.json')
         json_dump(split_json, split_json_save_path)
-        file_idx += args.num_tracks_each_ensemble
+    profiler.summarize()
+    if num_failures:
+        sys.exit(1)
@@ -0,0 +1,96 @@
+"""
+Plan length-bucketed batches and balanced chunks from the MIDI files augmented by midi_augmentation.py,
+and report the padding saved compared to batching and chunking the pieces in the order of their names.
+See utils/plan_utils.py for the manifest.
+"""
+
+import os
+import glob
+import argparse
+import multiprocessing
+from tqdm import tqdm
+
+from utils.instrument_utils import AVAILABLE_ENSEMBLES
+from utils.plan_utils import FRAME_RATE, midi_num_frames, make_manifest, save_manifest, padded_cost, padding_waste
+
+
+def read_num_frames(midi_files, num_workers=1):
+    """The number of frames of each MIDI file, read by num_workers processes."""
+    if num_workers <= 1:
+        return [midi_num_frames(f) for f in tqdm(midi_files)]
+    with multiprocessing.Pool(num_workers) as pool:
+        num_frames = list(tqdm(pool.imap(midi_num_frames, midi_files, chunksize=64), total=len(midi_files)))
+        pool.close()
+    return num_frames
+
+
+def unplanned_batches_and_chunks(ensemble_pieces, batch_size, num_chunks):
+    """The batches and chunks obtained without planning: the pieces of each ensemble in the order of their names,
+    cut into consecutive batches, and the batches cut into chunks of the same number of pieces."""
+    batches = []
+    for pieces in ensemble_pieces.values():
+        pieces = sorted(pieces)
+        batches += [[frames for _, frames in pieces[i:i + batch_size]] for i in range(0, len(pieces), batch_size)]
+    chunk_size = -(-len(batches) // num_chunks)
+    chunk_costs = [sum(padded_cost(frames) for frames in batches[i:i + chunk_size])
+                   for i in range(0, len(batches), chunk_size)]
+    return batches, chunk_costs
+
+
+def print_report(manifest, ensemble_pieces, num_chunks):
+    num_pieces = sum(len(pieces) for pieces in ensemble_pieces.values())
+    num_frames = sum(frames for pieces in ensemble_pieces.values() for _, frames in pieces)
+    print(f'{num_pieces} pieces, {num_frames / FRAME_RATE / 3600:.1f} hours, '
+          f'{len(manifest["batches"])} batches of up to {manifest["batch_size"]} pieces, {num_chunks} chunks.')
+
+    batches, chunk_costs = unplanned_batches_and_chunks(ensemble_pieces, manifest['batch_size'], num_chunks)
+    planned_batches = [batch['frames'] for batch in manifest['batches']]
+    planned_chunk_costs = [chunk['cost'] for chunk in manifest['chunks']]
+    for name, batches_frames, costs in [('in name order', batches, chunk_costs),
+                                        ('planned', planned_batches, planned_chunk_costs)]:
+        total_cost = sum(padded_cost(frames) for frames in batches_frames)
+        print(f'{name:>13}: {total_cost / FRAME_RATE / 3600:.1f} hours computed, '
+              f'{padding_waste(batches_frames):.1%} padding, '
+              f'longest chunk {max(costs) / (total_cost / num_chunks):.2f}x the mean chunk')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Plan batches')
+    parser.add_argument('--midi_dir', type=str, default=None, metavar='N',
+                        help='the directory of the MIDI files augmented by midi_augmentation.py.')
+    parser.add_argument('--manifest', type=str, default=None, metavar='N',
+                        help='the path of the manifest to write. If not provided, only print the report.')
+    parser.add_argument('--ensembles', type=str, nargs='+', default=AVAILABLE_ENSEMBLES, choices=AVAILABLE_ENSEMBLES,
+                        help='the ensembles to plan.')
+    parser.add_argument('--batch_size', type=int, default=8, metavar='N',
+                        help='the number of pieces in each batch.')
+    parser.add_argument('--num_chunks', type=int, default=256, metavar='N',
+                        help='the number of chunks.')
+    parser.add_argument('--chunk_midi_dir', type=str, default=None, metavar='N',
+                        help='if provided, link the MIDI files of chunk k to <chunk_midi_dir>/<k>/<ensemble>, '
+                             'to be synthesized by midi_ddsp_synthesize --midi_dir.')
+    parser.add_argument('--num_workers', type=int, default=1, metavar='N',
+                        help='the number of processes reading the MIDI files.')
+    args = parser.parse_args()
+
+    ensemble_pieces = {}
+    for ensemble in args.ensembles:
+        midi_files = sorted(glob.glob(os.path.join(args.midi_dir, ensemble, '*.mid')))
+        names = [os.path.splitext(os.path.basename(f))[0] for f in midi_files]
+        ensemble_pieces[ensemble] = list(zip(names, read_num_frames(midi_files, args.num_workers)))
+
+    manifest = make_manifest(args.midi_dir, ensemble_pieces, args.batch_size, args.num_chunks)
+    print_report(manifest, ensemble_pieces, args.num_chunks)
+    if args.manifest:
+        save_manifest(manifest, args.manifest)
+
+    if args.chunk_midi_dir:
+        for chunk_idx, chunk in enumerate(manifest['chunks']):
+            for batch_idx in chunk['batches']:
+                batch = manifest['batches'][batch_idx]
+                ensemble_dir = os.path.join(args.chunk_midi_dir, str(chunk_idx), batch['ensemble'])
+                os.makedirs(ensemble_dir, exist_ok=True)
+                for name in batch['pieces']:
+                    link_path = os.path.join(ensemble_dir, f'{name}.mid')
+                    if not os.path.lexists(link_path):
+                        os.symlink(os.path.join(manifest['midi_dir'], batch['ensemble'], f'{name}.mid'), link_path)
@@ -0,0 +1,286 @@
+"""
+Distribute the generation over workers pulling small batches of MIDI files from a shared queue, instead of splitting
+the MIDI files into fixed chunks. Faster workers take more batches, and the batch of a worker that crashed or was
+preempted is reassigned once its lease expires, so only that batch is regenerated.
+
+Each batch is processed in its own task directory under --work_dir by running the steps (--commands) one after
+another, and the synthesized pieces are then moved to <output_dir>/<ensemble>/<piece>, the layout read by
+data_postprocess/postprocess_cocochorales.py. See utils/queue_utils.py for the queue.
+
+  python scheduler.py init --queue ./queue.db --midi_dir ./cocochorales_midi --output_dir ./synthesized_midi
+  python scheduler.py work --queue ./queue.db --work_dir ./tasks --output_dir ./synthesized_midi --num_workers 4
+  python scheduler.py status --queue ./queue.db
+"""
+
+import os
+import sys
+import glob
+import time
+import shutil
+import argparse
+import threading
+import traceback
+import subprocess
+import multiprocessing
+
+from utils.instrument_utils import AVAILABLE_ENSEMBLES
+from utils.queue_utils import LeaseQueue, get_worker_name, LEASED
+from utils.plan_utils import load_manifest, manifest_batches
+
+REPO_DIR = os.path.dirname(os.path.realpath(__file__))
+# {midi_dir} holds the MIDI files of the batch, the steps write the pieces to {synthesis_dir}, and their journal and
+# profile to {task_dir}, as only the pieces are published.
+DEFAULT_COMMANDS = [
+    'midi_ddsp_synthesize --midi_dir {midi_dir} --output_dir {synthesis_dir} --skip_existing_files --save_metadata',
+    '{python} audio_mixing.py --multi_synthesis_dir {synthesis_dir} '
+    '--journal_dir {task_dir}/.journal --profile_dir {task_dir}/.profile',
+]
+LOG_TAIL_SIZE = 4000
+
+
+def piece_name(midi_file):
+    return os.path.splitext(os.path.basename(midi_file))[0]
+
+
+def list_batches(midi_dir, ensembles, batch_size):
+    """Cut the MIDI files of each ensemble, in the order of their names, into batches of batch_size files.
+    Returns [(ensemble, MIDI files)]."""
+    batches = []
+    for ensemble in ensembles:
+        midi_files = sorted(glob.glob(os.path.join(midi_dir, ensemble, '*.mid')))
+        batches += [(ensemble, midi_files[i:i + batch_size]) for i in range(0, len(midi_files), batch_size)]
+    return batches
+
+
+def list_planned_batches(manifest_path, ensembles):
+    """The batches of pieces of similar length planned by plan_batches.py, longest first."""
+    manifest = load_manifest(manifest_path)
+    return [(batch['ensemble'], [os.path.join(manifest['midi_dir'], batch['ensemble'], f'{name}.mid')
+                                 for name in batch['pieces']])
+            for batch in manifest_batches(manifest) if batch['ensemble'] in ensembles]
+
+
+def init_queue(queue, batches, output_dir, max_attempts):
+    """Add the batches of MIDI files, given as [(ensemble, MIDI files)], to the queue.
+    The pieces already in output_dir are not added."""
+    tasks = []
+    num_existing = 0
+    for ensemble, midi_files in batches:
+        if output_dir is not None:
+            pending_files = [f for f in midi_files
+                             if not os.path.isdir(os.path.join(output_dir, ensemble, piece_name(f)))]
+            num_existing += len(midi_files) - len(pending_files)
+            midi_files = pending_files
+        if midi_files:
+            batch = [os.path.abspath(f) for f in midi_files]
+            # the name only depends on the first piece, so that adding the same files again adds no task.
+            tasks.append((f'{ensemble}_{piece_name(batch[0])}', {'ensemble': ensemble, 'midi_files': batch}))
+    num_added = queue.add_tasks(tasks, max_attempts=max_attempts)
+    print(f'Added {num_added} tasks ({len(tasks) - num_added} already queued, '
+          f'{num_existing} pieces already in the output directory).')
+
+
+def _heartbeat(queue_path, task_id, worker, lease_seconds, stop, lost):
+    """Renew the lease of a task until stop is set, and set lost if the lease was lost."""
+    queue = LeaseQueue(queue_path)
+    try:
+        while not stop.wait(lease_seconds / 3):
+            if not queue.renew(task_id, worker, lease_seconds):
+                lost.set()
+                return
+    finally:
+        queue.close()
+
+
+def _log_tail(log_path):
+    with open(log_path, 'r', errors='replace') as f:
+        f.seek(max(0, os.path.getsize(log_path) - LOG_TAIL_SIZE))
+        tail = f.read()
+        f.close()
+    return tail
+
+
+def run_commands(commands, task_dir, payload, lost):
+    """Run the steps of a task. Returns None on success, else the error."""
+    midi_dir = os.path.join(task_dir, 'midi')
+    synthesis_dir = os.path.join(task_dir, 'synthesis')
+    os.makedirs(midi_dir)
+    os.makedirs(synthesis_dir)
+    for midi_file in payload['midi_files']:
+        os.symlink(midi_file, os.path.join(midi_dir, os.path.basename(midi_file)))
+
+    log_path = os.path.join(task_dir, 'log.txt')
+    for command in commands:
+        command = command.format(python=sys.executable, midi_dir=midi_dir, synthesis_dir=synthesis_dir,
+                                 task_dir=task_dir)
+        with open(log_path, 'a') as log:
+            log.write(f'$ {command}\n')
+            log.flush()
+            # the stage scripts read augment_config.yaml from the working directory
+            process = subprocess.Popen(command, shell=True, cwd=REPO_DIR, stdout=log, stderr=subprocess.STDOUT)
+            while True:
+                try:
+                    return_code = process.wait(timeout=1)
+                    break
+                except subprocess.TimeoutExpired:
+                    if lost.is_set():
+                        process.kill()
+                        process.wait()
+                        return 'lease lost'
+            log.close()
+        if return_code != 0:
+            return f'{command} exited with code {return_code}:\n{_log_tail(log_path)}'
+    return None
+
+
+def publish_pieces(synthesis_dir, output_dir, ensemble):
+    """Move the pieces synthesized by a task to <output_dir>/<ensemble>/<piece>, replacing any previous output.
+    Only the piece directories are moved, not the files and hidden directories the steps may have left, e.g. a journal
+    or profile written next to the pieces."""
+    ensemble_dir = os.path.join(output_dir, ensemble)
+    os.makedirs(ensemble_dir, exist_ok=True)
+    for piece in os.listdir(synthesis_dir):
+        if piece.startswith('.') or not os.path.isdir(os.path.join(synthesis_dir, piece)):
+            continue
+        target_dir = os.path.join(ensemble_dir, piece)
+        if os.path.isdir(target_dir):
+            shutil.rmtree(target_dir)
+        os.replace(os.path.join(synthesis_dir, piece), target_dir)
+
+
+def process_task(queue, task, args, worker):
+    """Process a leased task and complete it. Returns True if the task is done."""
+    task_id, name, payload, attempt = task
+    # a new directory for each attempt, a worker that lost its lease may still be writing to the previous one.
+    task_dir = os.path.join(args.work_dir, f'{name}.{attempt}')
+    shutil.rmtree(task_dir, ignore_errors=True)
+    stop, lost = threading.Event(), threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(args.queue, task_id, worker, args.lease_seconds, stop, lost),
+                                 daemon=True)
+    heartbeat.start()
+    start = time.time()
+    try:
+        error = run_commands(args.commands, task_dir, payload, lost)
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        stop.set()
+        heartbeat.join()
+
+    if error is None:
+        done = queue.complete(task_id, worker, commit_func=lambda: publish_pieces(
+            os.path.join(task_dir, 'synthesis'), args.output_dir, payload['ensemble']))
+        if done:
+            shutil.rmtree(task_dir, ignore_errors=True)
+            print(f'[{worker}] {name}: done in {time.time() - start:.1f}s.')
+        else:
+            print(f'[{worker}] {name}: lease lost, discarding the output.')
+        return done
+    print(f'[{worker}] {name}: attempt {attempt} failed, see {task_dir}/log.txt\n{error}')
+    queue.fail(task_id, worker, error)
+    return False
+
+
+def work(args):
+    """Lease and process tasks until none is left. While other workers hold leases, wait in case they expire."""
+    worker = get_worker_name()
+    queue = LeaseQueue(args.queue)
+    num_done = 0
+    try:
+        while args.max_tasks is None or num_done < args.max_tasks:
+            task = queue.lease(worker, args.lease_seconds)
+            if task is None:
+                if queue.counts()[LEASED] == 0:
+                    break
+                time.sleep(args.poll_seconds)
+                continue
+            num_done += process_task(queue, task, args, worker)
+    finally:
+        queue.close()
+    print(f'[{worker}] finished, {num_done} tasks done.')
+
+
+def print_status(queue):
+    counts = queue.counts()
+    total = sum(counts.values())
+    print(', '.join(f'{count}/{total} {status}' for status, count in counts.items()))
+    for worker, (num_done, mean_time) in queue.worker_stats().items():
+        print(f'  {worker}: {num_done} tasks done, {mean_time:.1f}s per task')
+    for name, attempts, error in queue.failed_tasks():
+        last_line = (error or '').strip().splitlines()[-1:] or ['']
+        print(f'  failed: {name} after {attempts} attempts: {last_line[0]}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scheduler')
+    subparsers = parser.add_subparsers(dest='action', required=True)
+
+    init_parser = subparsers.add_parser('init', help='add the MIDI files to the queue.')
+    init_parser.add_argument('--midi_dir', type=str, default=None, metavar='N',
+                             help='the directory containing the MIDI files of each ensemble.')
+    init_parser.add_argument('--manifest', type=str, default=None, metavar='N',
+                             help='queue the batches of pieces of similar length planned by plan_batches.py '
+                                  'instead of the MIDI files of midi_dir.')
+    init_parser.add_argument('--output_dir', type=str, default=None, metavar='N',
+                             help='the directory for the synthesized pieces. The pieces already there are skipped.')
+    init_parser.add_argument('--ensembles', type=str, nargs='+', default=AVAILABLE_ENSEMBLES,
+                             choices=AVAILABLE_ENSEMBLES, help='the ensembles to add.')
+    init_parser.add_argument('--batch_size', type=int, default=8, metavar='N',
+                             help='the number of MIDI files in each task, without --manifest.')
+    init_parser.add_argument('--max_attempts', type=int, default=3, metavar='N',
+                             help='the number of times a task is leased before it is marked as failed.')
+
+    work_parser = subparsers.add_parser('work', help='process tasks until the queue is empty.')
+    work_parser.add_argument('--work_dir', type=str, default=None, metavar='N', required=True,
+                             help='the directory for the task directories, where the steps write their output.')
+    work_parser.add_argument('--output_dir', type=str, default=None, metavar='N', required=True,
+                             help='the directory the synthesized pieces are moved to once a task is done.')
+    work_parser.add_argument('--commands', type=str, nargs='+', default=DEFAULT_COMMANDS, metavar='N',
+                             help='the steps run on each task, in order. {python}, {midi_dir}, {synthesis_dir} and '
+                                  '{task_dir} are replaced by the python executable, the directory of the MIDI files '
+                                  'of the task, the directory for the synthesized pieces and the task directory, e.g. '
+                                  'for the journal and profile of the steps.')
+    work_parser.add_argument('--num_workers', type=int, default=1, metavar='N',
+                             help='the number of worker processes to run on this machine.')
+    work_parser.add_argument('--lease_seconds', type=float, default=600, metavar='N',
+                             help='the duration of a lease, renewed every third of it while the task runs.')
+    work_parser.add_argument('--poll_seconds', type=float, default=30, metavar='N',
+                             help='how often an idle worker checks for expired leases.')
+    work_parser.add_argument('--max_tasks', type=int, default=None, metavar='N',
+                             help='the number of tasks each worker does before exiting.')
+
+    subparsers.add_parser('status', help='print the progress of the queue.')
+    subparsers.add_parser('requeue', help='put the failed tasks back in the queue.')
+    for subparser in subparsers.choices.values():
+        subparser.add_argument('--queue', type=str, default=None, metavar='N', required=True,
+                               help='the path of the queue database.')
+    args = parser.parse_args()
+
+    if args.action == 'init':
+        if args.manifest:
+            batches = list_planned_batches(args.manifest, args.ensembles)
+        elif args.midi_dir:
+            batches = list_batches(args.midi_dir, args.ensembles, args.batch_size)
+        else:
+            raise ValueError('Please specify either midi_dir or manifest.')
+        queue = LeaseQueue(args.queue)
+        init_queue(queue, batches, args.output_dir, args.max_attempts)
+        print_status(queue)
+    elif args.action == 'work':
+        args.work_dir, args.output_dir = os.path.abspath(args.work_dir), os.path.abspath(args.output_dir)
+        os.makedirs(args.work_dir, exist_ok=True)
+        LeaseQueue(args.queue).close()  # create the tables before the workers start
+        if args.num_workers <= 1:
+            work(args)
+        else:
+            workers = [multiprocessing.Process(target=work, args=(args,)) for _ in range(args.num_workers)]
+            for worker_process in workers:
+                worker_process.start()
+            for worker_process in workers:
+                worker_process.join()
+        print_status(LeaseQueue(args.queue))
+    elif args.action == 'status':
+        print_status(LeaseQueue(args.queue))
+    elif args.action == 'requeue':
+        queue = LeaseQueue(args.queue)
+        print(f'Requeued {queue.requeue()} tasks.')
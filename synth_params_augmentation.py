@@ -1,82 +1,145 @@
 """Manipulate synthesis parameters"""
 
 import glob
+import functools
+import traceback
 import argparse
-from tqdm import tqdm
 import os
+import sys
 import numpy as np
-import tensorflow as tf
-import ddsp.training
-from ddsp.core import midi_to_hz
 
 from utils.metadata_utils import load_metadata
 from utils.file_utils import get_config
-from midi_ddsp.utils.audio_io import save_wav
-from midi_ddsp.utils.inference_utils import ensure_same_length
-from midi_ddsp.modules.interpretable_conditioning import get_pitch_deviation
-from midi_ddsp.utils.inference_utils import conditioning_df_to_midi_features, to_length
-from midi_ddsp.utils.inference_utils import get_process_group
-from midi_ddsp.midi_ddsp_synthesize import load_pretrained_model
-from utils.file_utils import pickle_load, pickle_dump
+from utils.model_utils import add_model_args, get_synthesis_generator, get_worker_model_kwargs
+from utils.parallel_utils import add_parallel_args, run_parallel
+from utils.plan_utils import add_manifest_args, get_planned_synthesis_dirs
+from utils.journal_utils import add_journal_args, get_journal, piece_key
+from utils.file_utils import pickle_dump
+from utils.profile_utils import add_profile_args, get_profiler, profile_stage, batch_key
+from utils.random_utils import add_seed_args, get_rng
 
-# Load pre-trained model
-synthesis_generator, expression_generator = load_pretrained_model()
+JOURNAL_STAGE = 'synth_params_augmentation'
+
+
+def expand_note_values(values, conditioning_df, total_length):
+    """Expand note-wise values to frame-wise values, where each note covers the frames [onset, offset].
+    Where two notes cover the same frame, the later note in conditioning_df takes the frame."""
+    onsets = conditioning_df['onset'].to_numpy().astype(np.int64)
+    offsets = conditioning_df['offset'].to_numpy().astype(np.int64)
+    starts = np.minimum(onsets, total_length)
+    lengths = np.maximum(np.minimum(offsets + 1, total_length) - starts, 0)
+
+    # index of the note and of the frame, for every frame covered by every note.
+    note_idx = np.repeat(np.arange(len(lengths)), lengths)
+    frame_idx = np.arange(lengths.sum()) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    last_note_idx = np.full(total_length, -1, dtype=np.int64)
+    np.maximum.at(last_note_idx, frame_idx, note_idx)
+
+    values = np.asarray(values)
+    return np.where(last_note_idx >= 0, values[np.maximum(last_note_idx, 0)], 0)
 
 
 def expand_intonation_aug_coefficient(coefficient, conditioning_df):
     """Expand note-wise intonation augmentation coefficient to frame-wise"""
     total_length = conditioning_df.tail(1)['offset'].values[0]
-    coefficient_frame_wise = np.zeros((1, total_length, 1), dtype=np.float32)
-    for i, note in conditioning_df.iterrows():
-        on = int(note['onset'])
-        off = int(note['offset'])
-        coefficient_frame_wise[:, on:off + 1, :] = coefficient[i]
-    return coefficient_frame_wise
+    coefficient = np.asarray(coefficient)[conditioning_df.index.to_numpy()]
+    coefficient_frame_wise = expand_note_values(coefficient, conditioning_df, total_length)
+    return coefficient_frame_wise.astype(np.float32)[np.newaxis, :, np.newaxis]
 
 
-def intonation_augmentation(synthesis_parameters, conditioning_df_all, config):
+def intonation_augmentation(synthesis_parameters, conditioning_df_all, config, rng=None):
     """Random amount of pitch correction"""
+    import tensorflow as tf
+    import ddsp.training
+    from ddsp.core import midi_to_hz
+
+    rng = np.random.default_rng(rng)
+    # f0 of all parts, padded to the maximum length during synthesis.
+    f0_ori = synthesis_parameters['f0_hz']
+    num_parts = len(conditioning_df_all)
+    max_length = f0_ori.shape[1]
 
-    f0_new_all = []
+    # Build the frame-wise MIDI pitch, onsets and pitch correction amount (\alpha in eq.1 of the paper) of all parts
+    # as one padded batch. Different parts have different midi length,
+    # so here we need to keep track of the original length for each part.
+    q_pitch = np.zeros((num_parts, max_length, 1), dtype=np.float32)
+    onsets = np.zeros((num_parts, max_length), dtype=np.int64)
+    correction_amount = np.zeros((num_parts, max_length, 1), dtype=np.float32)
+    part_lengths = np.zeros(num_parts, dtype=np.int64)
     correction_amount_all = {}
-    max_length = synthesis_parameters['f0_hz'][0].shape[0]
     for i, conditioning_df in enumerate(conditioning_df_all):
-        f0_ori = synthesis_parameters['f0_hz'][i][tf.newaxis, ...]
-        midi_features = conditioning_df_to_midi_features(conditioning_df)
-        q_pitch, q_vel, f0_loss_weights, onsets, offsets = midi_features
+        midi_length = conditioning_df.tail(1)['offset'].values[0]
+        part_length = min(midi_length, max_length)
+        part_lengths[i] = part_length
+        q_pitch[i, :part_length, 0] = expand_note_values(conditioning_df['pitch'].to_numpy(), conditioning_df,
+                                                         midi_length)[:part_length]
+        note_onsets = conditioning_df['onset'].to_numpy().astype(np.int64)
+        onsets[i, note_onsets[note_onsets < part_length]] = 1
 
-        # Different parts have different midi length, but during synthesis,
-        # all f0s are padded to the maximum length.
-        # So here we need to take the f0's original length for each part.
-        f0_ori = f0_ori[:, :q_pitch.shape[1], :]
-        f0_midi = midi_to_hz(q_pitch, midi_zero_silence=True)
+        num_notes = len(conditioning_df.index)
+        correction_amount_note_wise = rng.uniform(config['min_pitch_correction'], config['max_pitch_correction'],
+                                                  size=num_notes)
+        correction_amount[i, :part_length] = expand_intonation_aug_coefficient(correction_amount_note_wise,
+                                                                               conditioning_df)[0, :part_length]
+        correction_amount_all[i] = correction_amount_note_wise.tolist()
 
-        # Get pitch deviation in Hz scale
-        pitch_deviation = f0_ori - f0_midi
+    f0_midi = midi_to_hz(q_pitch, midi_zero_silence=True)
 
-        # Get the note mask and calculate the average pitch deviation across notex
-        note_mask = ddsp.training.nn.get_note_mask_from_onset(q_pitch, onsets)
-        pv_mean = ddsp.training.nn.pool_over_notes(pitch_deviation, note_mask, return_std=False)
+    # Get pitch deviation in Hz scale
+    pitch_deviation = f0_ori - f0_midi
 
-        # Get the frame-wise pitch correction amount (\alpha in eq.1 of the paper)
-        num_notes = len(conditioning_df.index)
-        correction_amount_note_wise = np.random.uniform(config['min_pitch_correction'], config['max_pitch_correction'],
-                                                        size=num_notes)
-        correction_amount = expand_intonation_aug_coefficient(correction_amount_note_wise, conditioning_df)
-        correction_amount = to_length(correction_amount, dst_length=f0_ori.shape[1], axis=1)
-
-        f0_corrected = f0_ori - correction_amount * pv_mean
-        # we do not apply pitch correction on silence notes.
-        f0_corrected = tf.where(q_pitch != 0, f0_corrected, f0_ori)
-        f0_corrected = to_length(f0_corrected, dst_length=max_length, axis=1)  # pad f0 to max_length
-        f0_new_all.append(f0_corrected)
-        correction_amount_all[i] = correction_amount_note_wise.tolist()
+    # Get the note mask and calculate the average pitch deviation across notes.
+    # Padded frames have zero pitch, so they are not part of any note.
+    note_mask = ddsp.training.nn.get_note_mask_from_onset(q_pitch, onsets)
+    pv_mean = ddsp.training.nn.pool_over_notes(pitch_deviation, note_mask, return_std=False)
 
-    synthesis_parameters['f0_hz'] = tf.concat(f0_new_all, axis=0)
+    f0_corrected = f0_ori - correction_amount * pv_mean
+    # we do not apply pitch correction on silence notes.
+    f0_corrected = tf.where(q_pitch != 0, f0_corrected, f0_ori)
+    # f0 after the length of each part is padded with 0.
+    in_part = np.arange(max_length)[np.newaxis, :, np.newaxis] < part_lengths[:, np.newaxis, np.newaxis]
+    f0_corrected = tf.where(in_part, f0_corrected, tf.zeros_like(f0_corrected))
+
+    synthesis_parameters['f0_hz'] = f0_corrected
     return synthesis_parameters, correction_amount_all
 
 
-def synth_params_augmentation(data_dir, output_dir, config):
+def synth_params_to_audio(synthesis_generator, synthesis_parameters, instrument_id):
+    """Synthesize the audio of all the parts from the synthesis parameters using DDSP."""
+    from midi_ddsp.utils.inference_utils import get_process_group
+    with profile_stage('synthesis'):
+        processor_group = get_process_group(synthesis_parameters['amplitudes'].shape[1], use_angular_cumsum=True)
+        midi_audio = processor_group(synthesis_parameters, verbose=False)
+        midi_audio = synthesis_generator.reverb_module(midi_audio, reverb_number=instrument_id, training=False)
+    return midi_audio
+
+
+def load_and_augment_synth_params(data_dir, config, seed=None):
+    """Load the metadata of a piece and apply the intonation augmentation to its synthesis parameters."""
+    with profile_stage('load'):
+        pickle_path = os.path.join(data_dir, 'metadata.pickle')
+        instrument, conditioning_df_all, synthesis_parameters, residual_metadata = load_metadata(pickle_path)
+    instrument_id_all, instrument_name_all = instrument
+
+    with profile_stage('intonation'):
+        synthesis_parameters, correction_amount_all = intonation_augmentation(
+            synthesis_parameters, conditioning_df_all, config, get_rng(seed, JOURNAL_STAGE, piece_key(data_dir)))
+    return {
+        'data_dir': data_dir,
+        'instrument_id_all': instrument_id_all,
+        'instrument_name_all': instrument_name_all,
+        'conditioning_df_all': conditioning_df_all,
+        'synthesis_parameters': synthesis_parameters,
+        'correction_amount_all': correction_amount_all,
+        'residual_metadata': residual_metadata,
+    }
+
+
+def save_synth_params_augmentation(piece, midi_audio, output_dir, config):
+    """Save the re-synthesized audio and the metadata of a piece."""
+    from utils.audio_utils import save_wav
+    from midi_ddsp.utils.inference_utils import ensure_same_length
+    data_dir = piece['data_dir']
     # if output_dir is provided, then save to the output_dir.
     if output_dir:
         output_dir = os.path.join(output_dir, os.path.basename(data_dir))
@@ -84,19 +147,9 @@ def synth_params_augmentation(data_dir, output_dir, config):
     else:  # else, change in place
         output_dir = data_dir
 
-    # load metadata
-    pickle_path = os.path.join(data_dir, 'metadata.pickle')
-    instrument, conditioning_df_all, synthesis_parameters, residual_metadata = load_metadata(pickle_path)
-    instrument_id_all, instrument_name_all = instrument
-    instrument_id = tf.concat(instrument_id_all, 0)
-
-    synthesis_parameters, correction_amount_all = intonation_augmentation(synthesis_parameters, conditioning_df_all,
-                                                                          config)
-
-    # Re synthesize the audio using DDSP
-    processor_group = get_process_group(synthesis_parameters['amplitudes'].shape[1], use_angular_cumsum=True)
-    midi_audio = processor_group(synthesis_parameters, verbose=False)
-    midi_audio = synthesis_generator.reverb_module(midi_audio, reverb_number=instrument_id, training=False)
+    instrument_id_all = piece['instrument_id_all']
+    conditioning_df_all = piece['conditioning_df_all']
+    synthesis_parameters = piece['synthesis_parameters']
 
     midi_audio_mix = np.sum(
         np.stack(ensure_same_length(
@@ -104,24 +157,122 @@ def synth_params_augmentation(data_dir, output_dir, config):
             axis=-1),
         axis=-1)
 
-    # save stem
-    for part_number, instrument_name in enumerate(instrument_name_all):
-        audio = midi_audio[part_number].numpy().astype(np.float64)
-        save_wav(audio, os.path.join(output_dir, f'{part_number}_{instrument_name}.wav'), config['sample_rate'])
+    with profile_stage('save'):
+        # save stem
+        for part_number, instrument_name in enumerate(piece['instrument_name_all']):
+            audio = midi_audio[part_number].numpy().astype(np.float64)
+            save_wav(audio, os.path.join(output_dir, f'{part_number}_{instrument_name}.wav'), config['sample_rate'])
 
-    # save mix
-    save_wav(midi_audio_mix, os.path.join(output_dir, f'mix.wav'), config['sample_rate'])
+        # save mix
+        save_wav(midi_audio_mix, os.path.join(output_dir, f'mix.wav'), config['sample_rate'])
 
-    # make metadata with each item as dict
-    metadata = {
-        'instrument_id': {i: instrument_id_all[i].numpy()[0] for i in range(4)},
-        'note_expression_control': {i: conditioning_df_all[i] for i in range(4)},
-        'synthesis_parameters': {i: {k: v[i].numpy() for k, v in synthesis_parameters.items()} for i in range(4)},
-        'pitch_correction_amount': correction_amount_all,
-    }
-    metadata = {**metadata, **residual_metadata}  # merge changed metadata from rest of metadata
+        # make metadata with each item as dict
+        metadata = {
+            'instrument_id': {i: instrument_id_all[i].numpy()[0] for i in range(4)},
+            'note_expression_control': {i: conditioning_df_all[i] for i in range(4)},
+            'synthesis_parameters': {i: {k: v[i].numpy() for k, v in synthesis_parameters.items()}
+                                     for i in range(4)},
+            'pitch_correction_amount': piece['correction_amount_all'],
+        }
+        metadata = {**metadata, **piece['residual_metadata']}  # merge changed metadata from rest of metadata
+
+        pickle_dump(metadata, os.path.join(output_dir, 'metadata.pickle'))
+
+
+def synth_params_augmentation(data_dir, output_dir, config, seed=None):
+    import tensorflow as tf
+    piece = load_and_augment_synth_params(data_dir, config, seed)
+
+    # Re synthesize the audio using DDSP
+    instrument_id = tf.concat(piece['instrument_id_all'], 0)
+    midi_audio = synth_params_to_audio(get_synthesis_generator(), piece['synthesis_parameters'], instrument_id)
+
+    save_synth_params_augmentation(piece, midi_audio, output_dir, config)
+
+
+def pad_frames(x, num_frames):
+    """Pad the frames (axis 1) of x to num_frames by repeating its last frame.
+    Padding with zeros would change the last hop of the audio, as the upsampling of the controls interpolates between
+    the last frame and the padding."""
+    import tensorflow as tf
+    num_padding = num_frames - x.shape[1]
+    if num_padding <= 0:
+        return x
+    return tf.concat([x, tf.repeat(x[:, -1:], num_padding, axis=1)], axis=1)
+
+
+def synthesize_bucket(pieces, output_dir, config, journal=None):
+    """Pad the synthesis parameters of pieces to the same length, synthesize them in one batch,
+    and save the audio of each piece cropped back to its own length.
+    If journal is given, record each piece as done once it is saved."""
+    import tensorflow as tf
+    num_frames = [piece['synthesis_parameters']['amplitudes'].shape[1] for piece in pieces]
+    max_frames = max(num_frames)
+    synthesis_parameters = {
+        k: tf.concat([pad_frames(piece['synthesis_parameters'][k], max_frames) for piece in pieces], axis=0)
+        for k in pieces[0]['synthesis_parameters'].keys()}
+    instrument_id = tf.concat([tf.concat(piece['instrument_id_all'], 0) for piece in pieces], 0)
 
-    pickle_dump(metadata, os.path.join(output_dir, 'metadata.pickle'))
+    midi_audio = synth_params_to_audio(get_synthesis_generator(), synthesis_parameters, instrument_id)
+    hop_size = midi_audio.shape[1] // max_frames
+
+    part_idx = 0
+    for piece, piece_num_frames in zip(pieces, num_frames):
+        num_parts = len(piece['instrument_id_all'])
+        piece_audio = midi_audio[part_idx:part_idx + num_parts, :piece_num_frames * hop_size]
+        save_synth_params_augmentation(piece, piece_audio, output_dir, config)
+        if journal is not None:
+            journal.mark_done(JOURNAL_STAGE, piece_key(piece['data_dir']))
+        part_idx += num_parts
+
+
+def synth_params_augmentation_batch(data_dirs, output_dir, config, batch_size, bucket_frames, journal=None,
+                                    seed=None):
+    """Apply the synthesis parameters augmentation to a list of pieces, synthesizing several pieces at once.
+    Pieces are grouped into buckets of similar number of frames (bucket_frames wide) so that little compute is wasted
+    on padding, and each bucket is synthesized once it has batch_size pieces.
+    If journal is given, record each piece as started and done.
+    A piece failing to load, or a bucket failing to synthesize, is logged and the other pieces are still processed,
+    then a RuntimeError listing the failed pieces is raised."""
+    buckets = {}
+    failed = []
+    for data_dir in data_dirs:
+        if journal is not None:
+            journal.mark_started(JOURNAL_STAGE, piece_key(data_dir))
+        try:
+            piece = load_and_augment_synth_params(data_dir, config, seed)
+        except Exception:
+            print(f'Failed to load {data_dir}:\n{traceback.format_exc()}')
+            failed.append(data_dir)
+            continue
+        bucket = buckets.setdefault(piece['synthesis_parameters']['amplitudes'].shape[1] // bucket_frames, [])
+        bucket.append(piece)
+        if len(bucket) == batch_size:
+            failed += _synthesize_bucket_or_log(bucket, output_dir, config, journal)
+            bucket.clear()
+    for bucket in buckets.values():
+        if bucket:
+            failed += _synthesize_bucket_or_log(bucket, output_dir, config, journal)
+    if failed:
+        raise RuntimeError(f'{len(failed)} of {len(data_dirs)} pieces failed: {", ".join(failed)}')
+
+
+def _synthesize_bucket_or_log(pieces, output_dir, config, journal):
+    """synthesize_bucket, logging an exception instead of raising it. Returns the pieces of a failed bucket."""
+    try:
+        synthesize_bucket(pieces, output_dir, config, journal)
+        return []
+    except Exception:
+        data_dirs = [piece['data_dir'] for piece in pieces]
+        print(f'Failed to synthesize {", ".join(data_dirs)}:\n{traceback.format_exc()}')
+        return data_dirs
+
+
+def synthesize_planned_batch(data_dirs, output_dir, config, journal=None, seed=None):
+    """Apply the synthesis parameters augmentation to a batch of pieces of similar length planned by
+    plan_batches.py, synthesizing them in one batch."""
+    synth_params_augmentation_batch(data_dirs, output_dir, config, batch_size=len(data_dirs),
+                                    bucket_frames=sys.maxsize, journal=journal, seed=seed)
 
 
 if __name__ == '__main__':
@@ -133,16 +284,72 @@ if __name__ == '__main__':
                        help='the directory containing multiple folders generated by MIDI-DDSP synthesis.')
     parser.add_argument('--output_dir', type=str, default=None, metavar='N',
                         help='the directory for output.')
+    parser.add_argument('--batch_size', type=int, default=1, metavar='N',
+                        help='the number of pieces of similar length synthesized in one batch. '
+                             'With --manifest, any value above 1 synthesizes the planned batches.')
+    parser.add_argument('--bucket_frames', type=int, default=250, metavar='N',
+                        help='the width (in frames) of the length buckets used to batch pieces.')
+    parser.add_argument('--bucket_window', type=int, default=256, metavar='N',
+                        help='the number of pieces sorted into length buckets together when batching.')
+    add_parallel_args(parser)
+    add_journal_args(parser)
+    add_manifest_args(parser)
+    add_model_args(parser)
+    add_profile_args(parser)
+    add_seed_args(parser)
     args = parser.parse_args()
+    if args.manifest and args.synthesis_dir:
+        parser.error('--manifest plans batches of the pieces of --multi_synthesis_dir, not of --synthesis_dir.')
 
     config = get_config()
 
     if args.synthesis_dir:
         synth_dir_list = [args.synthesis_dir]
+    elif args.multi_synthesis_dir and args.manifest:
+        planned_batches = get_planned_synthesis_dirs(args.manifest, args.multi_synthesis_dir, args.chunk)
+        synth_dir_list = [d for batch in planned_batches for d in batch]
     elif args.multi_synthesis_dir:
-        synth_dir_list = glob.glob(f'{args.multi_synthesis_dir}/*/')
+        synth_dir_list = sorted(glob.glob(f'{args.multi_synthesis_dir}/*/'))
     else:
         raise ValueError('Please specify either synthesis_dir or multi_synthesis_dir.')
 
-    for synth_dir in tqdm(synth_dir_list):
-        synth_params_augmentation(synth_dir, args.output_dir, config)
\ No newline at end of file
+    # the trailing slash of the glob would make the name of the piece directories empty
+    synth_dir_list = [os.path.normpath(d) for d in synth_dir_list]
+    journal = get_journal(args)
+    synth_dir_list = journal.pending(JOURNAL_STAGE, synth_dir_list, ignore_journal=args.ignore_journal,
+                                     in_place=not args.output_dir)
+    profiler = get_profiler(args, JOURNAL_STAGE)
+
+    if args.batch_size > 1 and args.manifest:
+        # each work item is a batch planned by plan_batches.py, synthesized at once.
+        process_fn = functools.partial(synthesize_planned_batch, output_dir=args.output_dir, config=config,
+                                       journal=journal, seed=args.seed)
+        pending_dirs = set(synth_dir_list)
+        synth_dir_list = [[d for d in batch if d in pending_dirs] for batch in planned_batches]
+        synth_dir_list = [batch for batch in synth_dir_list if batch]
+        process_fn = profiler.wrap(process_fn, key=batch_key)
+    elif args.batch_size > 1:
+        # each work item is a window of pieces, which is sorted into length buckets and synthesized in batches.
+        process_fn = functools.partial(synth_params_augmentation_batch,
+                                       output_dir=args.output_dir,
+                                       config=config,
+                                       batch_size=args.batch_size,
+                                       bucket_frames=args.bucket_frames,
+                                       journal=journal,
+                                       seed=args.seed)
+        synth_dir_list = [synth_dir_list[i:i + args.bucket_window]
+                          for i in range(0, len(synth_dir_list), args.bucket_window)]
+        process_fn = profiler.wrap(process_fn, key=batch_key)
+    else:
+        process_fn = functools.partial(synth_params_augmentation, output_dir=args.output_dir, config=config,
+                                       seed=args.seed)
+        process_fn = profiler.wrap(journal.wrap(JOURNAL_STAGE, process_fn))
+
+    failures = run_parallel(process_fn,
+                            synth_dir_list,
+                            num_workers=args.num_workers,
+                            chunksize=args.chunksize,
+                            **get_worker_model_kwargs(args))
+    profiler.summarize()
+    if failures:
+        sys.exit(1)
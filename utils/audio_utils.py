@@ -0,0 +1,146 @@
+"""
+Utilities for reading and writing the WAV files of the stems without librosa.
+
+read_wav parses the WAV header and reads the samples directly (16 and 32 bit PCM, 32 and 64 bit float), optionally
+from a memory map, and only resamples when the sample rate of the file differs from the requested one. It returns the
+same float32 samples as librosa.load(path, sr=sample_rate, mono=True). Other formats are read with soundfile.
+
+save_wav writes the same files as midi_ddsp.utils.audio_io.save_wav (16 bit PCM with soundfile), without importing
+MIDI-DDSP and TensorFlow. AsyncWavWriter writes them from background threads.
+"""
+
+import queue
+import struct
+import threading
+import numpy as np
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+# the dtypes read directly, by (format, bits per sample)
+WAV_DTYPES = {(WAVE_FORMAT_PCM, 16): '<i2', (WAVE_FORMAT_PCM, 32): '<i4',
+              (WAVE_FORMAT_IEEE_FLOAT, 32): '<f4', (WAVE_FORMAT_IEEE_FLOAT, 64): '<f8'}
+
+
+def read_wav_header(path):
+    """Parse the header of a WAV file.
+    Returns a dict with the format, number of channels, sample rate, bits per sample, and the byte offset and size of
+    the samples."""
+    with open(path, 'rb') as f:
+        riff = f.read(12)
+        if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+            raise ValueError(f'{path} is not a WAV file.')
+        header = {}
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                raise ValueError(f'{path} has no data chunk.')
+            chunk_id, chunk_size = chunk_header[:4], struct.unpack('<I', chunk_header[4:])[0]
+            if chunk_id == b'fmt ':
+                fmt = f.read(chunk_size)
+                audio_format, num_channels, sample_rate, _, _, bits_per_sample = struct.unpack('<HHIIHH', fmt[:16])
+                if audio_format == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+                    audio_format = struct.unpack('<H', fmt[24:26])[0]  # the first two bytes of the sub-format GUID
+                header.update(format=audio_format, num_channels=num_channels, sample_rate=sample_rate,
+                              bits_per_sample=bits_per_sample)
+                f.seek(chunk_size % 2, 1)
+            elif chunk_id == b'data':
+                if 'format' not in header:
+                    raise ValueError(f'{path} has no fmt chunk before the data chunk.')
+                header['data_offset'] = f.tell()
+                # the size may be wrong if the file was not closed properly, read until the end of the file then.
+                file_size = f.seek(0, 2)
+                header['data_size'] = min(chunk_size, file_size - header['data_offset'])
+                break
+            else:
+                f.seek(chunk_size + chunk_size % 2, 1)  # chunks are padded to an even size
+        f.close()
+    return header
+
+
+def read_wav(path, sample_rate=None, mono=True, mmap=False):
+    """Read a WAV file as float32, resampled to sample_rate if it is not None and differs from the rate of the file.
+    Returns (samples, sample rate) as librosa.load: samples are [samples] if mono, else [channels, samples].
+    With mmap, float32 files that need no conversion are returned as a read-only memory map."""
+    header = read_wav_header(path)
+    dtype = WAV_DTYPES.get((header['format'], header['bits_per_sample']))
+    if dtype is None:
+        import soundfile as sf
+        wav, native_rate = sf.read(path, dtype='float32', always_2d=True)
+        wav = wav.T
+    else:
+        dtype = np.dtype(dtype)
+        num_channels = header['num_channels']
+        num_frames = header['data_size'] // (dtype.itemsize * num_channels)
+        if mmap:
+            wav = np.memmap(path, dtype=dtype, mode='r', offset=header['data_offset'],
+                            shape=(num_frames, num_channels))
+        else:
+            wav = np.fromfile(path, dtype=dtype, count=num_frames * num_channels,
+                              offset=header['data_offset']).reshape(num_frames, num_channels)
+        wav = wav.T
+        native_rate = header['sample_rate']
+        if dtype.kind == 'i':
+            # the same scaling as libsndfile, used by librosa.load
+            wav = wav.astype(np.float32) / np.float32(2 ** (8 * dtype.itemsize - 1))
+        elif dtype != np.float32:
+            wav = wav.astype(np.float32)
+
+    if mono:
+        wav = wav[0] if wav.shape[0] == 1 else np.mean(wav, axis=0)
+    elif wav.shape[0] == 1:
+        wav = wav[0]
+    if sample_rate is not None and sample_rate != native_rate:
+        import librosa
+        wav = librosa.resample(np.asarray(wav), orig_sr=native_rate, target_sr=sample_rate)
+        native_rate = sample_rate
+    return wav, native_rate
+
+
+def save_wav(wav, path, sample_rate):
+    """Save audio as 16 bit PCM, as midi_ddsp.utils.audio_io.save_wav."""
+    import soundfile as sf
+    sf.write(path, wav, sample_rate)
+
+
+class AsyncWavWriter:
+    """Write WAV files from background threads, so that encoding and writing overlap with the computation.
+    The arrays passed to write must not be modified afterwards. close() waits for all the writes and raises the first
+    error. Use as a context manager around the writes of a piece, so that the piece is complete when it exits."""
+
+    def __init__(self, num_threads=1, max_pending=8):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.errors = []
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(num_threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                save_wav(*item)
+            except Exception as e:
+                self.errors.append(e)
+
+    def write(self, wav, path, sample_rate):
+        """Queue a file to write, waiting if max_pending files are already queued."""
+        if self.errors:
+            raise self.errors[0]
+        self.queue.put((wav, path, sample_rate))
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,9 +1,19 @@
 """Utilities for instrument assignment."""
 
-from midi_ddsp.data_handling.instrument_name_utils import INST_NAME_TO_MIDI_PROGRAM_DICT
 import numpy as np
 
-USEFUL_INST_PROG = list(INST_NAME_TO_MIDI_PROGRAM_DICT.values())[:-1]  # except guitar
+# Names imported from midi_ddsp on first access, as importing midi_ddsp also imports tensorflow.
+MIDI_DDSP_INSTRUMENT_NAMES = ['INST_NAME_TO_MIDI_PROGRAM_DICT', 'INST_ID_TO_NAME_DICT', 'MIDI_PROGRAM_TO_INST_NAME_DICT']
+
+
+def __getattr__(name):
+    if name in MIDI_DDSP_INSTRUMENT_NAMES:
+        from midi_ddsp.data_handling import instrument_name_utils
+        return getattr(instrument_name_utils, name)
+    if name == 'USEFUL_INST_PROG':
+        return list(__getattr__('INST_NAME_TO_MIDI_PROGRAM_DICT').values())[:-1]  # except guitar
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
 
 FOUR_BACH_PARTS = ['Soprano', 'Alto', 'Tenor', 'Bass']
 
@@ -65,7 +75,7 @@ RANDOM_ENSEMBLE = {
 }
 
 
-def get_instrument_by_part(ensemble, part):
+def get_instrument_by_part(ensemble, part, rng=None):
     if ensemble == 'string':
         instrument = STRING_ENSEMBLE[part]
     elif ensemble == 'brass':
@@ -73,7 +83,7 @@ def get_instrument_by_part(ensemble, part):
     elif ensemble == 'woodwind':
         instrument = WOODWIND_ENSEMBLE[part]
     elif ensemble == 'random':
-        instrument = np.random.choice(RANDOM_ENSEMBLE[part])
+        instrument = str(np.random.default_rng(rng).choice(RANDOM_ENSEMBLE[part]))
     else:
         raise ValueError('Band name not supported.')
     return instrument
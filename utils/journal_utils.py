@@ -0,0 +1,153 @@
+"""
+A per-stage, per-piece journal recording which pieces have been processed, so that a stage can be run again after
+a crash and skip the pieces already processed.
+
+The journal of a stage is a directory holding one small record per piece: <journal_dir>/<stage>/<piece>.started when
+the stage starts processing the piece, and <piece>.done once all its output has been written. Records are only
+added, never modified, and each is written to a temporary file and renamed, so that a crash never leaves a partial
+record. A piece that is started but not done was interrupted, and its output (or its input, for the stages that
+modify the pieces in place) may be incomplete.
+"""
+
+import os
+import json
+import time
+import socket
+import functools
+
+JOURNAL_DIR_NAME = '.journal'
+STARTED = 'started'
+DONE = 'done'
+
+
+def add_journal_args(parser):
+    """Add the arguments controlling the journal to an argparse parser."""
+    parser.add_argument('--journal_dir', type=str, default=None, metavar='N',
+                        help=f'the directory of the journal recording the processed pieces. '
+                             f'Default to {JOURNAL_DIR_NAME} in the output directory, '
+                             f'or in <output directory>_bookkeeping for the post-processing.')
+    parser.add_argument('--ignore_journal', action='store_true',
+                        help='process all the pieces, including those the journal records as done.')
+    return parser
+
+
+def piece_key(path):
+    """The key of a piece in the journal, the name of its directory or file."""
+    return os.path.basename(os.path.normpath(path))
+
+
+class Journal:
+    def __init__(self, journal_dir):
+        self.journal_dir = journal_dir
+
+    def _record_path(self, stage, piece, status):
+        return os.path.join(self.journal_dir, stage, f'{piece}.{status}')
+
+    def _write_record(self, stage, piece, status, **info):
+        path = self._record_path(stage, piece, status)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        record = {'stage': stage, 'piece': piece, 'status': status, 'time': time.time(),
+                  'host': socket.gethostname(), 'pid': os.getpid(), **info}
+        tmp_path = f'{path}.tmp.{socket.gethostname()}.{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump(record, f)
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+        os.replace(tmp_path, path)
+
+    def mark_started(self, stage, piece, **info):
+        self._write_record(stage, piece, STARTED, **info)
+
+    def mark_done(self, stage, piece, **info):
+        self._write_record(stage, piece, DONE, **info)
+
+    def is_done(self, stage, piece):
+        return os.path.exists(self._record_path(stage, piece, DONE))
+
+    def status(self, stage):
+        """The status of the pieces of a stage, {piece: 'started' or 'done'}."""
+        statuses = {}
+        stage_dir = os.path.join(self.journal_dir, stage)
+        if not os.path.isdir(stage_dir):
+            return statuses
+        for root, _, files in os.walk(stage_dir):
+            relative_root = os.path.relpath(root, stage_dir)
+            for file in files:
+                piece, _, status = file.rpartition('.')
+                if status not in [STARTED, DONE]:
+                    continue  # temporary files
+                piece = piece if relative_root == '.' else os.path.join(relative_root, piece)
+                if status == DONE or piece not in statuses:
+                    statuses[piece] = status
+        return statuses
+
+    def stages(self):
+        if not os.path.isdir(self.journal_dir):
+            return []
+        return sorted(d for d in os.listdir(self.journal_dir) if os.path.isdir(os.path.join(self.journal_dir, d)))
+
+    def set_total(self, stage, total):
+        """Record the number of pieces of a stage, reported by journal_status.py."""
+        os.makedirs(self.journal_dir, exist_ok=True)
+        tmp_path = os.path.join(self.journal_dir, f'{stage}.total.tmp.{os.getpid()}')
+        with open(tmp_path, 'w') as f:
+            f.write(str(total))
+            f.close()
+        os.replace(tmp_path, os.path.join(self.journal_dir, f'{stage}.total'))
+
+    def get_total(self, stage):
+        path = os.path.join(self.journal_dir, f'{stage}.total')
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            total = int(f.read())
+            f.close()
+        return total
+
+    def pending(self, stage, items, key=piece_key, ignore_journal=False, record_total=True, in_place=False):
+        """Filter out the items the journal records as done, and record the total number of items of the stage.
+        When the items of a stage are filtered in several calls, record the total once with set_total and pass
+        record_total=False.
+        For the stages modifying the pieces in place, the items started but not done are filtered out as well, with
+        a warning, as their input may be partially overwritten and processing them again would not give the same
+        output: regenerate them (journal_status.py lists them)."""
+        items = list(items)
+        if record_total:
+            self.set_total(stage, len(items))
+        if ignore_journal:
+            return items
+        statuses = self.status(stage)
+        done = {piece for piece, status in statuses.items() if status == DONE}
+        pending_items = [item for item in items if key(item) not in done]
+        if len(pending_items) < len(items):
+            print(f'Skipping {len(items) - len(pending_items)} of {len(items)} pieces already done in {stage}.')
+        if in_place:
+            interrupted = [key(item) for item in pending_items if statuses.get(key(item)) == STARTED]
+            if interrupted:
+                print(f'Warning: skipping {len(interrupted)} pieces interrupted in {stage}, which modifies the pieces '
+                      f'in place, as they may be partially overwritten. Regenerate them: {", ".join(interrupted)}')
+                pending_items = [item for item in pending_items if statuses.get(key(item)) != STARTED]
+        return pending_items
+
+    def wrap(self, stage, func, key=piece_key):
+        """Wrap a function processing one item, so that it records the item as started and done."""
+        return functools.partial(_journaled_call, self, stage, func, key)
+
+
+def _journaled_call(journal, stage, func, key, item):
+    piece = key(item)
+    journal.mark_started(stage, piece)
+    start = time.time()
+    result = func(item)
+    journal.mark_done(stage, piece, duration=time.time() - start)
+    return result
+
+
+def get_journal(args, output_root=None):
+    """Get the journal from the arguments added by add_journal_args. By default, the journal is in output_root,
+    or for the stages processing synthesis directories, in the output directory or next to the synthesized pieces."""
+    if output_root is None:
+        output_root = args.output_dir or args.multi_synthesis_dir or \
+                      os.path.dirname(os.path.normpath(args.synthesis_dir))
+    return Journal(args.journal_dir or os.path.join(output_root, JOURNAL_DIR_NAME))
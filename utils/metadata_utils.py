@@ -1,11 +1,12 @@
-import tensorflow as tf
 from utils.file_utils import pickle_load, pickle_dump
+from utils import instrument_utils
 import numpy as np
-from midi_ddsp.data_handling.instrument_name_utils import INST_ID_TO_NAME_DICT
 
 
 def load_metadata(pickle_path):
     """load metadata and convert them to tensorflow tensor such that they can be input to the model."""
+    import tensorflow as tf
+    INST_ID_TO_NAME_DICT = instrument_utils.INST_ID_TO_NAME_DICT
     metadata = pickle_load(pickle_path)
     instrument_id_all = list(metadata['instrument_id'].values())
     instrument_name_all = [INST_ID_TO_NAME_DICT[i] for i in instrument_id_all]
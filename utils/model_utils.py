@@ -0,0 +1,34 @@
+"""Utilities for loading the pre-trained MIDI-DDSP model."""
+
+_pretrained_model = None
+
+
+def get_pretrained_model():
+    """Get the pre-trained MIDI-DDSP (synthesis_generator, expression_generator).
+    The model is loaded on first use and then shared by everything in the current process."""
+    global _pretrained_model
+    if _pretrained_model is None:
+        from midi_ddsp.midi_ddsp_synthesize import load_pretrained_model
+        _pretrained_model = load_pretrained_model()
+    return _pretrained_model
+
+
+def get_synthesis_generator():
+    return get_pretrained_model()[0]
+
+
+def add_model_args(parser):
+    """Add the arguments controlling how the model is loaded in worker processes to an argparse parser."""
+    parser.add_argument('--share_model', action='store_true',
+                        help='load the model once in the main process and fork the workers from it, '
+                             'instead of loading a copy of the model in each spawned worker. '
+                             'Saves memory and start-up time, but TensorFlow does not officially support fork.')
+    return parser
+
+
+def get_worker_model_kwargs(args):
+    """Get the run_parallel keyword arguments for loading the model in each worker according to args."""
+    if args.share_model and args.num_workers > 1:
+        get_pretrained_model()  # forked workers inherit the model loaded here
+        return {'initializer': None, 'start_method': 'fork'}
+    return {'initializer': get_pretrained_model, 'start_method': 'spawn'}  # tensorflow is not fork-safe
@@ -0,0 +1,75 @@
+"""Utilities for running the per-piece stage scripts in a process pool."""
+
+import functools
+import multiprocessing
+import traceback
+import numpy as np
+from tqdm import tqdm
+
+
+def add_parallel_args(parser):
+    """Add the arguments controlling parallel execution to an argparse parser."""
+    parser.add_argument('--num_workers', type=int, default=1, metavar='N',
+                        help='the number of worker processes. 1 runs everything in the main process.')
+    parser.add_argument('--chunksize', type=int, default=1, metavar='N',
+                        help='the number of pieces sent to a worker at a time.')
+    return parser
+
+
+def _safe_call(func, item):
+    """Call func on item and return the traceback as a string instead of raising."""
+    try:
+        func(item)
+        return item, None
+    except Exception:
+        return item, traceback.format_exc()
+
+
+def _init_worker(initializer, initargs):
+    # Forked workers inherit the global numpy random state of the parent,
+    # re-seed so that workers do not draw identical random augmentations.
+    np.random.seed()
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def run_parallel(func, items, num_workers=1, chunksize=1, initializer=None, initargs=(), start_method=None,
+                 desc=None):
+    """Apply func to every item, in a pool of num_workers processes.
+
+    Results are reported in the order of items, and an exception raised for one item is logged and does not stop
+    the rest of the run. initializer(*initargs) is called once in each worker (or once in the main process when
+    num_workers is 1), which is where per-worker state such as a MIDI-DDSP model should be loaded.
+
+    Returns a list of (item, traceback) for the items that failed.
+    """
+    items = list(items)
+    call = functools.partial(_safe_call, func)
+    failures = []
+
+    if num_workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        results = map(call, items)
+        pool = None
+    else:
+        ctx = multiprocessing.get_context(start_method)
+        pool = ctx.Pool(num_workers, initializer=_init_worker, initargs=(initializer, initargs))
+        results = pool.imap(call, items, chunksize=max(1, chunksize))
+
+    try:
+        for item, error in tqdm(results, total=len(items), desc=desc):
+            if error is not None:
+                tqdm.write(f'Failed to process {item}:\n{error}')
+                failures.append((item, error))
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if failures:
+        print(f'{len(failures)} of {len(items)} items failed.')
+    return failures
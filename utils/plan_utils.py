@@ -0,0 +1,126 @@
+"""
+Utilities for planning batches and chunks of pieces of similar length.
+
+The run time of the synthesis and of the augmentations grows with the number of frames of a piece, which depends on
+the tempo drawn by midi_augmentation.py. A manifest, written by plan_batches.py from the augmented MIDI files, groups
+the pieces of each ensemble into batches of pieces of similar length (so that little compute is wasted on padding),
+and the batches into chunks of similar total cost:
+
+{'version': 1, 'midi_dir': ..., 'frame_rate': 250, 'batch_size': 8,
+ 'batches': [{'ensemble': 'string', 'pieces': [names of the MIDI files without extension], 'frames': [...]}, ...],
+ 'chunks': [{'batches': [indices of the batches], 'cost': padded frames of the chunk}, ...]}
+"""
+
+import os
+import json
+import math
+import heapq
+
+MANIFEST_VERSION = 1
+FRAME_RATE = 250  # the frame rate of the synthesis parameters of MIDI-DDSP
+
+
+def midi_num_frames(midi_file, frame_rate=FRAME_RATE):
+    """The number of frames up to the end of the last note of a MIDI file."""
+    import pretty_midi
+    midi = pretty_midi.PrettyMIDI(midi_file)
+    end_time = max((note.end for instrument in midi.instruments for note in instrument.notes), default=0.0)
+    return math.ceil(end_time * frame_rate)
+
+
+def padded_cost(batch_frames):
+    """The number of frames computed for a batch, all pieces being padded to the longest."""
+    return len(batch_frames) * max(batch_frames)
+
+
+def padding_waste(batches_frames):
+    """The fraction of the computed frames that are padding."""
+    total = sum(padded_cost(frames) for frames in batches_frames)
+    return 1 - sum(sum(frames) for frames in batches_frames) / total if total else 0.0
+
+
+def plan_batches(pieces, batch_size):
+    """Group pieces, given as [(name, frames)], into batches of batch_size pieces of similar length.
+    Cutting the pieces sorted by length into consecutive batches minimizes the padding. Longest batches first."""
+    pieces = sorted(pieces, key=lambda p: (-p[1], p[0]))
+    return [pieces[i:i + batch_size] for i in range(0, len(pieces), batch_size)]
+
+
+def plan_chunks(costs, num_chunks):
+    """Assign items of the given costs to num_chunks chunks of similar total cost (greedily, the most costly item
+    first to the least loaded chunk). Returns the lists of item indices and the cost of each chunk."""
+    chunks = [[] for _ in range(num_chunks)]
+    heap = [(0, i) for i in range(num_chunks)]
+    for item in sorted(range(len(costs)), key=lambda i: -costs[i]):
+        cost, chunk = heapq.heappop(heap)
+        chunks[chunk].append(item)
+        heapq.heappush(heap, (cost + costs[item], chunk))
+    chunk_costs = [0] * num_chunks
+    for cost, chunk in heap:
+        chunk_costs[chunk] = cost
+    return [sorted(chunk) for chunk in chunks], chunk_costs
+
+
+def make_manifest(midi_dir, ensemble_pieces, batch_size, num_chunks, frame_rate=FRAME_RATE):
+    """Make the manifest from {ensemble: [(name, frames)]}."""
+    batches = []
+    for ensemble, pieces in ensemble_pieces.items():
+        for batch in plan_batches(pieces, batch_size):
+            batches.append({'ensemble': ensemble, 'pieces': [name for name, _ in batch],
+                            'frames': [frames for _, frames in batch]})
+    chunks, chunk_costs = plan_chunks([padded_cost(batch['frames']) for batch in batches], num_chunks)
+    return {'version': MANIFEST_VERSION, 'midi_dir': os.path.abspath(midi_dir), 'frame_rate': frame_rate,
+            'batch_size': batch_size, 'batches': batches,
+            'chunks': [{'batches': chunk, 'cost': cost} for chunk, cost in zip(chunks, chunk_costs)]}
+
+
+def save_manifest(manifest, path):
+    with open(path, 'w') as f:
+        json.dump(manifest, f)
+        f.close()
+
+
+def load_manifest(path):
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+        f.close()
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError(f'{path} is not a batch manifest of version {MANIFEST_VERSION}.')
+    return manifest
+
+
+def manifest_batches(manifest, chunk=None):
+    """The batches of a chunk, or of all the chunks if chunk is None, longest first."""
+    if chunk is None:
+        batches = manifest['batches']
+    elif 0 <= chunk < len(manifest['chunks']):
+        batches = [manifest['batches'][i] for i in manifest['chunks'][chunk]['batches']]
+    else:
+        raise ValueError(f'The manifest has {len(manifest["chunks"])} chunks, chunk {chunk} does not exist.')
+    return sorted(batches, key=lambda batch: -max(batch['frames']))
+
+
+def add_manifest_args(parser):
+    """Add the arguments for processing the pieces listed in a manifest to an argparse parser."""
+    parser.add_argument('--manifest', type=str, default=None, metavar='N',
+                        help='a manifest written by plan_batches.py, to process the pieces of multi_synthesis_dir '
+                             'in the planned batches, longest first.')
+    parser.add_argument('--chunk', type=int, default=None, metavar='N',
+                        help='only process the pieces of this chunk of the manifest.')
+    return parser
+
+
+def get_planned_synthesis_dirs(manifest_path, multi_synthesis_dir, chunk=None):
+    """The synthesis directories of the pieces of a manifest, as a list of batches.
+    The pieces missing from multi_synthesis_dir (e.g. failed in synthesis) are left out."""
+    batches = []
+    num_missing = 0
+    for batch in manifest_batches(load_manifest(manifest_path), chunk):
+        data_dirs = [os.path.join(multi_synthesis_dir, name) for name in batch['pieces']]
+        existing_dirs = [d for d in data_dirs if os.path.isdir(d)]
+        num_missing += len(data_dirs) - len(existing_dirs)
+        if existing_dirs:
+            batches.append(existing_dirs)
+    if num_missing:
+        print(f'{num_missing} pieces of the manifest are not in {multi_synthesis_dir}.')
+    return batches
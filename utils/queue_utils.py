@@ -0,0 +1,153 @@
+"""
+A work queue with leases, stored in a SQLite database, for distributing the generation over workers that pull tasks
+as they go instead of processing a fixed chunk each.
+
+A worker leases a task for a limited time and renews the lease while it works on it. A task whose lease expires
+(because its worker crashed or was preempted) is leased again by the next worker asking for work, up to max_attempts
+times. Only the worker holding the lease can complete a task.
+
+The database relies on the file locks of SQLite: put it on a local disk, or on a shared filesystem with working POSIX
+locks when the workers run on several machines.
+"""
+
+import os
+import json
+import time
+import socket
+import sqlite3
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    started REAL,
+    finished REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, lease_expires);
+"""
+
+
+def get_worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class LeaseQueue:
+    def __init__(self, path, timeout=60):
+        self.path = path
+        # autocommit mode, transactions are started explicitly
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def _transaction(self, func, *args):
+        """Run func(cursor, *args) in a transaction holding the write lock."""
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            result = func(cursor, *args)
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+        cursor.execute('COMMIT')
+        return result
+
+    def add_tasks(self, tasks, max_attempts=3):
+        """Add tasks given as (name, payload), payload being JSON serializable.
+        Tasks whose name is already in the queue are ignored. Returns the number of tasks added."""
+        def add(cursor):
+            before = cursor.execute('SELECT COUNT(*) FROM tasks').fetchone()[0]
+            cursor.executemany('INSERT OR IGNORE INTO tasks (name, payload, max_attempts) VALUES (?, ?, ?)',
+                               [(name, json.dumps(payload), max_attempts) for name, payload in tasks])
+            return cursor.execute('SELECT COUNT(*) FROM tasks').fetchone()[0] - before
+        return self._transaction(add)
+
+    def lease(self, worker, lease_seconds):
+        """Lease the next pending task, or a task whose lease has expired.
+        Returns (task id, name, payload, attempt), or None if there is no task to lease."""
+        def lease(cursor):
+            now = time.time()
+            # a task whose lease expired on its last attempt is failed.
+            cursor.execute('UPDATE tasks SET status = ?, error = ?, finished = ? '
+                           'WHERE status = ? AND lease_expires < ? AND attempts >= max_attempts',
+                           (FAILED, 'lease expired', now, LEASED, now))
+            row = cursor.execute('SELECT id, name, payload, attempts FROM tasks '
+                                 'WHERE status = ? OR (status = ? AND lease_expires < ?) ORDER BY id LIMIT 1',
+                                 (PENDING, LEASED, now)).fetchone()
+            if row is None:
+                return None
+            task_id, name, payload, attempts = row
+            cursor.execute('UPDATE tasks SET status = ?, worker = ?, lease_expires = ?, attempts = ?, started = ? '
+                           'WHERE id = ?', (LEASED, worker, now + lease_seconds, attempts + 1, now, task_id))
+            return task_id, name, json.loads(payload), attempts + 1
+        return self._transaction(lease)
+
+    def renew(self, task_id, worker, lease_seconds):
+        """Extend the lease of a task. Returns False if the worker does not hold the lease anymore."""
+        def renew(cursor):
+            cursor.execute('UPDATE tasks SET lease_expires = ? WHERE id = ? AND worker = ? AND status = ?',
+                           (time.time() + lease_seconds, task_id, worker, LEASED))
+            return cursor.rowcount == 1
+        return self._transaction(renew)
+
+    def complete(self, task_id, worker, commit_func=None):
+        """Mark a task as done. commit_func, if given, is called while the queue is locked and only if the worker
+        still holds the lease, to publish the output of the task. Returns False if the worker lost the lease."""
+        def complete(cursor):
+            holder = cursor.execute('SELECT worker, status FROM tasks WHERE id = ?', (task_id,)).fetchone()
+            if holder != (worker, LEASED):
+                return False
+            if commit_func is not None:
+                commit_func()
+            cursor.execute('UPDATE tasks SET status = ?, finished = ?, error = NULL WHERE id = ?',
+                           (DONE, time.time(), task_id))
+            return True
+        return self._transaction(complete)
+
+    def fail(self, task_id, worker, error):
+        """Release a failed task, to be retried by another lease unless it has reached max_attempts."""
+        def fail(cursor):
+            cursor.execute('UPDATE tasks SET status = CASE WHEN attempts >= max_attempts THEN ? ELSE ? END, '
+                           'lease_expires = NULL, finished = ?, error = ? WHERE id = ? AND worker = ? AND status = ?',
+                           (FAILED, PENDING, time.time(), error, task_id, worker, LEASED))
+        self._transaction(fail)
+
+    def requeue(self, statuses=(FAILED,)):
+        """Put the tasks with the given statuses back in the queue, with their attempts reset."""
+        def requeue(cursor):
+            cursor.execute(f'UPDATE tasks SET status = ?, attempts = 0, worker = NULL, lease_expires = NULL '
+                           f'WHERE status IN ({",".join("?" * len(statuses))})', (PENDING, *statuses))
+            return cursor.rowcount
+        return self._transaction(requeue)
+
+    def counts(self):
+        """The number of tasks of each status. Leased tasks whose lease expired are counted as pending."""
+        counts = {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0}
+        rows = self.connection.execute('SELECT CASE WHEN status = ? AND lease_expires < ? THEN ? ELSE status END, '
+                                       'COUNT(*) FROM tasks GROUP BY 1', (LEASED, time.time(), PENDING))
+        counts.update(dict(rows.fetchall()))
+        return counts
+
+    def worker_stats(self):
+        """{worker: (number of tasks done, mean time per task in seconds)}"""
+        rows = self.connection.execute('SELECT worker, COUNT(*), AVG(finished - started) FROM tasks '
+                                       'WHERE status = ? GROUP BY worker ORDER BY worker', (DONE,))
+        return {worker: (num_done, mean_time) for worker, num_done, mean_time in rows.fetchall()}
+
+    def failed_tasks(self):
+        rows = self.connection.execute('SELECT name, attempts, error FROM tasks WHERE status = ? ORDER BY id',
+                                       (FAILED,))
+        return rows.fetchall()
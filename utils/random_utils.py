@@ -0,0 +1,32 @@
+"""
+Random generators derived from a global seed, so that the augmentations do not depend on the number of workers, the
+order the pieces are processed in, or how the generation is split across jobs and machines.
+
+Each stage draws the augmentations of a piece from get_rng(seed, stage, piece), a generator seeded by the global seed
+and a hash of the name of the stage and the id of the piece. The same piece gets the same augmentations in any
+process, and the fused augmentation_pipeline.py draws the same augmentations as the separate stages.
+"""
+
+import hashlib
+import numpy as np
+
+
+def add_seed_args(parser):
+    """Add the random seed argument to an argparse parser."""
+    parser.add_argument('--seed', type=int, default=None, metavar='N',
+                        help='the random seed. The same seed gives the same output for any number of workers and '
+                             'any split of the pieces into jobs. If not provided, the output is not reproducible.')
+    return parser
+
+
+def _key_to_int(key):
+    # hash() of a string differs between processes, so use a stable hash.
+    return int.from_bytes(hashlib.sha256(str(key).encode('utf-8')).digest()[:8], 'little')
+
+
+def get_rng(seed, *keys):
+    """A numpy random Generator for the keys (e.g. the name of a stage and the id of a piece), derived from seed.
+    If seed is None, the generator is seeded from fresh entropy."""
+    if seed is None:
+        return np.random.default_rng()
+    return np.random.default_rng(np.random.SeedSequence([seed] + [_key_to_int(key) for key in keys]))
@@ -0,0 +1,254 @@
+"""
+A registry of the pieces of the dataset, stored in a SQLite database and built once from the *_split.json files of
+the MIDI augmentation, mapping the MIDI file id of each piece to its ensemble, split, track id in the final dataset
+and the locations of its MIDI file and synthesized output.
+
+The track ids are assigned when the registry is built, in the order the pieces were numbered by the sequential
+postprocessing, so that the pieces can then be postprocessed in any order and in parallel, and a resumed run keeps
+the same track ids. Pieces without a synthesized output have no track id.
+
+Two numberings are supported, following the two postprocessing scripts:
+- from the synthesis directories (postprocess_cocochorales.py): one counter from 1 over the ensembles, the splits and
+  the pieces in the order of the split files, only counting the pieces found in <synthesis_dir>/<ensemble>/<piece>.
+- from the zips of the chunks (postprocess_and_unchunk_cocochorales.py): one counter per split starting at
+  first_track_idx[split], over the ensembles, the zips of <zip_dir>/<ensemble> and the pieces sorted in each zip.
+"""
+
+import os
+import glob
+import json
+import sqlite3
+import zipfile
+
+from utils.file_utils import json_load
+from utils.instrument_utils import AVAILABLE_ENSEMBLES
+
+REGISTRY_NAME = 'registry.sqlite'
+SPLITS = ['train', 'valid', 'test']
+NUM_TRACK_DIGITS = 6
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pieces (
+    ensemble TEXT NOT NULL,
+    piece TEXT NOT NULL,
+    split TEXT NOT NULL,
+    track_idx INTEGER,
+    track_id TEXT UNIQUE,
+    midi_path TEXT NOT NULL,
+    synthesis_dir TEXT,
+    zip_path TEXT,
+    PRIMARY KEY (ensemble, piece)
+);
+CREATE INDEX IF NOT EXISTS pieces_piece ON pieces (piece);
+CREATE INDEX IF NOT EXISTS pieces_split ON pieces (ensemble, split, track_idx);
+CREATE INDEX IF NOT EXISTS pieces_zip ON pieces (zip_path, split, track_idx);
+CREATE TABLE IF NOT EXISTS info (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+COLUMNS = ['ensemble', 'piece', 'split', 'track_idx', 'track_id', 'midi_path', 'synthesis_dir', 'zip_path']
+
+
+def add_registry_args(parser):
+    """Add the arguments controlling the piece registry to an argparse parser."""
+    parser.add_argument('--registry', type=str, default=None, metavar='N',
+                        help=f'the path of the piece registry, built on the first run. '
+                             f'Default to {REGISTRY_NAME} in <output directory>_bookkeeping, '
+                             f'out of the published dataset.')
+    parser.add_argument('--rebuild_registry', action='store_true',
+                        help='build the piece registry again, e.g. after more pieces were synthesized. '
+                             'This may change the track ids of the pieces.')
+    return parser
+
+
+def get_track_id(ensemble, track_idx):
+    """The name of a piece in the final dataset, different from its MIDI file id."""
+    return f'{ensemble}_track{str(track_idx).zfill(NUM_TRACK_DIGITS)}'
+
+
+def list_zip_pieces(zip_file):
+    """List the pieces in the zip of a chunk, as {piece: [names of the files of the piece in the zip]}."""
+    pieces = {}
+    for name in zip_file.namelist():
+        piece, _, file_name = name.partition('/')
+        if file_name and not name.endswith('/'):
+            pieces.setdefault(piece, []).append(name)
+    return pieces
+
+
+def _load_splits(midi_dir, ensemble):
+    """{split: [MIDI file ids]} of an ensemble, in the order of its split file."""
+    split_json = json_load(os.path.join(midi_dir, 'split', f'{ensemble}_split.json'))
+    return {split: [os.path.splitext(f)[0] for f in split_json.get(split, [])] for split in SPLITS}
+
+
+def _rows_from_synthesis_dir(midi_dir, synthesis_dir, ensembles):
+    track_idx = 1
+    for ensemble in ensembles:
+        ensemble_dir = os.path.join(synthesis_dir, ensemble)
+        synthesized = set(os.listdir(ensemble_dir)) if os.path.isdir(ensemble_dir) else set()
+        for split, pieces in _load_splits(midi_dir, ensemble).items():
+            for piece in pieces:
+                row = [ensemble, piece, split, None, None, os.path.join(midi_dir, ensemble, f'{piece}.mid'), None, None]
+                if piece in synthesized:
+                    row[3:5] = [track_idx, get_track_id(ensemble, track_idx)]
+                    row[6] = os.path.join(ensemble_dir, piece)
+                    track_idx += 1
+                yield row
+
+
+def _rows_from_zip_dir(midi_dir, zip_dir, ensembles, first_track_idx):
+    track_idx = dict(first_track_idx)
+    for ensemble in ensembles:
+        splits = _load_splits(midi_dir, ensemble)
+        split_of_piece = {piece: split for split, pieces in splits.items() for piece in pieces}
+        zipped = set()
+        for zip_path in sorted(glob.glob(os.path.join(glob.escape(os.path.join(zip_dir, ensemble)), '*.zip'))):
+            with zipfile.ZipFile(zip_path, 'r') as zip_file:
+                zip_pieces = sorted(list_zip_pieces(zip_file))
+                zip_file.close()
+            for split in SPLITS:
+                for piece in zip_pieces:
+                    if split_of_piece.get(piece) != split or piece in zipped:
+                        continue
+                    zipped.add(piece)
+                    yield [ensemble, piece, split, track_idx[split], get_track_id(ensemble, track_idx[split]),
+                           os.path.join(midi_dir, ensemble, f'{piece}.mid'), None, zip_path]
+                    track_idx[split] += 1
+        for split, pieces in splits.items():
+            for piece in pieces:
+                if piece not in zipped:
+                    yield [ensemble, piece, split, None, None, os.path.join(midi_dir, ensemble, f'{piece}.mid'),
+                           None, None]
+
+
+def _abspath(path):
+    return None if path is None else os.path.abspath(path)
+
+
+def build_registry(path, midi_dir, synthesis_dir=None, zip_dir=None, first_track_idx=None,
+                   ensembles=AVAILABLE_ENSEMBLES):
+    """Build the registry at path from the split files in <midi_dir>/split, locating the pieces in synthesis_dir or
+    in the zips of zip_dir, replacing any registry at path. Returns the PieceRegistry."""
+    if (synthesis_dir is None) == (zip_dir is None):
+        raise ValueError('Provide one of synthesis_dir and zip_dir.')
+    midi_dir, synthesis_dir, zip_dir = [_abspath(d) for d in [midi_dir, synthesis_dir, zip_dir]]
+    if zip_dir is not None:
+        rows = _rows_from_zip_dir(midi_dir, zip_dir, ensembles, first_track_idx)
+    else:
+        rows = _rows_from_synthesis_dir(midi_dir, synthesis_dir, ensembles)
+    info = {'midi_dir': midi_dir, 'synthesis_dir': synthesis_dir, 'zip_dir': zip_dir,
+            'first_track_idx': first_track_idx, 'ensembles': list(ensembles)}
+
+    # built in a temporary file and renamed, so that a registry is either complete or absent.
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f'{path}.tmp.{os.getpid()}'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    connection = sqlite3.connect(tmp_path)
+    connection.executescript(SCHEMA)
+    with connection:
+        connection.executemany(f'INSERT OR IGNORE INTO pieces ({", ".join(COLUMNS)}) '
+                               f'VALUES ({", ".join("?" * len(COLUMNS))})', rows)
+        connection.executemany('INSERT INTO info (key, value) VALUES (?, ?)',
+                               [(key, json.dumps(value)) for key, value in info.items()])
+    connection.close()
+    os.replace(tmp_path, path)
+    return PieceRegistry(path)
+
+
+class PieceRegistry:
+    """Read the registry of the pieces. The registry is picklable, and each process opens its own connection."""
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+
+    def __getstate__(self):
+        return {'path': self.path, '_connection': None}
+
+    def _execute(self, query, params=()):
+        # a connection cannot be shared with forked or spawned workers.
+        if self._connection is None or self._connection[0] != os.getpid():
+            connection = sqlite3.connect(self.path)
+            connection.row_factory = sqlite3.Row
+            self._connection = (os.getpid(), connection)
+        return self._connection[1].execute(query, params)
+
+    def close(self):
+        if self._connection is not None and self._connection[0] == os.getpid():
+            self._connection[1].close()
+        self._connection = None
+
+    def info(self):
+        """The arguments the registry was built with."""
+        return {key: json.loads(value) for key, value in self._execute('SELECT key, value FROM info')}
+
+    def lookup(self, piece, ensemble=None):
+        """The record of a piece by its MIDI file id, as a dict, or None if it is not in the registry.
+        Without ensemble, the piece must be unique among the ensembles."""
+        if ensemble is not None:
+            rows = self._execute('SELECT * FROM pieces WHERE ensemble = ? AND piece = ?', (ensemble, piece))
+        else:
+            rows = self._execute('SELECT * FROM pieces WHERE piece = ?', (piece,))
+        rows = rows.fetchall()
+        if len(rows) > 1:
+            raise ValueError(f'Piece {piece} is in several ensembles, provide the ensemble.')
+        return dict(rows[0]) if rows else None
+
+    def lookup_track(self, track_id):
+        """The record of a piece by its track id in the final dataset, or None."""
+        row = self._execute('SELECT * FROM pieces WHERE track_id = ?', (track_id,)).fetchone()
+        return dict(row) if row else None
+
+    def pieces(self, ensemble=None, split=None, zip_path=None, with_track=True):
+        """The records of the pieces, filtered by ensemble, split and zip, in the order of their track ids.
+        with_track only returns the pieces with a synthesized output."""
+        conditions, params = [], []
+        for column, value in [('ensemble', ensemble), ('split', split), ('zip_path', zip_path)]:
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                params.append(value)
+        if with_track:
+            conditions.append('track_idx IS NOT NULL')
+        where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+        rows = self._execute(f'SELECT * FROM pieces {where} ORDER BY track_idx, ensemble, piece', params)
+        return [dict(row) for row in rows]
+
+    def zip_paths(self, ensemble=None):
+        """The zips holding pieces, in order."""
+        query = 'SELECT DISTINCT zip_path FROM pieces WHERE zip_path IS NOT NULL'
+        params = ()
+        if ensemble is not None:
+            query += ' AND ensemble = ?'
+            params = (ensemble,)
+        return sorted(row[0] for row in self._execute(query, params))
+
+    def count(self, split=None, with_track=True):
+        """The number of pieces, in a split."""
+        query = 'SELECT COUNT(*) FROM pieces WHERE (? IS NULL OR split = ?)'
+        if with_track:
+            query += ' AND track_idx IS NOT NULL'
+        return self._execute(query, (split, split)).fetchone()[0]
+
+
+def get_registry(args, output_root, midi_dir, synthesis_dir=None, zip_dir=None, first_track_idx=None):
+    """Get the registry from the arguments added by add_registry_args, building it if it does not exist yet or
+    with --rebuild_registry. By default, the registry is in output_root, which the post-processing scripts set to
+    the bookkeeping directory next to the dataset (see data_postprocess/postprocess_utils.py).
+    Raises a ValueError if an existing registry was built from other directories."""
+    path = args.registry or os.path.join(output_root, REGISTRY_NAME)
+    if args.rebuild_registry or not os.path.exists(path):
+        print(f'Building the piece registry {path}')
+        return build_registry(path, midi_dir, synthesis_dir=synthesis_dir, zip_dir=zip_dir,
+                              first_track_idx=first_track_idx)
+    registry = PieceRegistry(path)
+    info = registry.info()
+    expected = {'midi_dir': _abspath(midi_dir), 'synthesis_dir': _abspath(synthesis_dir), 'zip_dir': _abspath(zip_dir),
+                'first_track_idx': first_track_idx}
+    mismatched = [key for key, value in expected.items() if info.get(key) != value]
+    if mismatched:
+        raise ValueError(f'The registry {path} was built with other {", ".join(mismatched)}, '
+                         f'use --rebuild_registry to build it again.')
+    return registry
@@ -0,0 +1,504 @@
+"""
+Utilities for reading the CocoChorales dataset directly from the downloaded .tar.bz2 shards, without extracting them.
+
+Each shard (<data_dir>/<data_type>/<split>/<n>.tar.bz2) holds the files of a run of pieces, written by
+data_postprocess/postprocess_and_unchunk_cocochorales.py. tar stores the files of a directory one after another,
+so the shards can be read as a stream and each piece is yielded as soon as its last file has been read.
+
+Shards can also be written in an indexed format, for random access to single pieces and files. Every tar member is
+compressed as a separate bzip2 stream (frame). Concatenated bzip2 streams are still a valid .tar.bz2, readable by tar
+and by the streaming reader. A sidecar index (<n>.tar.bz2.index) maps each piece and file to the byte range of its
+frame, so that one file can be read by decompressing only its frame.
+"""
+
+import os
+import io
+import bz2
+import glob
+import json
+import queue
+import shutil
+import time
+import tarfile
+import threading
+import traceback
+import subprocess
+import multiprocessing
+import numpy as np
+from utils.synth_params_utils import load_synthesis_parameters_from_buffer
+
+DATA_TYPES = ['main_dataset', 'metadata', 'note_expression', 'synthesis_parameters', 'f0']
+SPLITS = ['train', 'valid', 'test']
+SHARD_INDEX_EXTENSION = '.index'
+SHARD_INDEX_VERSION = 1
+
+
+def list_shards(data_dir, data_type='main_dataset', split='train'):
+    """List the shards of a data type and split, in the order of their index."""
+    return sorted(glob.glob(os.path.join(data_dir, data_type, split, '*.tar.bz2')),
+                  key=lambda x: int(os.path.basename(x).split('.')[0]))
+
+
+def _piece_id_and_name(member_name):
+    """Split a member name (./string_track000001/stems_audio/0_violin.wav) into the piece id and the path in it."""
+    path = member_name[2:] if member_name.startswith('./') else member_name
+    piece, _, name = path.partition('/')
+    if not name:
+        # data types other than main_dataset store one file per piece, e.g. ./string_track000001.yaml
+        piece, name = piece.split('.')[0], path
+    return piece, name
+
+
+def _open_decompressed(shard_path, use_pbzip2):
+    """Open the decompressed stream of a shard. pbzip2 decompresses the blocks of a shard on all the cores."""
+    if use_pbzip2 and shutil.which('pbzip2') is not None:
+        process = subprocess.Popen(['pbzip2', '-dc', shard_path], stdout=subprocess.PIPE)
+        return process.stdout, process
+    # BZ2File reads the multi-stream files written by pbzip2 and write_indexed_shard.
+    return bz2.BZ2File(shard_path, 'rb'), None
+
+
+def iterate_shard(shard_path, use_pbzip2=True):
+    """Yield (piece_id, {path in piece: bytes}) for each piece in a shard, reading it as a stream."""
+    stream, process = _open_decompressed(shard_path, use_pbzip2)
+    try:
+        with tarfile.open(fileobj=stream, mode='r|') as tar:
+            current_piece, files = None, {}
+            for member in tar:
+                if not member.isfile():
+                    continue
+                piece, name = _piece_id_and_name(member.name)
+                if piece != current_piece and files:
+                    yield current_piece, files
+                    files = {}
+                current_piece = piece
+                files[name] = tar.extractfile(member).read()
+            if files:
+                yield current_piece, files
+    finally:
+        stream.close()
+        if process is not None:
+            process.kill()
+            process.wait()
+
+
+def decode_piece(files):
+    """Decode the files of a piece by their extension: wav to float32 arrays, yaml and json to dicts,
+    mid to PrettyMIDI, pickle and params (see utils/synth_params_utils.py) to synthesis parameters.
+    Other files are kept as bytes."""
+    import yaml
+    import pickle
+    decoded = {}
+    for name, data in files.items():
+        extension = os.path.splitext(name)[1]
+        if extension == '.wav':
+            import soundfile as sf
+            decoded[name], _ = sf.read(io.BytesIO(data), dtype='float32')
+        elif extension == '.yaml':
+            decoded[name] = yaml.safe_load(data)
+        elif extension == '.json':
+            decoded[name] = json.loads(data)
+        elif extension == '.mid':
+            import pretty_midi
+            decoded[name] = pretty_midi.PrettyMIDI(io.BytesIO(data))
+        elif extension == '.pickle':
+            decoded[name] = pickle.loads(data)
+        elif extension == '.params':
+            decoded[name] = load_synthesis_parameters_from_buffer(data)
+        else:
+            decoded[name] = data
+    return decoded
+
+
+def _shard_worker(shard_queue, output_queue, decode, use_pbzip2):
+    try:
+        while True:
+            shard_path = shard_queue.get()
+            if shard_path is None:
+                break
+            for piece, files in iterate_shard(shard_path, use_pbzip2=use_pbzip2):
+                output_queue.put(('piece', (piece, decode_piece(files) if decode else files)))
+    except Exception:
+        output_queue.put(('error', traceback.format_exc()))
+    output_queue.put(('done', None))
+
+
+def _iterate_shards_parallel(shard_paths, num_workers, decode, use_pbzip2, queue_size):
+    """Read num_workers shards at a time in worker processes. Pieces of different shards are interleaved."""
+    ctx = multiprocessing.get_context()
+    shard_queue = ctx.Queue()
+    output_queue = ctx.Queue(maxsize=queue_size)
+    for shard_path in shard_paths:
+        shard_queue.put(shard_path)
+    for _ in range(num_workers):
+        shard_queue.put(None)
+    workers = [ctx.Process(target=_shard_worker, args=(shard_queue, output_queue, decode, use_pbzip2), daemon=True)
+               for _ in range(num_workers)]
+    for worker in workers:
+        worker.start()
+
+    try:
+        num_done = 0
+        while num_done < num_workers:
+            try:
+                kind, value = output_queue.get(timeout=1)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    raise RuntimeError('All shard reading workers exited unexpectedly.')
+                continue
+            if kind == 'piece':
+                yield value
+            elif kind == 'error':
+                raise RuntimeError(f'Failed to read a shard:\n{value}')
+            else:
+                num_done += 1
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+
+def shuffle_buffer(iterator, buffer_size, seed=None):
+    """Shuffle the items of an iterator approximately, by yielding a random item of a buffer of buffer_size items."""
+    rng = np.random.RandomState(seed)
+    buffer = []
+    for item in iterator:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        idx = rng.randint(buffer_size)
+        yield buffer[idx]
+        buffer[idx] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+def iterate_pieces(data_dir, data_type='main_dataset', split='train', shard_paths=None, num_workers=1, decode=True,
+                   shuffle_shards=False, buffer_size=0, seed=None, use_pbzip2=True, queue_size=16):
+    """Stream the pieces of a split from the .tar.bz2 shards, as (piece_id, {path in piece: data}).
+
+    For main_dataset, the paths are the ones in the piece directory (mix.wav, stems_audio/0_violin.wav,
+    metadata.yaml, mix.mid, stems_midi/0_violin.mid, ...), decoded by decode_piece unless decode is False.
+
+    shard_paths overrides the shards listed from data_dir, e.g. to give each training job a subset of them.
+    num_workers > 1 reads that many shards in parallel worker processes (pieces of different shards are then
+    interleaved in a non-deterministic order). shuffle_shards shuffles the order of the shards and buffer_size > 0
+    shuffles the pieces within a buffer of that many pieces, both with seed.
+    """
+    if shard_paths is None:
+        shard_paths = list_shards(data_dir, data_type, split)
+    shard_paths = list(shard_paths)
+    if shuffle_shards:
+        np.random.RandomState(seed).shuffle(shard_paths)
+
+    if num_workers <= 1:
+        pieces = ((piece, decode_piece(files) if decode else files)
+                  for shard_path in shard_paths
+                  for piece, files in iterate_shard(shard_path, use_pbzip2=use_pbzip2))
+    else:
+        pieces = _iterate_shards_parallel(shard_paths, num_workers, decode, use_pbzip2, queue_size)
+
+    if buffer_size > 0:
+        pieces = shuffle_buffer(pieces, buffer_size, seed)
+    yield from pieces
+
+
+def _member_frame(tarinfo, data=b''):
+    """The bzip2 frame of one tar member: its header and data, padded to the tar block size."""
+    header = tarinfo.tobuf(tarfile.GNU_FORMAT, tarfile.ENCODING, 'surrogateescape')
+    padding = b'\0' * (-len(data) % tarfile.BLOCKSIZE)
+    return bz2.compress(header + data + padding), len(header)
+
+
+class ShardWriter:
+    """Write the files of pieces to a shard one after another, without staging them on disk.
+
+    shard_format is 'tar' (compressed with pbzip2 if installed, as tar cf <shard> --use-compress-prog=pbzip2)
+    or 'indexed' (see above). The shard is written to <shard_path>.tmp and renamed when closed.
+    """
+
+    def __init__(self, shard_path, shard_format='tar', use_pbzip2=True):
+        if shard_format not in ['tar', 'indexed']:
+            raise ValueError(f'Shard format {shard_format} not supported, should be tar or indexed.')
+        self.shard_path = shard_path
+        self.shard_format = shard_format
+        self._dirs = set()
+        self._process = None
+        self._file = open(shard_path + '.tmp', 'wb')
+        if shard_format == 'indexed':
+            self._index = {}
+            self._offset = 0
+        elif use_pbzip2 and shutil.which('pbzip2') is not None:
+            self._process = subprocess.Popen(['pbzip2', '-c'], stdin=subprocess.PIPE, stdout=self._file)
+            self._tar = tarfile.open(fileobj=self._process.stdin, mode='w|', format=tarfile.GNU_FORMAT)
+        else:
+            self._tar = tarfile.open(fileobj=self._file, mode='w|bz2', format=tarfile.GNU_FORMAT)
+
+    def add(self, tarinfo, data=b''):
+        """Add a tar member, with data if it is a file."""
+        if self.shard_format == 'indexed':
+            frame, data_offset = _member_frame(tarinfo, data)
+            self._file.write(frame)
+            if tarinfo.isfile():
+                piece, name = _piece_id_and_name(tarinfo.name)
+                self._index.setdefault(piece, {})[name] = [self._offset, len(frame), data_offset, tarinfo.size]
+            self._offset += len(frame)
+        else:
+            self._tar.addfile(tarinfo, io.BytesIO(data) if tarinfo.isfile() else None)
+
+    def add_file(self, name, data):
+        """Add a file from its path in the shard (e.g. string_track000001/mix.wav) and its bytes,
+        adding the directories it is in first, like tar -C <dir>/ . does."""
+        parts = ('.', *name.split('/'))
+        for i in range(1, len(parts)):
+            dir_name = '/'.join(parts[:i])
+            if dir_name not in self._dirs:
+                tarinfo = tarfile.TarInfo(dir_name + '/')
+                tarinfo.type, tarinfo.mode, tarinfo.mtime = tarfile.DIRTYPE, 0o755, int(time.time())
+                self.add(tarinfo)
+                self._dirs.add(dir_name)
+        tarinfo = tarfile.TarInfo('./' + name)
+        tarinfo.size, tarinfo.mode, tarinfo.mtime = len(data), 0o644, int(time.time())
+        self.add(tarinfo, data)
+
+    def close(self):
+        if self.shard_format == 'indexed':
+            self._file.write(bz2.compress(b'\0' * tarfile.BLOCKSIZE * 2))  # end of archive
+            with open(self.shard_path + SHARD_INDEX_EXTENSION + '.tmp', 'w') as f:
+                json.dump({'version': SHARD_INDEX_VERSION, 'pieces': self._index}, f)
+                f.close()
+        else:
+            self._tar.close()
+            if self._process is not None:
+                self._process.stdin.close()
+                if self._process.wait() != 0:
+                    raise RuntimeError(f'pbzip2 failed when writing {self.shard_path}.')
+        self._file.close()
+        os.replace(self.shard_path + '.tmp', self.shard_path)
+        if self.shard_format == 'indexed':
+            os.replace(self.shard_path + SHARD_INDEX_EXTENSION + '.tmp', self.shard_path + SHARD_INDEX_EXTENSION)
+
+
+def _write_indexed_shard(members, shard_path):
+    """Write (tarinfo, data) members to an indexed shard, and the index next to it."""
+    writer = ShardWriter(shard_path, 'indexed')
+    for tarinfo, data in members:
+        writer.add(tarinfo, data)
+    writer.close()
+
+
+def _tarinfo(path, arcname):
+    stat = os.stat(path)
+    tarinfo = tarfile.TarInfo(arcname)
+    tarinfo.mode, tarinfo.mtime = stat.st_mode & 0o7777, int(stat.st_mtime)
+    if os.path.isdir(path):
+        tarinfo.type = tarfile.DIRTYPE
+    else:
+        tarinfo.size = stat.st_size
+    return tarinfo
+
+
+def write_indexed_shard(source_dir, shard_path):
+    """Pack the content of source_dir into an indexed shard, with the same member names as
+    tar cf <shard_path> -C <source_dir>/ ."""
+    def members():
+        for root, dirs, files in os.walk(source_dir):
+            dirs.sort()
+            relative_root = os.path.relpath(root, source_dir)
+            arcname_root = '.' if relative_root == '.' else './' + relative_root.replace(os.sep, '/')
+            yield _tarinfo(root, arcname_root + '/'), b''
+            for file in sorted(files):
+                path = os.path.join(root, file)
+                with open(path, 'rb') as f:
+                    data = f.read()
+                    f.close()
+                yield _tarinfo(path, f'{arcname_root}/{file}'), data
+    _write_indexed_shard(members(), shard_path)
+
+
+def convert_to_indexed_shard(shard_path, output_path=None):
+    """Rewrite an existing shard in the indexed format (in place if output_path is None)."""
+    def members():
+        with tarfile.open(fileobj=bz2.BZ2File(shard_path, 'rb'), mode='r|') as tar:
+            for member in tar:
+                yield member, tar.extractfile(member).read() if member.isfile() else b''
+    _write_indexed_shard(members(), output_path or shard_path)
+
+
+class _ShardCountdown:
+    """Call on_closed once the shards of all the data types of a split are closed, from the last packing thread."""
+
+    def __init__(self, count, on_closed):
+        self._count = count
+        self._on_closed = on_closed
+        self._lock = threading.Lock()
+
+    def closed(self):
+        with self._lock:
+            self._count -= 1
+            if self._count > 0:
+                return
+        self._on_closed()
+
+
+class ShardPacker:
+    """Pack pieces into the shards of several data types in background threads, while the caller prepares the next
+    pieces.
+
+    The shards of each data type are written by one thread (a thread can own several data types), which receives the
+    files through a bounded queue of queue_size pieces. The caller only waits when the queue is full, i.e. when
+    the thread is busy compressing, and the thread only waits when the queue is empty. bz2 compression and writing to
+    pbzip2 do not hold the GIL, so they run in parallel with the caller.
+
+    Shards are written to <output_dir>/<data type>/<split>/<shard_idx>.tar.bz2.
+    """
+
+    def __init__(self, output_dir, data_types=DATA_TYPES, shard_format='tar', num_workers=1, queue_size=4):
+        self.output_dir = output_dir
+        self.shard_format = shard_format
+        num_workers = max(1, min(num_workers, len(data_types)))
+        self._owner = {data_type: i % num_workers for i, data_type in enumerate(data_types)}
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(num_workers)]
+        self._error = None
+        self.stats = {'wait_time': 0.0, 'pack_time': [0.0] * num_workers, 'idle_time': [0.0] * num_workers,
+                      'bytes': [0] * num_workers, 'shards': [0] * num_workers}
+        self._threads = [threading.Thread(target=self._work, args=(i,), daemon=True) for i in range(num_workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def _work(self, worker_idx):
+        writers = {}
+        task_queue = self._queues[worker_idx]
+        while True:
+            start = time.perf_counter()
+            task = task_queue.get()
+            self.stats['idle_time'][worker_idx] += time.perf_counter() - start
+            if task is None:
+                break
+            if self._error is not None:
+                continue  # keep consuming so that the caller is not blocked, until the end
+            start = time.perf_counter()
+            action, split, shard_idx, data_type, payload = task
+            try:
+                if action == 'add':
+                    if (split, data_type) not in writers:
+                        shard_path = os.path.join(self.output_dir, data_type, split, f'{shard_idx}.tar.bz2')
+                        writers[(split, data_type)] = ShardWriter(shard_path, self.shard_format)
+                    for name, data in payload.items():
+                        writers[(split, data_type)].add_file(name, data)
+                        self.stats['bytes'][worker_idx] += len(data)
+                else:
+                    if (split, data_type) in writers:
+                        writers.pop((split, data_type)).close()
+                        self.stats['shards'][worker_idx] += 1
+                    if payload is not None:
+                        payload.closed()
+            except Exception:
+                self._error = traceback.format_exc()
+            self.stats['pack_time'][worker_idx] += time.perf_counter() - start
+
+    def _put(self, data_type, task):
+        start = time.perf_counter()
+        task_queue = self._queues[self._owner[data_type]]
+        while True:
+            if self._error is not None:
+                raise RuntimeError(f'Failed to pack a shard:\n{self._error}')
+            try:
+                task_queue.put(task, timeout=1)
+                break
+            except queue.Full:
+                continue
+        self.stats['wait_time'] += time.perf_counter() - start
+
+    def add_piece(self, split, shard_idx, files):
+        """Add the files of a piece, {data type: {path in the shard: bytes}}, to the shards shard_idx of split."""
+        for data_type, data_type_files in files.items():
+            self._put(data_type, ('add', split, shard_idx, data_type, data_type_files))
+
+    def close_shard(self, split, on_closed=None):
+        """Finish the shards of split being written. on_closed is called, from a packing thread, once the shards of
+        all the data types are written. It is not called if writing a shard failed."""
+        countdown = _ShardCountdown(len(self._owner), on_closed) if on_closed is not None else None
+        for data_type in self._owner:
+            self._put(data_type, ('close', split, None, data_type, countdown))
+
+    def close(self, splits=()):
+        """Finish the shards of splits, and stop the threads. Raises if writing a shard failed."""
+        for split in splits:
+            self.close_shard(split)
+        for task_queue in self._queues:
+            task_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        if self._error is not None:
+            raise RuntimeError(f'Failed to pack a shard:\n{self._error}')
+
+    def abort(self):
+        """Stop the threads without finishing the shards, which are left as .tmp files."""
+        if self._error is None:
+            self._error = 'aborted'
+        for task_queue in self._queues:
+            task_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def summary(self):
+        """The throughput of the packing threads, and the time the caller waited for them."""
+        lines = [f'waited {self.stats["wait_time"]:.1f}s for packing']
+        for i in range(len(self._threads)):
+            pack_time = self.stats['pack_time'][i]
+            megabytes = self.stats['bytes'][i] / 1e6
+            data_types = ', '.join(data_type for data_type, owner in self._owner.items() if owner == i)
+            lines.append(f'packing thread {i} ({data_types}): {megabytes:.1f} MB in {self.stats["shards"][i]} '
+                         f'shards, {pack_time:.1f}s busy ({megabytes / max(pack_time, 1e-9):.1f} MB/s), '
+                         f'{self.stats["idle_time"][i]:.1f}s idle')
+        return '\n'.join(lines)
+
+
+class ShardIndex:
+    """Random access to the pieces of indexed shards.
+
+    Loads the indexes of the shards of a data type and split (or of the given shard_paths), then reads a single file
+    of a piece by decompressing only its frame, independently of the size of the shard.
+    """
+
+    def __init__(self, data_dir=None, data_type='main_dataset', split='train', shard_paths=None):
+        if shard_paths is None:
+            shard_paths = list_shards(data_dir, data_type, split)
+        self.pieces = {}
+        for shard_path in shard_paths:
+            index_path = shard_path + SHARD_INDEX_EXTENSION
+            if not os.path.exists(index_path):
+                raise FileNotFoundError(f'{index_path} not found, convert the shard with '
+                                        f'data_download/index_shards.py.')
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+                f.close()
+            for piece, files in index['pieces'].items():
+                self.pieces[piece] = (shard_path, files)
+
+    def __contains__(self, piece_id):
+        return piece_id in self.pieces
+
+    def __len__(self):
+        return len(self.pieces)
+
+    def list_files(self, piece_id):
+        return list(self.pieces[piece_id][1].keys())
+
+    def read_file(self, piece_id, name):
+        """Read the bytes of one file of a piece, e.g. read_file('string_track000123', 'stems_audio/0_violin.wav')."""
+        shard_path, files = self.pieces[piece_id]
+        frame_offset, frame_size, data_offset, data_size = files[name]
+        with open(shard_path, 'rb') as f:
+            f.seek(frame_offset)
+            frame = f.read(frame_size)
+            f.close()
+        return bz2.decompress(frame)[data_offset:data_offset + data_size]
+
+    def get_piece(self, piece_id, names=None, decode=True):
+        """Read the files of a piece (or only the given names), decoded by decode_piece unless decode is False."""
+        names = names if names is not None else self.list_files(piece_id)
+        files = {name: self.read_file(piece_id, name) for name in names}
+        return decode_piece(files) if decode else files
@@ -0,0 +1,203 @@
+"""
+Utilities for saving and loading synthesis parameters in a columnar format that can be memory-mapped.
+
+The file starts with a small JSON header giving, for each parameter (f0_hz, amplitudes, harmonic_distribution,
+noise_magnitudes), the dtype, shape and byte offset of one contiguous array holding the frames of all the parts
+one after another, and the range of frames of each part. The arrays follow the header, aligned to 64 bytes.
+
+The arrays can optionally be stored with a reduced precision encoding, trading accuracy for 2-4x less storage
+and read bandwidth. The absolute error of each decoded value x is bounded by (see encoding_error_bound):
+ - 'float32': no error, this is the default.
+ - 'float16': 2^-11 * |x| (about 0.05%), or 2^-25 for |x| < 2^-14. Values must be below 65504 in magnitude.
+ - 'int16': each channel (last axis) is quantized to 65536 levels between its min and max,
+   the error is (max - min) / 131070 of the channel, plus float32 rounding (2^-23 * |x|).
+ - 'int8': same as int16 with 256 levels, the error is (max - min) / 510 of the channel, plus float32 rounding.
+   Too coarse for f0_hz in most uses.
+For the integer encodings, the scale and offset of each channel are stored in the header,
+and the value is decoded as stored * scale + offset.
+"""
+
+import io
+import json
+import struct
+import numpy as np
+
+SYNTH_PARAMS_MAGIC = b'CCSYNTHP'
+SYNTH_PARAMS_VERSION = 1
+SYNTH_PARAMS_EXTENSION = '.params'
+ALIGNMENT = 64
+ENCODINGS = ['float32', 'float16', 'int16', 'int8']
+
+
+def _align(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def encode_array(array, encoding):
+    """Encode an array. Returns the array to store, and the per-channel scale and offset for integer encodings."""
+    if encoding not in ENCODINGS:
+        raise ValueError(f'Encoding {encoding} not supported, should be one of {ENCODINGS}.')
+    if encoding.startswith('float'):
+        return array.astype(encoding), None, None
+    int_info = np.iinfo(encoding)
+    array = array.astype(np.float64)
+    reduce_axis = tuple(range(array.ndim - 1))
+    if array.size:
+        low, high = array.min(axis=reduce_axis), array.max(axis=reduce_axis)
+    else:
+        low, high = np.zeros(array.shape[-1]), np.zeros(array.shape[-1])
+    scale = (high - low) / (int_info.max - int_info.min)
+    scale[scale == 0] = 1.0  # constant channel
+    offset = low - int_info.min * scale
+    # round the scale and offset to the float32 used for decoding, before quantizing.
+    scale, offset = scale.astype(np.float32).astype(np.float64), offset.astype(np.float32).astype(np.float64)
+    quantized = np.clip(np.round((array - offset) / scale), int_info.min, int_info.max).astype(encoding)
+    return quantized, scale.tolist(), offset.tolist()
+
+
+def decode_array(stored, scale=None, offset=None):
+    """Decode an array stored by encode_array to float32."""
+    decoded = stored.astype(np.float32)
+    if scale is not None:
+        decoded *= np.asarray(scale, dtype=np.float32)
+        decoded += np.asarray(offset, dtype=np.float32)
+    return decoded
+
+
+def encoding_error_bound(array, encoding):
+    """Upper bound of the absolute error of each value of array after it is encoded and decoded."""
+    array = np.asarray(array, dtype=np.float64)
+    if encoding == 'float32':
+        return np.zeros(array.shape)
+    if encoding == 'float16':
+        return np.maximum(np.abs(array) * 2.0 ** -11, 2.0 ** -25)
+    _, scale, offset = encode_array(array, encoding)
+    scale, offset = np.asarray(scale), np.asarray(offset)
+    # half a quantization step, plus the float32 rounding of stored * scale + offset.
+    return scale / 2 + (np.abs(array) + np.abs(offset) + scale) * 2.0 ** -22
+
+
+def dump_synthesis_parameters(synthesis_parameters, f, encoding='float32'):
+    """Write synthesis parameters ({part: {parameter: array [frames, ...]}}) in the columnar format to the file
+    object f, with the arrays stored in the given encoding."""
+    parts = list(synthesis_parameters.keys())
+    names = list(synthesis_parameters[parts[0]].keys())
+    part_frames = []
+    start = 0
+    for part in parts:
+        num_frames = len(synthesis_parameters[part][names[0]])
+        part_frames.append([start, start + num_frames])
+        start += num_frames
+
+    arrays, quantization = {}, {}
+    for name in names:
+        array = np.concatenate([synthesis_parameters[part][name] for part in parts], axis=0)
+        stored, scale, offset = encode_array(array, encoding)
+        arrays[name] = np.ascontiguousarray(stored)
+        quantization[name] = {'encoding': encoding, 'quantization_scale': scale, 'quantization_offset': offset}
+
+    # The offsets of the arrays depend on the size of the header, which depends on the offsets,
+    # so grow the header size until it fits.
+    header_size = 0
+    while True:
+        array_headers = {}
+        offset = header_size
+        for name, array in arrays.items():
+            array_headers[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset,
+                                   **quantization[name]}
+            offset = _align(offset + array.nbytes)
+        header = {'version': SYNTH_PARAMS_VERSION, 'parts': parts, 'part_frames': part_frames,
+                  'arrays': array_headers}
+        header_bytes = json.dumps(header).encode()
+        needed_header_size = _align(len(SYNTH_PARAMS_MAGIC) + 4 + len(header_bytes))
+        if needed_header_size <= header_size:
+            break
+        header_size = needed_header_size
+
+    start = f.tell()
+    f.write(SYNTH_PARAMS_MAGIC)
+    f.write(struct.pack('<I', len(header_bytes)))
+    f.write(header_bytes)
+    for name, array in arrays.items():
+        f.write(b'\0' * (array_headers[name]['offset'] - (f.tell() - start)))
+        f.write(array.tobytes())
+
+
+def save_synthesis_parameters(synthesis_parameters, path, encoding='float32'):
+    """Save synthesis parameters in the columnar format to path, see dump_synthesis_parameters."""
+    with open(path, 'wb') as f:
+        dump_synthesis_parameters(synthesis_parameters, f, encoding=encoding)
+        f.close()
+
+
+def synthesis_parameters_to_bytes(synthesis_parameters, encoding='float32'):
+    """Get the bytes of the columnar file of synthesis parameters, see dump_synthesis_parameters."""
+    buffer = io.BytesIO()
+    dump_synthesis_parameters(synthesis_parameters, buffer, encoding=encoding)
+    return buffer.getvalue()
+
+
+def _parse_header(data, path):
+    """Parse the header from the first bytes of a file."""
+    magic = bytes(data[:len(SYNTH_PARAMS_MAGIC)])
+    if magic != SYNTH_PARAMS_MAGIC:
+        raise ValueError(f'{path} is not a synthesis parameters file.')
+    header_start = len(SYNTH_PARAMS_MAGIC) + 4
+    header_length, = struct.unpack('<I', bytes(data[len(SYNTH_PARAMS_MAGIC):header_start]))
+    return json.loads(bytes(data[header_start:header_start + header_length]))
+
+
+def load_synthesis_parameters_header(path):
+    with open(path, 'rb') as f:
+        data = f.read(len(SYNTH_PARAMS_MAGIC) + 4)
+        if len(data) == len(SYNTH_PARAMS_MAGIC) + 4:
+            data += f.read(struct.unpack('<I', data[len(SYNTH_PARAMS_MAGIC):])[0])
+        f.close()
+    return _parse_header(data, path)
+
+
+def _get_synthesis_parameters(header, data, part, frame_range, names, decode):
+    """Get the synthesis parameters as views of data, a uint8 array holding the whole file."""
+    names = names if names is not None else list(header['arrays'].keys())
+    parts = header['parts'] if part is None else [part]
+
+    synthesis_parameters = {}
+    for p in parts:
+        part_start, part_end = header['part_frames'][header['parts'].index(p)]
+        if frame_range is not None:
+            part_start, part_end = (min(part_start + frame_range[0], part_end),
+                                    min(part_start + frame_range[1], part_end))
+        part_parameters = {}
+        for name in names:
+            array_header = header['arrays'][name]
+            dtype = np.dtype(array_header['dtype'])
+            frame_shape = array_header['shape'][1:]
+            frame_bytes = dtype.itemsize * int(np.prod(frame_shape))
+            array = np.ndarray(shape=[part_end - part_start, *frame_shape],
+                               dtype=dtype,
+                               buffer=data,
+                               offset=array_header['offset'] + part_start * frame_bytes)
+            if decode and array_header.get('encoding', 'float32') != 'float32':
+                array = decode_array(array, array_header['quantization_scale'], array_header['quantization_offset'])
+            part_parameters[name] = array
+        synthesis_parameters[p] = part_parameters
+    return synthesis_parameters if part is None else synthesis_parameters[part]
+
+
+def load_synthesis_parameters(path, part=None, frame_range=None, names=None, decode=True):
+    """Load synthesis parameters as read-only views of a memory map of the file, without copying.
+
+    If part is None, returns {part: {parameter: array}} for all the parts, else returns {parameter: array} of the part.
+    frame_range=(start, end) selects frames [start, end) of each part. names selects a subset of the parameters.
+    Arrays saved with a reduced precision encoding are decoded to float32 (which copies them), unless decode is False.
+    """
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    header = _parse_header(data, path)
+    return _get_synthesis_parameters(header, data, part, frame_range, names, decode)
+
+
+def load_synthesis_parameters_from_buffer(buffer, part=None, frame_range=None, names=None, decode=True):
+    """Same as load_synthesis_parameters, for a file already read into memory (e.g. read from a tar)."""
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    header = _parse_header(data, '<buffer>')
+    return _get_synthesis_parameters(header, data, part, frame_range, names, decode)